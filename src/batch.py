@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import time
+from openai import OpenAI
+
+# Offline batch mode
+# 1. Run a script with ``--plan BATCH_FILE``: answers already in the response cache are used as usual,
+#    and every request without a cached response is written to BATCH_FILE instead of being sent.
+# 2. Submit BATCH_FILE to the Batch API (or to ``simulate`` below) and download the results file.
+# 3. Run the script again with ``--ingest RESULTS_FILE --plan BATCH_FILE``: the results are stored
+#    in the response cache, parsed by the usual code, and the next wave of requests is planned.
+# Repeat until no requests are pending; the script then writes its results as in a normal run.
+
+
+def read_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def write_jsonl(path, records):
+    if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+def ingest_results(results_file, cache):
+    # Store the responses of a Batch API results file in the response cache,
+    # where ``custom_id`` is the cache key of the request
+    stored = 0
+    failed = 0
+    for result in read_jsonl(results_file):
+        response = result.get('response') or dict()
+        if result.get('error') or response.get('status_code') != 200:
+            # not stored, so the request is planned again
+            failed += 1
+            continue
+        choices = [choice['message']['content'] for choice in response['body']['choices']]
+        # all samples of a request with ``n`` (see ``prompt.sample_responses``)
+        cache.store(result['custom_id'], choices if len(choices) > 1 else choices[0])
+        stored += 1
+    print(f"Ingested {stored} responses from {results_file}" + (f" ({failed} failed)" if failed else ""))
+    return stored
+
+
+def plan_summary(cache, unfinished):
+    # Report what is left after a run in plan mode
+    if not cache.pending:
+        return "No pending requests."
+    return (f"{len(cache.pending)} pending requests written to {cache.batch_file} ({unfinished} unfinished); "
+            f"run again with ``--ingest RESULTS_FILE --plan {cache.batch_file}`` once they are answered.")
+
+
+def run_local_batch(batch_file, results_file, client):
+    # A file-based stand-in for the batch endpoint: answers every request of ``batch_file``
+    # with ``client`` (e.g., one pointing at a local server) and writes them in the results format
+    results = list()
+    for number, request in enumerate(read_jsonl(batch_file)):
+        try:
+            completion = client.chat.completions.create(**request['body'])
+            response = {'status_code': 200, 'request_id': f'local-{number}', 'body': completion.model_dump()}
+            error = None
+        except Exception as e:
+            response = None
+            error = {'code': type(e).__name__, 'message': str(e)}
+        results.append({'id': f'batch_req_{number}', 'custom_id': request['custom_id'],
+                        'response': response, 'error': error})
+    write_jsonl(results_file, results)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tools for the offline batch mode')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    simulate = subparsers.add_parser('simulate', help='answer a batch file locally instead of with the Batch API')
+    simulate.add_argument('batch_file')
+    simulate.add_argument('results_file')
+    simulate.add_argument('--base-url', default=os.environ.get('OPENAI_BASE_URL'),
+                          help='OpenAI-compatible endpoint answering the requests (default: $OPENAI_BASE_URL)')
+    simulate.add_argument('--api-key', default=os.environ.get('OPENAI_API_KEY', '[API_KEY]'))
+    args = parser.parse_args()
+
+    start = time.time()
+    client = OpenAI(api_key=args.api_key, base_url=args.base_url)
+    results = run_local_batch(args.batch_file, args.results_file, client)
+    failed = sum(1 for result in results if result['error'])
+    print(f"Answered {len(results) - failed}/{len(results)} requests in {time.time() - start:.1f}s; "
+          f"results written to {args.results_file}")
+
+
+if __name__ == "__main__":
+    main()
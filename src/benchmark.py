@@ -0,0 +1,512 @@
+import argparse
+import hashlib
+from itertools import islice
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+
+FEW_INTERM_FILE = 'data/csv/few_interm_result.csv'
+FEW_RESULT_FILE = 'data/csv/few_result.csv'
+ANNOTATION_FILE = 'data/annotation/human_annotation_simple.tsv'
+BASELINE_FILE = 'result/benchmark/parsers_baseline.json'
+CHUNK_ROWS = 100  # rows per call of the functions cleaning a whole DataFrame
+TOLERANCE = 0.2  # relative change in throughput or p99 latency flagged as a regression
+VOTE_LATENCY = 'lognormal:0.5,0.4'  # latency of the mock server in the ``votes`` benchmark
+RANGE_MB = 256  # megabytes of the compressed dump per range in the ``wikidump`` benchmark, as in wikiall.py
+
+
+class ConcatRows:
+    # The accumulation used before ``RowBuffer``: a one-row DataFrame concatenated for every row
+    def __init__(self, col_names):
+        self.col_names = list(col_names)
+        self.df = pd.DataFrame(columns=self.col_names)
+
+    def append(self, col_values):
+        new_df = pd.DataFrame([dict(zip(self.col_names, col_values))])
+        self.df = pd.concat([self.df, new_df], axis=0, ignore_index=True)
+
+    def to_frame(self):
+        return self.df
+
+
+def read_tsv(path, rows=None):
+    return pd.read_csv(path, sep='\t', encoding='utf-8', dtype=str, keep_default_na=False, nrows=rows)
+
+
+def bench_cleaning(args):
+    # Time ``fewshot.clean_parts_materials`` with the old and the new row accumulation
+    import fewshot
+
+    raw_df = read_tsv(FEW_INTERM_FILE, args.rows)
+    col_names = list(raw_df.columns)
+    print(f"Cleaning {len(raw_df)} rows of {FEW_INTERM_FILE}")
+
+    timings = dict()
+    outputs = dict()
+    row_buffer = fewshot.RowBuffer
+    try:
+        for name, row_class in [('DataFrame per row', ConcatRows), ('RowBuffer', row_buffer)]:
+            fewshot.RowBuffer = row_class
+            start = time.perf_counter()
+            outputs[name] = fewshot.clean_parts_materials(raw_df, col_names)
+            timings[name] = time.perf_counter() - start
+            print(f"  {name:<20} {timings[name]:8.2f}s  ({len(raw_df) / timings[name]:,.0f} rows/sec)")
+    finally:
+        fewshot.RowBuffer = row_buffer
+
+    before, after = outputs.values()
+    print(f"  speedup {timings['DataFrame per row'] / timings['RowBuffer']:.1f}x, "
+          f"identical output: {bool((before.values == after.values).all())}")
+    expected_df = read_tsv(FEW_RESULT_FILE)
+    matches = (after.values == expected_df.iloc[:len(after)].values).all(axis=1).sum()
+    print(f"  {matches}/{len(after)} rows match {FEW_RESULT_FILE}")
+
+
+def legacy_extract_material_str(material_str):
+    # ``prompt.extract_material_str`` before its patterns were compiled once, kept for comparison
+    material_keywords = {'alloy', 'aluminium', 'aluminum',
+                        'bamboo', 'bone', 'brass', 'brick', 'bronze',
+                        'cardboard', 'cement', 'cements', 'ceramic',
+                        'chemical', 'clay', 'concrete', 'copper', 'cotton',
+                        'electronic', 'fabric', 'felt', 'fiber', 'foam',
+                        'gel', 'gem', 'glass', 'gold', 'hardboard', 'hardwood',
+                        'iron', 'ivory', 'ivories', 'leather', 'linen', 'liquid', 'lumber',
+                        'metal', 'nickel', 'nylon', 'paper', 'plastic', 'platinum', 'plywood',
+                        'polyester', 'porcelain', 'powder', 'quartz', 'rubber', 'satin', 'silicon', 'silk',
+                        'silver', 'slate', 'spandex', 'steel', 'stone', 'synthetic',
+                        'textile', 'tile', 'titanium', 'vinyl', 'wood', 'wool'}
+
+    # if materials are listed after 'various/varied', then take the listed materials
+    # otherwise, simplify it by changing it to 'various materials'
+    if any(material_str.lower().startswith(varying_token) for varying_token in {'varied', 'varies', 'various', 'vary'}) or \
+            (' varies' in material_str.lower() or ' vary' in material_str.lower()):
+        has_include_token = re.search(r'^(includ)| includ|\(includ', material_str.lower())
+        if has_include_token:
+            material_str = material_str[has_include_token.end():].split(" ", 1)[-1]
+        elif any(any(token.lower().startswith(keyword) for keyword in material_keywords) for token in
+                 re.split(r'\s|\(', material_str)):
+            for token in re.split(r'\s|\(', material_str):
+                if any(token.lower().startswith(keyword) for keyword in material_keywords):
+                    material_str = material_str[material_str.find(token):].split(", depending ")[0].split(" depending ")[0]
+                    break
+        else:
+            material_str = 'various materials'
+
+    # remove parts whose material doesn't exist; e.g., "N/A", "no materials", "none".
+    elif (not material_str) or material_str in {'—', '-'} or \
+            any(material_str.lower().startswith(neg_token) for neg_token in {'not ', 'no ', 'none', 'n/a'}) or \
+            (('no ' in material_str.lower() or 'not ' in material_str.lower()) and\
+             ('material' in material_str.lower() or 'physical' in material_str.lower())):
+        return '-'
+
+    # convert a sentence to a phrase with a list of nouns
+    found_predicate = re.search(r'(be|is|are) ([\sa-zA-Z]*)made [a-zA-Z]* ', material_str)
+    if found_predicate:
+        material_str = material_str[found_predicate.end():]
+
+    # clean up
+    material_str = re.sub(r'(\s)*\([^)]*\)', '', material_str)
+    material_str = material_str.split(", etc.", 1)[0].split(")", 1)[0].strip('. ')
+
+    # convert 'combination/mix/blend of both' to 'and/or'
+    conj_list = [' and/or ', ' or ', ' and ', ', ']
+    comb_list = list()
+    for comb_head, plural in {'combination': 's', 'blend': 's', 'mix': 'es'}.items():
+        for comb_word in ['a ' + comb_head, comb_head + plural]:
+            for comb_tail in [' of both', ' thereof']:
+                # e.g., 'A, B, a blend thereof'
+                if comb_word + comb_tail in material_str:
+                    comb_list.append(comb_word + comb_tail)
+            # e.g., 'A, B, or a blend'
+            if any(any(c1 + comb_word + c2 in material_str or material_str.endswith(c1 + comb_word)
+                       for c1 in conj_list) for c2 in conj_list):
+                comb_list.append(comb_word)
+    if any(any(c1 + 'both' + c2 in material_str or material_str.endswith(c1 + 'both')
+               for c1 in conj_list) for c2 in conj_list):
+        comb_list.append('both')
+
+    for comb_phrase in comb_list:
+        import prompt
+        two_materials, rest_materials = material_str.split(comb_phrase, 1)
+        _, conj_ind = prompt.find_last_conjuction(two_materials, conj_list)
+        two_materials = two_materials[:conj_ind]
+        two_materials = two_materials.strip(',')
+        last_conj, last_conj_ind = prompt.find_last_conjuction(two_materials, conj_list)
+        material_str = two_materials[:last_conj_ind] + ' and/or ' + two_materials[last_conj_ind + len(
+            last_conj):] + rest_materials
+
+    return material_str
+
+
+def bench_materials(args):
+    # Time ``prompt.extract_material_str`` against the implementation before it was precompiled
+    import prompt
+
+    raw_df = read_tsv(FEW_INTERM_FILE, args.rows)
+    material_list = list(material_strings(raw_df))
+    print(f"Extracting {len(material_list)} material strings of {FEW_INTERM_FILE}")
+
+    timings = dict()
+    outputs = dict()
+    for name, func in [('before', legacy_extract_material_str), ('precompiled', prompt.extract_material_str)]:
+        timings[name] = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            outputs[name] = [func(material_str) for material_str in material_list]
+            timings[name] = min(timings[name], time.perf_counter() - start)
+        print(f"  {name:<20} {timings[name]:8.3f}s  ({len(material_list) / timings[name]:,.0f} rows/sec)")
+    print(f"  speedup {timings['before'] / timings['precompiled']:.1f}x, "
+          f"identical output: {outputs['before'] == outputs['precompiled']}")
+
+
+def material_strings(raw_df):
+    # The strings ``extract_material_str`` gets from ``clean_parts_materials``: one per part line
+    for response in raw_df['response']:
+        if "\n" not in response:
+            yield response.strip(".")
+        else:
+            for line in response.split("\n"):
+                if ": " in line:
+                    yield line.split(": ", 1)[1]
+
+
+def zeroshot_frame(raw_df):
+    # zeroshot.py's intermediate rows rebuilt from the few-shot rows, since no zero-shot results are shipped:
+    # Question 5 (A) without distinct parts, Question 7 (B) with the same materials, else Question 8 (C)
+    import mockserver
+
+    rows = list()
+    for item, subtype, subsubtype, optionality, response in raw_df.itertuples(index=False):
+        entry = {'parts': mockserver.parse_parts(optionality), 'materials': response}
+        materials = set(mockserver.part_materials(entry).values())
+        if not entry['parts']:
+            rows.append([item, subtype, subsubtype, 'A', mockserver.summarize_materials(response)])
+        elif len(materials) <= 1:
+            rows.append([item, subtype, subsubtype, 'B', "<Parts>\n" + mockserver.answer_parts(entry, False) +
+                         "\n\n<Materials>: " + mockserver.summarize_materials(response)])
+        else:
+            rows.append([item, subtype, subsubtype, 'C', mockserver.answer_parts(entry, True)])
+    return pd.DataFrame(rows, columns=['item', 'subtype', 'subsubtype', 'question', 'response'])
+
+
+def likely_responses(canned):
+    # Answers to zeroshot.q_likely_types; every third type is "probably unlikely" to exercise both branches
+    for noun, types in canned.nouns.items():
+        if list(types.keys()) != ['-']:
+            yield "\n" + "\n".join(f"{number}. {subtype} - " + ("probably unlikely" if number % 3 == 0 else "likely") +
+                                    " recognized by most people" for number, subtype in enumerate(types, 1))
+
+
+def chunks(df, rows):
+    return [df.iloc[start:start + rows] for start in range(0, len(df), rows)]
+
+
+def parser_cases(rows):
+    # name -> (function, calls as argument tuples, rows per call)
+    import fewshot
+    import mockserver
+    import prompt
+    import zeroshot
+
+    annotation_df = read_tsv(ANNOTATION_FILE, rows)
+    # some annotated parts have no materials, which the model's responses always have
+    annotation_df = annotation_df[annotation_df['response'].map(
+        lambda response: "\n" not in response or all(": " in line for line in response.split("\n")))]
+    few_df = pd.concat([read_tsv(FEW_INTERM_FILE, rows), annotation_df], ignore_index=True)
+    col_names = list(few_df.columns)
+    zero_df = zeroshot_frame(few_df)
+    canned = mockserver.CannedResponses(FEW_INTERM_FILE)
+    nouns = list(canned.nouns)[:rows]
+    cases = {
+        'extract_material_str': (prompt.extract_material_str,
+                                 [(material_str,) for material_str in material_strings(few_df)], 1),
+        'clean_parts_materials': (fewshot.clean_parts_materials,
+                                  [(chunk, col_names) for chunk in chunks(few_df, CHUNK_ROWS)], CHUNK_ROWS),
+        'extract_parts_materials': (zeroshot.extract_parts_materials,
+                                    [(question, response) for question, response in
+                                     zip(zero_df['question'], zero_df['response'])], 1),
+        'clean_response_format': (zeroshot.clean_response_format,
+                                  [(chunk,) for chunk in chunks(zero_df, CHUNK_ROWS)], CHUNK_ROWS),
+        'extract_types': (fewshot.extract_types,
+                          [(noun, canned.answer_types(noun), 512, fewshot.MODEL, None) for noun in nouns], 1),
+        'extract_likely_items': (zeroshot.extract_likely_items,
+                                 [(response,) for response in likely_responses(canned)][:rows], 1),
+    }
+    try:
+        # downloads the benepar and WordNet models when imported
+        from filterwiki import get_first_sentence
+        cases['get_first_sentence'] = (get_first_sentence, [(response,) for response in few_df['response']], 1)
+    except Exception as error:
+        print(f"Skipping get_first_sentence: filterwiki cannot be imported ({error!r})")
+    return cases
+
+
+def fingerprint(outputs):
+    digest = hashlib.sha256()
+    for output in outputs:
+        digest.update((output.to_csv(sep='\t') if isinstance(output, pd.DataFrame) else repr(output)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def measure(func, calls, rows_per_call, repeat):
+    # Throughput of the fastest pass, latency percentiles over all calls,
+    # and the allocations of one more pass traced separately since tracing slows it down
+    latencies = list()
+    best = float('inf')
+    for _ in range(repeat):
+        outputs = list()
+        start = time.perf_counter()
+        for args in calls:
+            call_start = time.perf_counter()
+            outputs.append(func(*args))
+            latencies.append(time.perf_counter() - call_start)
+        best = min(best, time.perf_counter() - start)
+    latencies.sort()
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for args in calls:
+        func(*args)
+    after = tracemalloc.take_snapshot()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+
+    row_count = sum(len(args[0]) for args in calls) if rows_per_call > 1 else len(calls)
+    return {'rows': row_count, 'rows_per_sec': row_count / best if best else 0.0,
+            'p50_ms': latencies[len(latencies) // 2] * 1000, 'p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+            'peak_kib': peak / 1024, 'blocks': blocks, 'digest': fingerprint(outputs)}
+
+
+def regressions(result, baseline, tolerance):
+    flags = list()
+    if result['rows_per_sec'] < baseline['rows_per_sec'] * (1 - tolerance):
+        flags.append(f"{1 - result['rows_per_sec'] / baseline['rows_per_sec']:.0%} slower")
+    if result['p99_ms'] > baseline['p99_ms'] * (1 + tolerance):
+        flags.append(f"p99 {result['p99_ms'] / baseline['p99_ms']:.1f}x")
+    if result['rows'] == baseline['rows'] and result['digest'] != baseline['digest']:
+        flags.append("output changed")
+    return flags
+
+
+def bench_parsers(args):
+    # Time the response parsers on the shipped corpora and compare them with a stored baseline
+    import fewshot
+
+    cases = parser_cases(args.rows)
+    if args.functions:
+        cases = {name: case for name, case in cases.items() if name in args.functions}
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    # extract_types asks the model to confirm the subtypes; keep the names as "1)" answers would
+    confirm_subtypes = fewshot.confirm_subtypes
+    fewshot.confirm_subtypes = lambda subtypes, *_: {subtype: subtype for subtype in subtypes}
+    results = dict()
+    failed = False
+    try:
+        print(f"{'function':<25}{'rows':>8}{'rows/sec':>12}{'p50 ms':>10}{'p99 ms':>10}{'peak KiB':>10}{'blocks':>9}")
+        for name, (func, calls, rows_per_call) in cases.items():
+            results[name] = measure(func, calls, rows_per_call, args.repeat)
+            result = results[name]
+            flags = regressions(result, baseline[name], args.tolerance) if name in baseline else ['no baseline']
+            failed = failed or (name in baseline and bool(flags))
+            print(f"{name:<25}{result['rows']:>8}{result['rows_per_sec']:>12,.0f}{result['p50_ms']:>10.3f}"
+                  f"{result['p99_ms']:>10.3f}{result['peak_kib']:>10,.0f}{result['blocks']:>9,}  {', '.join(flags)}")
+    finally:
+        fewshot.confirm_subtypes = confirm_subtypes
+
+    if args.save_baseline:
+        if os.path.dirname(args.baseline) and not os.path.exists(os.path.dirname(args.baseline)):
+            os.makedirs(os.path.dirname(args.baseline))
+        with open(args.baseline, 'w') as f:
+            json.dump({**baseline, **results}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
+    elif failed:
+        sys.exit(1)
+
+
+def legacy_q_has_types(item, max_tokens, model, client):
+    # ``zeroshot.q_has_types`` before the votes were sampled with ``n``: up to three requests one after another
+    import prompt
+
+    question = f'Are there any essential, non-optional parts\n1) that are present in one type of {item} but absent in another and\n2) that would be recognized by most people?\nSimply say "yes" or "no".'
+    res = {'yes': 0, 'no': 0}
+    for i in range(3):
+        response = prompt.receive_response(question, max_tokens, model, client)
+        if 'yes' not in response.lower():
+            res['no'] += 1
+        else:
+            res['yes'] += 1
+        if i == 1 and min(res.values()) == 0:
+            return max(res, key=res.get)
+    return max(res, key=res.get)
+
+
+def bench_votes(args):
+    # Per-noun latency, requests and tokens of Question 1's majority vote against the mock server
+    from openai import OpenAI
+    import mockserver
+    import prompt
+    import zeroshot
+
+    mock = mockserver.MockLLM(mockserver.CannedResponses(FEW_INTERM_FILE), latency=args.latency, seed=0)
+    server = mockserver.start_server(mock, port=0)
+    client = OpenAI(api_key='mock', base_url=f"http://{mockserver.HOST}:{server.server_port}/v1")
+    nouns = list(mock.canned.nouns)[:args.nouns]
+    model = zeroshot.MODEL
+    strategies = [
+        ('sequential (before)', lambda noun: legacy_q_has_types(noun, 10, model, client), True),
+        (f'n={args.votes}', lambda noun: zeroshot.q_has_types(noun, 10, model, args.votes, False, client), True),
+        (f'n={args.votes}, early exit', lambda noun: zeroshot.q_has_types(noun, 10, model, args.votes, True, client),
+         True),
+        (f'{args.votes} concurrent requests',
+         lambda noun: zeroshot.q_has_types(noun, 10, model, args.votes, False, client), False),
+    ]
+    print(f"Majority vote of Question 1 for {len(nouns)} nouns, mock latency {args.latency}")
+    print(f"{'strategy':<28}{'p50 s':>8}{'mean s':>8}{'p99 s':>8}{'requests':>10}{'prompt tok':>12}{'compl tok':>11}")
+    n_sampling = prompt.N_SAMPLING
+    answers = dict()
+    try:
+        for name, func, use_n in strategies:
+            prompt.N_SAMPLING = use_n
+            prompt.TELEMETRY.clear()
+            latencies = list()
+            answers[name] = list()
+            for noun in nouns:
+                start = time.perf_counter()
+                answers[name].append(func(noun))
+                latencies.append(time.perf_counter() - start)
+            latencies.sort()
+            records = prompt.TELEMETRY.records
+            print(f"{name:<28}{latencies[len(latencies) // 2]:>8.2f}{sum(latencies) / len(latencies):>8.2f}"
+                  f"{latencies[int(len(latencies) * 0.99)]:>8.2f}{len(records):>10}"
+                  f"{sum(record['prompt_tokens'] for record in records):>12}"
+                  f"{sum(record['completion_tokens'] for record in records):>11}")
+    finally:
+        prompt.N_SAMPLING = n_sampling
+        server.shutdown()
+    first = next(iter(answers.values()))
+    print(f"Same answers as before: {all(noun_answers == first for noun_answers in answers.values())}")
+
+
+def count_range(path, start, end):
+    # Runs in a worker of ``run_ranges``: ``wikiall.extract_range`` without writing the shard
+    import wikiall
+    import wikidump
+
+    entities = 0
+    rows = 0
+    for line in wikidump.iter_range_lines(path, start, end):
+        for data in wikidump.read_line(line, wikiall.entity_row, wikiall.ENTITY_FILTER):
+            entities += 1
+            rows += data is not None
+    return {'entities': entities, 'rows': rows}
+
+
+def bench_wikidump(args):
+    # Entities per second of wikiall's extraction: the qwikidata loop decoding every entity with the json module,
+    # and ``wikidump.iter_range_lines`` over the first range with and without ENTITY_FILTER and orjson
+    from qwikidata.json_dump import WikidataJsonDump
+    import wikiall
+    import wikidump
+
+    range_bytes = args.range_mb << 20
+    size = os.path.getsize(args.dump)
+    first_range = min(size, range_bytes) if args.dump.endswith('.bz2') else size
+
+    def range_rows(required):
+        return (row for line in wikidump.iter_range_lines(args.dump, 0, first_range)
+                for row in wikidump.read_line(line, wikiall.entity_row, required))
+
+    strategies = [
+        ('qwikidata (before)', json.loads, lambda: map(wikiall.entity_row, WikidataJsonDump(args.dump))),
+        ('json', json.loads, lambda: range_rows(())),
+        ('json, filter', json.loads, lambda: range_rows(wikiall.ENTITY_FILTER)),
+    ]
+    if wikidump.orjson:
+        strategies.append(('orjson, filter', wikidump.orjson.loads, lambda: range_rows(wikiall.ENTITY_FILTER)))
+    print(f"Extracting the first {args.entities:,} entities of {args.dump}")
+    print(f"{'strategy':<24}{'seconds':>9}{'entities/sec':>14}{'rows':>9}")
+    loads = wikidump.loads
+    outputs = dict()
+    try:
+        for name, strategy_loads, rows in strategies:
+            wikidump.loads = strategy_loads
+            start = time.perf_counter()
+            outputs[name] = [row for row in islice(rows(), args.entities) if row is not None]
+            seconds = time.perf_counter() - start
+            print(f"{name:<24}{seconds:>9.2f}{args.entities / seconds:>14,.0f}{len(outputs[name]):>9,}")
+    finally:
+        wikidump.loads = loads
+    first = next(iter(outputs.values()))
+    print(f"Same rows as before: {all(output == first for output in outputs.values())}")
+
+    if args.workers != 1:
+        # ``run_ranges`` on as many ranges as workers; the other ranges are marked done in a progress file of its own
+        workers = args.workers or os.cpu_count()
+        with tempfile.TemporaryDirectory() as folder:
+            progress = wikidump.RangeProgress(os.path.join(folder, 'progress.json'), args.dump, range_bytes)
+            for start, end in progress.ranges()[workers:]:
+                progress.state['done'][str(start)] = None
+            progress.save()
+            start = time.perf_counter()
+            progress = wikidump.run_ranges(args.dump, count_range, progress.progress_file, workers, range_bytes)
+            seconds = time.perf_counter() - start
+        results = [range_done['result'] for range_done in progress.state['done'].values() if range_done]
+        entities = sum(result['entities'] for result in results)
+        print(f"{f'run_ranges, {len(results)} ranges':<24}{seconds:>9.2f}{entities / seconds:>14,.0f}"
+              f"{sum(result['rows'] for result in results):>9,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks on the data shipped in data/')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    cleaning = subparsers.add_parser('cleaning', help='row accumulation in clean_parts_materials')
+    cleaning.add_argument('--rows', type=int, default=None,
+                          help='number of rows to clean (default: all); the old accumulation is quadratic in this')
+    cleaning.set_defaults(func=bench_cleaning)
+
+    materials = subparsers.add_parser('materials', help='extract_material_str before and after precompiling')
+    materials.add_argument('--rows', type=int, default=None, help='number of rows to read (default: all)')
+    materials.add_argument('--repeat', type=int, default=3, help='timed passes of each implementation')
+    materials.set_defaults(func=bench_materials)
+
+    parsers = subparsers.add_parser('parsers', help='throughput, latency and allocations of the response parsers')
+    parsers.add_argument('--rows', type=int, default=None, help='number of rows read from each corpus (default: all)')
+    parsers.add_argument('--repeat', type=int, default=3, help='timed passes per function')
+    parsers.add_argument('--functions', nargs='+', default=None, help='only these functions')
+    parsers.add_argument('--baseline', default=BASELINE_FILE)
+    parsers.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parsers.add_argument('--tolerance', type=float, default=TOLERANCE,
+                         help='relative slowdown flagged as a regression (exit status 1)')
+    parsers.set_defaults(func=bench_parsers)
+
+    votes = subparsers.add_parser('votes', help="q_has_types' majority vote against the mock server")
+    votes.add_argument('--nouns', type=int, default=50, help='number of nouns asked about')
+    votes.add_argument('--votes', type=int, default=3, help='samples per vote')
+    votes.add_argument('--latency', default=VOTE_LATENCY, help='latency distribution of the mock server')
+    votes.set_defaults(func=bench_votes)
+
+    dump = subparsers.add_parser('wikidump', help="wikiall's extraction from a Wikidata dump, in entities/sec")
+    dump.add_argument('dump', help='Wikidata dump, e.g., latest-all.json.bz2')
+    dump.add_argument('--entities', type=int, default=200000, help='number of entities read from the start of the dump')
+    dump.add_argument('--workers', type=int, default=1,
+                      help='also time run_ranges on this many ranges and processes (0: all cores; default 1: not timed)')
+    dump.add_argument('--range-mb', type=int, default=RANGE_MB, help='megabytes of the compressed dump per range')
+    dump.set_defaults(func=bench_wikidump)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+from contextlib import contextmanager
+import contextvars
+import json
+import os
+import threading
+import time
+from cache import current_scope
+
+# Limits of the requests made for one noun and of one retry loop, i.e., a loop asking again
+# until a response passes a check; None for no limit.
+# A noun over its limits is skipped (written without rows) and the run goes on with the next noun;
+# a retry loop over its limits stops asking and falls back to a defined outcome, e.g., keeping the subtype name.
+NOUN_LIMITS = {'calls': 500, 'tokens': 2000000, 'seconds': 60 * 60}
+LOOP_LIMITS = {'rounds': 5, 'tokens': 200000, 'seconds': 60 * 20}
+# Retry loops with other limits; the loops around the whole noun are bounded by NOUN_LIMITS otherwise
+LOOP_LIMITS_BY_NAME = {
+    'type_parts': {'rounds': 3, 'tokens': None, 'seconds': None},
+    'part_material_match': {'rounds': 3, 'tokens': None, 'seconds': None},
+    'find_subtypes': {'rounds': 3, 'tokens': None, 'seconds': None},
+    'find_subsubtypes': {'rounds': 3, 'tokens': None, 'seconds': None},
+}
+
+_BUDGETS = contextvars.ContextVar('budgets', default=())
+
+
+class BudgetExhausted(Exception):
+    # The noun can't be finished within its budget: it is over its limits (raised before the next request),
+    # or a retry loop without a fallback outcome was stopped
+    pass
+
+
+class Budget:
+    # Counts the requests (calls and tokens) made within ``spend`` and the wall time since it was created;
+    # a retry loop also counts its rounds, i.e., how many times it asked.
+    def __init__(self, name, limits, noun=False):
+        self.name = name
+        self.limits = limits
+        self.noun = noun
+        self.scope = current_scope()
+        self.calls = 0
+        self.tokens = 0
+        self.rounds = 0
+        self.started = time.time()
+        self.reason = ''  # the first limit reached
+        self.lock = threading.Lock()
+
+    def charge(self, record):
+        # ``record`` is the telemetry record of a finished request; cached responses cost no tokens
+        with self.lock:
+            self.calls += 1
+            self.tokens += record['prompt_tokens'] + record['completion_tokens']
+
+    def exceeded(self):
+        # The first limit reached, e.g., "tokens 200311/200000", or '' within the limits
+        usage = {'calls': self.calls, 'tokens': self.tokens, 'rounds': self.rounds,
+                 'seconds': time.time() - self.started}
+        for field, limit in self.limits.items():
+            if limit is not None and usage[field] >= limit:
+                return f"{field} {usage[field]:.0f}/{limit}"
+        return ''
+
+    def next_round(self):
+        # For ``while <the response fails a check> and budget.next_round():``;
+        # False once a limit is reached, which is reported to ``BUDGET_LOG`` once
+        reason = self.reason or self.exceeded()
+        if reason:
+            if not self.reason:
+                self.reason = reason
+                BUDGET_LOG.stop(self)
+            return False
+        self.rounds += 1
+        return True
+
+
+class BudgetLog:
+    # One event per retry loop stopped by its limits and per noun skipped,
+    # either over its own limits or because a retry loop without a fallback was stopped
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = list()
+
+    def stop(self, budget):
+        with self.lock:
+            self.events.append({'scope': budget.scope, 'budget': budget.name, 'skipped': False,
+                                'reason': budget.reason, 'calls': budget.calls, 'tokens': budget.tokens,
+                                'rounds': budget.rounds, 'seconds': round(time.time() - budget.started, 3)})
+
+    def skip(self, noun, error):
+        with self.lock:
+            self.events.append({'scope': noun, 'budget': noun, 'skipped': True, 'reason': str(error)})
+
+    def clear(self):
+        with self.lock:
+            self.events = list()
+
+    def export(self, path):
+        # One JSON line per event
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with self.lock:
+            events = list(self.events)
+        with open(path, 'w', encoding='utf-8') as f:
+            for event in events:
+                f.write(json.dumps(event) + '\n')
+        return len(events)
+
+    def summary(self):
+        with self.lock:
+            events = list(self.events)
+        if not events:
+            return "Budgets: no limit reached."
+        loops = dict()
+        for event in events:
+            if not event['skipped']:
+                loops[event['budget']] = loops.get(event['budget'], 0) + 1
+        nouns = [event['budget'] for event in events if event['skipped']]
+        return (f"Budgets: {sum(loops.values())} retry loops stopped"
+                + (" (" + ", ".join(f"{name} {count}" for name, count in sorted(loops.items())) + ")" if loops else "")
+                + f", {len(nouns)} nouns skipped" + (": " + ", ".join(nouns) if nouns else "") + ".")
+
+
+BUDGET_LOG = BudgetLog()
+
+
+@contextmanager
+def spend(budget):
+    # The requests made within are charged to ``budget`` and to the budgets around it
+    token = _BUDGETS.set(_BUDGETS.get() + (budget,))
+    try:
+        yield budget
+    finally:
+        _BUDGETS.reset(token)
+
+
+def noun_budget(noun):
+    return spend(Budget(noun, NOUN_LIMITS, noun=True))
+
+
+def loop_budget(name):
+    return spend(Budget(name, {**LOOP_LIMITS, **LOOP_LIMITS_BY_NAME.get(name, dict())}))
+
+
+def current_budgets():
+    return _BUDGETS.get()
+
+
+def check_budgets(budgets):
+    # Called before every request; raises ``BudgetExhausted`` if the noun is over its limits,
+    # so the script skips the noun and reports it with ``BUDGET_LOG.skip``
+    for budget in budgets:
+        if budget.noun:
+            reason = budget.reason or budget.exceeded()
+            if reason:
+                budget.reason = reason
+                raise BudgetExhausted(f"over the noun's limits, {reason}")
@@ -0,0 +1,243 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+import contextvars
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_MODES = {'bypass', 'read-through', 'replay', 'plan'}
+EVICT_EVERY = 1000  # number of stored responses between evictions
+
+_CACHE_SCOPE = contextvars.ContextVar('cache_scope', default='')
+
+
+class CacheMiss(Exception):
+    pass
+
+
+class PendingRequest(CacheMiss):
+    # Raised in "plan" mode after the missing request was written to the batch file
+    pass
+
+
+@contextmanager
+def cache_scope(name):
+    # Requests made within the scope (e.g., one noun) count their repeated prompts separately,
+    # so a re-run replays the same sequence of samples no matter how the nouns are scheduled.
+    token = _CACHE_SCOPE.set(name)
+    try:
+        yield
+    finally:
+        _CACHE_SCOPE.reset(token)
+
+
+def current_scope():
+    return _CACHE_SCOPE.get()
+
+
+class ResponseCache:
+    # Content-addressed on-disk cache of model responses.
+    # The key is a hash of the model, messages, max_tokens and sampling parameters,
+    # plus how many times the same request was already made in the current scope;
+    # the prompts are sampled, so asking again in a retry loop should get a new sample,
+    # while a re-run gets the same samples back in the same order.
+    #
+    # Modes:
+    # - "read-through": return the cached response, or request and store it on a miss
+    # - "replay": only return cached responses; a miss raises ``CacheMiss``
+    # - "bypass": always request and never store
+    # - "plan": like "replay", but a miss is also written to a batch file (see ``plan``)
+    def __init__(self, path, mode='read-through', max_entries=None, max_bytes=None, max_age=None):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"`mode` must be one of {sorted(CACHE_MODES)}.")
+        self.path = path
+        self.mode = mode
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age  # in seconds
+        self.lock = threading.Lock()
+        self.occurrences = dict()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self.batch_file = None
+        self.pending = set()
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                                "(key TEXT PRIMARY KEY, response TEXT, size INTEGER, created REAL, last_used REAL)")
+        self.evict()
+
+    def key(self, model, message_list, max_tokens, params):
+        request = json.dumps({'model': model, 'messages': message_list,
+                              'max_tokens': max_tokens, 'params': params}, sort_keys=True)
+        request_hash = hashlib.sha256(request.encode('utf-8')).hexdigest()
+        with self.lock:
+            occurrence = self.occurrences.get((current_scope(), request_hash), 0)
+            self.occurrences[(current_scope(), request_hash)] = occurrence + 1
+        return f'{request_hash}-{occurrence}'
+
+    def plan(self, batch_file):
+        # Instead of sending the requests without cached responses, write them to ``batch_file``
+        # in the Batch API format; their results are stored back with ``batch.ingest_results``.
+        if os.path.dirname(batch_file) and not os.path.exists(os.path.dirname(batch_file)):
+            os.makedirs(os.path.dirname(batch_file))
+        self.mode = 'plan'
+        self.batch_file = batch_file
+        self.pending = set()
+        with open(batch_file, 'w', encoding='utf-8'):
+            pass
+
+    def get(self, key, request=None):
+        if self.mode == 'bypass':
+            return None
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+            else:
+                self.stats['hits'] += 1
+                self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        if row is None:
+            if self.mode == 'replay':
+                raise CacheMiss(key)
+            if self.mode == 'plan':
+                self.add_pending(key, request)
+                raise PendingRequest(key)
+            return None
+        return json.loads(row[0])
+
+    def add_pending(self, key, request):
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+            with open(self.batch_file, 'a', encoding='utf-8') as f:
+                f.write(json.dumps({'custom_id': key, 'method': 'POST',
+                                    'url': '/v1/chat/completions', 'body': request}) + '\n')
+
+    def put(self, key, response):
+        if self.mode != 'read-through':
+            return
+        self.store(key, response)
+
+    def store(self, key, response):
+        # Write the response whatever the mode is, e.g., when ingesting batch results
+        value = json.dumps(response)
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                                    (key, value, len(value), now, now))
+            self.stats['stores'] += 1
+            evict = self.stats['stores'] % EVICT_EVERY == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        # Drop expired responses first, then the least recently used ones beyond the size limits
+        with self.lock:
+            before = self.connection.total_changes
+            if self.max_age is not None:
+                self.connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age,))
+            if self.max_entries is not None:
+                self.connection.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                                        "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+            if self.max_bytes is not None:
+                self.connection.execute("DELETE FROM responses WHERE key IN (SELECT key FROM "
+                                        "(SELECT key, SUM(size) OVER (ORDER BY last_used DESC) AS total "
+                                        "FROM responses) WHERE total > ?)", (self.max_bytes,))
+            self.stats['evictions'] += self.connection.total_changes - before
+
+    def summary(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / lookups if lookups else 0.0
+        return (f"Cache ({self.mode}): {self.stats['hits']} hits, {self.stats['misses']} misses "
+                f"({hit_rate:.1%} hit rate), {self.stats['stores']} stored, {self.stats['evictions']} evicted")
+
+
+class VerdictMemo:
+    # Remembers the answers of ``confirm_subtype`` and ``rename_subtype`` across nouns and retries,
+    # keyed on the normalized (subtype, supertype) pair, so that the same pair is only asked about once.
+    # At most ``max_entries`` verdicts are kept, dropping the least recently used ones;
+    # with ``path``, they are loaded from and saved to a JSON file to be reused by later runs.
+    # A verdict is "keep" (the subtype name is appropriate), "remove" or "rename" with the new name.
+    def __init__(self, path=None, max_entries=10000):
+        if max_entries < 1:
+            raise ValueError("`max_entries` must be a positive integer.")
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'saved_questions': 0}
+        if path is not None and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for kind, subtype, supertype, verdict, name in json.load(f):
+                    self.entries[(kind, subtype, supertype)] = (verdict, name)
+            self.evict()
+
+    @staticmethod
+    def key(kind, subtype, supertype):
+        return kind, ' '.join(subtype.lower().split()), ' '.join(supertype.lower().split())
+
+    def get(self, kind, subtype, supertype):
+        # Returns (verdict, name) or None.
+        # A hit saves one question, or two for a confirmation that was followed by renaming.
+        key = self.key(kind, subtype, supertype)
+        with self.lock:
+            if key not in self.entries:
+                self.stats['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats['hits'] += 1
+            self.stats['saved_questions'] += 2 if kind == 'confirm' and self.entries[key][0] == 'rename' else 1
+            return self.entries[key]
+
+    def name(self, kind, subtype, supertype):
+        # The remembered answer as ``confirm_subtype`` returns it, or None if there is none
+        entry = self.get(kind, subtype, supertype)
+        if entry is None:
+            return None
+        verdict, name = entry
+        return {'keep': subtype, 'remove': '', 'rename': name}[verdict]
+
+    def put(self, kind, subtype, supertype, verdict, name=''):
+        with self.lock:
+            self.entries[self.key(kind, subtype, supertype)] = (verdict, name)
+            self.entries.move_to_end(self.key(kind, subtype, supertype))
+            self.stats['stores'] += 1
+        self.evict()
+
+    def forget(self, subtype, supertype):
+        # Drop the verdicts of a pair, e.g., when its new name clashes with another subtype,
+        # so that the pair is asked about again when the types are listed again
+        with self.lock:
+            for kind in ['confirm', 'rename']:
+                self.entries.pop(self.key(kind, subtype, supertype), None)
+
+    def evict(self):
+        with self.lock:
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def save(self):
+        if self.path is None:
+            return
+        if os.path.dirname(self.path) and not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with self.lock:
+            entries = [[*key, *value] for key, value in self.entries.items()]
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(self.path + '.tmp', self.path)
+
+    def summary(self):
+        lookups = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / lookups if lookups else 0.0
+        return (f"Verdict memo: {self.stats['hits']} hits, {self.stats['misses']} misses ({hit_rate:.1%} hit rate), "
+                f"{self.stats['saved_questions']} per-subtype questions saved, {len(self.entries)} kept, "
+                f"{self.stats['evictions']} evicted")
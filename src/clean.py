@@ -0,0 +1,72 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import os
+import time
+import pandas as pd
+
+# Re-run the cleaning stage of fewshot.py or zeroshot.py on an intermediate result file,
+# e.g., after a parser fix, without asking the model again.
+# Every row is cleaned independently, so the file is split into chunks of rows
+# that are cleaned in worker processes and concatenated again in the original order.
+
+CHUNK_ROWS = 500  # rows per task sent to a worker process
+SCRIPTS = {'few', 'zero'}
+
+
+def cleaning_function(script):
+    # The modules are imported here so that only the cleaned script's dependencies are loaded
+    if script == 'few':
+        import fewshot
+        col_names = ['item', 'subtype', 'subsubtype', 'optionality', 'response']
+        return partial(fewshot.clean_parts_materials, col_names=col_names), fewshot.RESULT_FILE, fewshot.CLEAN_RESULT_FILE
+    if script == 'zero':
+        import zeroshot
+        return zeroshot.clean_response_format, zeroshot.RESULT_FILE, zeroshot.CLEAN_RESULT_FILE
+    raise ValueError(f"`script` must be one of {sorted(SCRIPTS)}.")
+
+
+def split_rows(raw_df, chunk_rows):
+    return [raw_df.iloc[start:start + chunk_rows] for start in range(0, len(raw_df), chunk_rows)]
+
+
+def clean_in_chunks(raw_df, clean_func, workers=None, chunk_rows=CHUNK_ROWS):
+    # Clean ``raw_df`` with ``clean_func`` in ``workers`` processes (default: all cores);
+    # ``map`` returns the chunks in order, so the output is the same as cleaning in one pass
+    if chunk_rows < 1:
+        raise ValueError("Please specify a positive number of rows per chunk.")
+    workers = workers or os.cpu_count()
+    if workers == 1 or len(raw_df) <= chunk_rows:
+        return clean_func(raw_df)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        clean_dfs = list(executor.map(clean_func, split_rows(raw_df, chunk_rows)))
+    return pd.concat(clean_dfs, axis=0, ignore_index=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Clean an intermediate result file with several processes')
+    parser.add_argument('script', choices=sorted(SCRIPTS), help='the script that wrote the intermediate file')
+    parser.add_argument('--input', default=None, help='intermediate result file (default: RESULT_FILE of the script)')
+    parser.add_argument('--output', default=None,
+                        help='cleaned result file (default: CLEAN_RESULT_FILE of the script)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help='rows per chunk')
+    args = parser.parse_args()
+    if args.workers is not None and args.workers < 1:
+        raise ValueError("Please specify a positive number of workers.")
+
+    clean_func, result_file, clean_result_file = cleaning_function(args.script)
+    input_file = args.input or result_file
+    output_file = args.output or clean_result_file
+    start = time.time()
+    raw_df = pd.read_csv(input_file, sep='\t', encoding='utf-8', dtype=str, keep_default_na=False)
+    clean_df = clean_in_chunks(raw_df, clean_func, args.workers, args.chunk_rows)
+    if os.path.dirname(output_file) and not os.path.exists(os.path.dirname(output_file)):
+        os.makedirs(os.path.dirname(output_file))
+    clean_df.to_csv(output_file, sep='\t', index=False, encoding='utf-8')
+    print(f"Cleaned {len(raw_df)} rows of {input_file} in {time.time() - start:.1f}s; "
+          f"results written to {output_file}")
+
+
+if __name__ == "__main__":
+    main()
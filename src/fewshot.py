@@ -1,10 +1,19 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import repeat
 import os
 from openai import OpenAI
-import pandas as pd
 from pathlib import Path
 import re
 import copy
+from batch import ingest_results, plan_summary
+from budget import BUDGET_LOG, BudgetExhausted, loop_budget, noun_budget
+from cache import PendingRequest, cache_scope
+from clean import clean_in_chunks
 from prompt import *
+from results import ResultWriter
+from telemetry import call_site
 
 if Path('nouns/nounlist.txt').exists():
     # custom noun list
@@ -19,10 +28,24 @@ if not Path(RESULT_FOLDER).exists():
 LOG_FILE = RESULT_FOLDER+'log/few_log.txt'
 RESULT_FILE = RESULT_FOLDER+'csv/few_interm_result.csv'
 CLEAN_RESULT_FILE = RESULT_FOLDER+'csv/few_result.csv'
+CACHE_FILE = RESULT_FOLDER+'cache/few_cache.sqlite'
+VERDICT_FILE = RESULT_FOLDER+'cache/few_verdicts.json'  # subtype confirmations; None for one run only
+METRICS_FILE = RESULT_FOLDER+'log/few_metrics.jsonl'  # one line per request; ".csv" for CSV
+BUDGET_FILE = RESULT_FOLDER+'log/few_budget.jsonl'  # nouns skipped and retry loops stopped by their limits
+# caps of max_tokens per call site, written by ``python3 src/telemetry.py METRICS_FILE --suggest-max-tokens``
+MAX_TOKENS_FILE = RESULT_FOLDER+'log/few_max_tokens.json'
+CACHE_MODE = 'read-through'  # 'read-through', 'replay' or 'bypass'
 MAX_TOKENS = 1024
+# Responses sampled at once for the subtypes and parts; the first one passing the format and part checks is kept,
+# so a badly formatted response costs no extra round trip. 1 asks for one response at a time.
+PART_CANDIDATES = 1
+# Where a response to PART_PROMPT stops: the next example and the notes, which ``strip_part_response`` drops anyway
+PART_STOP = ["Entity 7:", "\nNote: ", "- Note: "]
 MODEL = "gpt-4-1106-preview"
 OPENAI_API_KEY = '[API_KEY]'
-CLIENT = OpenAI(api_key=OPENAI_API_KEY)
+# e.g., "http://127.0.0.1:8000/v1" for the mock server in src/mockserver.py; None for the OpenAI API
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL')
+CLIENT = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
 
 PART_PROMPT = """Please list common categories and their sub-categories, and their constituent parts of the given entity. Each type must be distinguished solely by the unique presence of their essential parts or components. Only list essential parts, not in their variations in shape, size, material, or function. Please do not count chemical substances such as electrolyte as essential parts.
 
@@ -122,54 +145,82 @@ def prompt_response(message, max_tokens, model, client=CLIENT):
     return receive_response(message, max_tokens, model, client)
 
 
+def prompt_samples(message, max_tokens, model, n, client=CLIENT, stop=None):
+    return sample_responses(message, max_tokens, model, client, n, stop=stop)
+
+
 def ask_type_parts(noun, max_tokens=MAX_TOKENS, model=MODEL,
                    prompt=PART_PROMPT, second_prompt=SECOND_PART_PROMPT, client=CLIENT):
     part_dict = dict()
-    while len(part_dict) == 0:
-        part_response = ensure_part_format(noun, max_tokens, model)
-        if 'No distinct subtypes' in part_response:
-            # Ask about subtypes and parts again to ensure the answer
+    with loop_budget('type_parts') as budget:
+        while len(part_dict) == 0 and budget.next_round():
             part_response = ensure_part_format(noun, max_tokens, model)
-        part_response = ensure_part_semantics(noun, part_response, prompt, second_prompt, max_tokens, model)
-        part_dict, renamed_type_trace, excluded_type_trace = extract_types(noun, part_response, max_tokens, model, client)
+            if 'No distinct subtypes' in part_response:
+                # Ask about subtypes and parts again to ensure the answer
+                part_response = ensure_part_format(noun, max_tokens, model)
+            part_response = ensure_part_semantics(noun, part_response, prompt, second_prompt, max_tokens, model)
+            part_dict, renamed_type_trace, excluded_type_trace = extract_types(noun, part_response, max_tokens, model, client)
+    if len(part_dict) == 0:
+        raise BudgetExhausted("no types found within the type_parts loop's budget")
 
     return part_dict, part_response, renamed_type_trace, excluded_type_trace
 
 
+@call_site('ensure_part_format')
 def ensure_part_format(noun, max_tokens, model):
     prompt = PART_PROMPT.replace("{noun}", noun)
 
-    response = prompt_response(prompt, max_tokens, model)
-    response = \
-        response.split("Subtypes:", 1)[-1].split("Subtypes 6:", 1)[
-            -1].split("Entity: ", 1)[-1].split("Entity 6: ", 1)[
-            -1].split("Entity 7:", 1)[0].split("\nNote: ", 1)[0].split("- Note: ", 1)[0].strip()
-
-    while has_subsubsubtypes(response) or has_wrong_format(response):
-        response = prompt_response(prompt, max_tokens, model)
-        response = \
-            response.split("Subtypes:", 1)[-1].split("Subtypes 6:", 1)[
-                -1].split("Entity: ", 1)[-1].split("Entity 6: ", 1)[
-                -1].split("Entity 7:", 1)[0].split("\nNote: ", 1)[0].split("- Note: ", 1)[0].strip()
+    response = None
+    with loop_budget('part_format') as budget:
+        while response is None and budget.next_round():
+            response = pick_part_response(ask_part_candidates(prompt, max_tokens, model))
+    if response is None:
+        raise BudgetExhausted("no response in the right format within the part_format loop's budget")
 
     return response
 
 
+def strip_part_response(response):
+    # keep the subtypes and parts of the response only
+    return response.split("Subtypes:", 1)[-1].split("Subtypes 6:", 1)[
+        -1].split("Entity: ", 1)[-1].split("Entity 6: ", 1)[
+        -1].split("Entity 7:", 1)[0].split("\nNote: ", 1)[0].split("- Note: ", 1)[0].strip()
+
+
+def ask_part_candidates(message, max_tokens, model):
+    return [strip_part_response(response)
+            for response in prompt_samples(message, max_tokens, model, PART_CANDIDATES, stop=PART_STOP)]
+
+
+def pick_part_response(candidates):
+    # The first candidate in the right format without repeated or wrong parts,
+    # else the first one in the right format, which ``ensure_part_semantics`` asks about again;
+    # None if no candidate has the right format
+    formatted = [candidate for candidate in candidates
+                 if not (has_subsubsubtypes(candidate) or has_wrong_format(candidate))]
+    for candidate in formatted:
+        if not (get_repeated_parts(candidate) or get_wrong_parts(candidate)):
+            return candidate
+    return formatted[0] if formatted else None
+
+
 def ensure_part_semantics(noun, part_response, prompt, second_prompt, max_tokens, model):
     repeated_parts = get_repeated_parts(part_response)
     wrong_parts = get_wrong_parts(part_response)
-    while repeated_parts or wrong_parts:
-        # 1) Repeated parts: at least two types share the same parts in the response
-        # 2) Mechanism parts: a part name ends with 'mechanism' or 'system', except 'internal mechanism'
-        # 3) Additional parts: a part name contains 'additional' or 'various'
-        # 4) Long parts: a part name appears to be too long
-        # In these cases, we confirm the validity of the response by asking an additional question.
-        for problem_prompt in [repeated_parts, wrong_parts]:
-            if problem_prompt:
-                part_response = ask_parts_again(noun, part_response, problem_prompt,
-                                                prompt, second_prompt, max_tokens, model)
-        repeated_parts = get_repeated_parts(part_response)
-        wrong_parts = get_wrong_parts(part_response)
+    # out of budget, the last response is kept as it is
+    with loop_budget('part_semantics') as budget:
+        while (repeated_parts or wrong_parts) and budget.next_round():
+            # 1) Repeated parts: at least two types share the same parts in the response
+            # 2) Mechanism parts: a part name ends with 'mechanism' or 'system', except 'internal mechanism'
+            # 3) Additional parts: a part name contains 'additional' or 'various'
+            # 4) Long parts: a part name appears to be too long
+            # In these cases, we confirm the validity of the response by asking an additional question.
+            for problem_prompt in [repeated_parts, wrong_parts]:
+                if problem_prompt:
+                    part_response = ask_parts_again(noun, part_response, problem_prompt,
+                                                    prompt, second_prompt, max_tokens, model)
+            repeated_parts = get_repeated_parts(part_response)
+            wrong_parts = get_wrong_parts(part_response)
 
     return part_response
 
@@ -221,6 +272,7 @@ def get_wrong_parts(response):
     return ''
 
 
+@call_site('ask_parts_again')
 def ask_parts_again(noun, prev_response, problem_prompt, prompt, second_prompt, max_tokens, model):
     # Ask subtypes and parts again by pointing out a problem in the previous response;
     # e.g., repeated parts, parts including "mechanism" or "system", or long parts.
@@ -229,18 +281,13 @@ def ask_parts_again(noun, prev_response, problem_prompt, prompt, second_prompt,
                     {"role": "assistant", "content": prev_response},
                     {"role": "user", "content": part_check_prompt}]
 
-    response = prompt_response(message_list, max_tokens, model)
-    response = \
-        response.split("Subtypes:", 1)[-1].split("Subtypes 6:", 1)[
-            -1].split("Entity: ", 1)[-1].split("Entity 6: ", 1)[
-            -1].split("Entity 7:", 1)[0].split("\nNote: ", 1)[0].split("- Note: ", 1)[0].strip()
-
-    while has_subsubsubtypes(response) or has_wrong_format(response):
-        response = prompt_response(message_list, max_tokens, model)
-        response = \
-            response.split("Subtypes:", 1)[-1].split("Subtypes 6:", 1)[
-                -1].split("Entity: ", 1)[-1].split("Entity 6: ", 1)[
-                -1].split("Entity 7:", 1)[0].split("\nNote: ", 1)[0].split("- Note: ", 1)[0].strip()
+    response = None
+    with loop_budget('part_format') as budget:
+        while response is None and budget.next_round():
+            response = pick_part_response(ask_part_candidates(message_list, max_tokens, model))
+    if response is None:
+        # out of budget; the previous response is in the right format
+        return prev_response
 
     return response
 
@@ -302,14 +349,18 @@ def extract_types(noun, response, max_tokens, model, client):
         confirmed_part_dict = dict()
         renamed_type_trace = ""
         excluded_type_trace = ""
+        # all subtypes of the noun are confirmed with one question, and so are the subsubtypes of each subtype
+        subtype_names = confirm_subtypes([subtype for subtype in part_dict.keys() if '(optional)' not in subtype],
+                                         noun, 512, 128, model, client)
         for subtype, subpart_dict in part_dict.items():
             if '(optional)' in subtype:
                 continue
-            new_subtype = confirm_subtype(subtype, noun, 512, 128, model, client)
+            new_subtype = subtype_names[subtype]
             if new_subtype:
                 if new_subtype.lower() in [lower_type.lower() for lower_type in confirmed_part_dict.keys()] +\
                         [re.sub(r' \([^)]*\)$', '', lower_type.lower()) for lower_type in confirmed_part_dict.keys()]:
                     # If the new name for the subtype already exists as another subtype, find subtypes again.
+                    forget_verdict(subtype, noun)
                     return dict(), "", ""
                 if new_subtype.lower() == re.sub(r' \([^)]*\)$', '', noun.lower()) or\
                         new_subtype.lower() in [subsubtype.lower() for subsubtype in subpart_dict.keys()] +\
@@ -330,13 +381,17 @@ def extract_types(noun, response, max_tokens, model, client):
                         new_subtype = re.sub(r' \([^)]*\)$', '', new_subtype.strip("."))
 
                 confirmed_part_dict[new_subtype] = dict()
+                subsubtype_names = confirm_subtypes([subsubtype for subsubtype in subpart_dict.keys()
+                                                     if '(optional)' not in subsubtype],
+                                                    new_subtype, 512, 128, model, client)
                 for subsubtype, parts in subpart_dict.items():
                     if '(optional)' in subsubtype:
                         continue
-                    new_subsubtype = confirm_subtype(subsubtype, new_subtype, 512, 128, model, client)
+                    new_subsubtype = subsubtype_names[subsubtype]
                     if new_subsubtype:
                         if new_subsubtype.lower() in [lower_type.lower() for lower_type in confirmed_part_dict[new_subtype].keys()]:
                             # If the new name for the subsubtype already exists as another subsubtype, find subsubtypes again.
+                            forget_verdict(subsubtype, new_subtype)
                             return dict(), "", ""
                         if new_subsubtype.lower() == new_subtype.lower() or \
                                 new_subsubtype.lower() == re.sub(r' \([^)]*\)$', '', noun.lower()):
@@ -359,6 +414,8 @@ def extract_types(noun, response, max_tokens, model, client):
                     # when a subtype exists with no valid subsubtypes,
                     # but the part information we have is about subsubtypes,
                     # we need to re-extract subsubtypes, so we run the whole type/part prompt again
+                    for subsubtype in subpart_dict.keys():
+                        forget_verdict(subsubtype, new_subtype)
                     return dict(), "", ""
             else:
                 excluded_type_trace += f"{subtype} is removed from the subtypes of {noun}.\n"
@@ -366,7 +423,8 @@ def extract_types(noun, response, max_tokens, model, client):
         return confirmed_part_dict, renamed_type_trace, excluded_type_trace
 
 
-def ask_materials(noun, part_dict, result_df, col_names, max_tokens=MAX_TOKENS, model=MODEL, prompt=MATERIAL_PROMPT):
+@call_site('ask_materials')
+def ask_materials(noun, part_dict, result_rows, max_tokens=MAX_TOKENS, model=MODEL, prompt=MATERIAL_PROMPT):
     simple_noun = noun.split(" (", 1)[0]
     if " (" in noun:
         category = " (" + noun.split(" (")[-1]
@@ -424,23 +482,27 @@ def ask_materials(noun, part_dict, result_df, col_names, max_tokens=MAX_TOKENS,
                 # and compare the numbers to the part count under materials, so that
                 # e.g., when a part name is "valves or keys" and under materials,
                 # each of "vales" and "keys" gets their own material response, that's fine.
-                return result_df, True
+                return result_rows, True
 
-            result_df = append_rows(result_df, col_names, [noun, subtype, subsubtype, parts_optionality, response])
+            result_rows.append([noun, subtype, subsubtype, parts_optionality, response])
 
-    return result_df, False
+    return result_rows, False
 
 
+@call_site('ensure_material_semantics')
 def ensure_material_semantics(response, prompt, parts_optionality, max_tokens, model):
     if materials_too_long(response) or ('unknown' in response.lower()) or verbose_materials(response):
-        # Prompt the model for the composition materials again
-        response = prompt_response(prompt, max_tokens, model)
-        while verbose_materials(response):
+        # Prompt the model for the composition materials again;
+        # out of budget, a verbose response is kept and simplified when cleaning
+        with loop_budget('verbose_materials') as budget:
             response = prompt_response(prompt, max_tokens, model)
+            while verbose_materials(response) and budget.next_round():
+                response = prompt_response(prompt, max_tokens, model)
         if materials_too_long(response) or 'unknown' in response.lower():
-            response = prompt_response(prompt, max_tokens, model)
-            while verbose_materials(response):
+            with loop_budget('verbose_materials') as budget:
                 response = prompt_response(prompt, max_tokens, model)
+                while verbose_materials(response) and budget.next_round():
+                    response = prompt_response(prompt, max_tokens, model)
             if materials_too_long(response) or 'unknown' in response.lower():
                 # If the third response is suspiciously long as well, then the item is considered as
                 # a dependent component that doesn't have its own materials (e.g., watermark),
@@ -468,7 +530,7 @@ def materials_too_long(response):
 
 
 def clean_parts_materials(raw_df, col_names):
-    clean_df = pd.DataFrame(columns=col_names)
+    clean_rows = RowBuffer(col_names)
     for ind, row in raw_df.iterrows():
         parts_optionality = row['optionality']
         materials = row['response']
@@ -559,42 +621,114 @@ def clean_parts_materials(raw_df, col_names):
 
         # change 'electronics' material to 'electronic materials'
         new_materials = re.sub(r':([^\n]+)electronics', ':\\1electronic materials', materials)
-        clean_df = append_rows(clean_df, col_names,
-                               [row['item'], row['subtype'], row['subsubtype'], parts_optionality, new_materials])
-    return clean_df
+        clean_rows.append([row['item'], row['subtype'], row['subsubtype'], parts_optionality, new_materials])
+    return clean_rows.to_frame()
+
+
+def process_noun(noun, col_names):
+    # Ask about the subtypes, parts and materials of one noun.
+    # Nouns are independent of each other, so this runs in several worker threads at once.
+    with cache_scope(noun), noun_budget(noun), loop_budget('part_material_match') as budget:
+        part_material_unmatch = True
+        while part_material_unmatch and budget.next_round():
+            # Ask about subtypes and parts
+            part_dict, part_response, renamed_type_trace, excluded_type_trace = ask_type_parts(noun)
+            # Ask about materials
+            noun_rows, part_material_unmatch = ask_materials(noun, part_dict, RowBuffer(col_names))
+        if part_material_unmatch:
+            raise BudgetExhausted("parts and materials unmatched within the part_material_match loop's budget")
+
+    # a quick progress log
+    log = f"Noun: {noun}\n"
+    log += part_response.strip() + "\n"
+    if renamed_type_trace:
+        log += "Renamed:\n" + renamed_type_trace
+    if excluded_type_trace:
+        log += "Deleted:\n" + excluded_type_trace
+    log += "\n"
+    return noun_rows, log
+
+
+def try_process_noun(noun, col_names):
+    # In plan mode, a noun stops at its first request without a cached response
+    try:
+        return process_noun(noun, col_names)
+    except PendingRequest:
+        return None
+    except BudgetExhausted as error:
+        # the noun is written without rows, so that the run goes on; see BUDGET_FILE
+        BUDGET_LOG.skip(noun, error)
+        return RowBuffer(col_names), f"Noun: {noun}\nSkipped, out of budget: {error}\n\n"
 
 
 def main():
-    with open(NOUN_FILE, 'r') as f_read:
-        col_names = ['item', 'subtype', 'subsubtype', 'optionality', 'response']
-        result_df = pd.DataFrame(columns=col_names)
-        noun = f_read.readline().strip()
-        while noun:
-            part_material_unmatch = True
-            while part_material_unmatch:
-                # Ask about subtypes and parts
-                part_dict, part_response, renamed_type_trace, excluded_type_trace = ask_type_parts(noun)
-                # Ask about materials
-                temp_result_df, part_material_unmatch = ask_materials(noun, part_dict, result_df, col_names)
-
-            # leave a quick progress log
-            f_write = open(LOG_FILE, 'a')
-            f_write.write(f"Noun: {noun}\n")
-            f_write.write(part_response.strip() + "\n")
-            if renamed_type_trace:
-                f_write.write("Renamed:\n" + renamed_type_trace)
-            if excluded_type_trace:
-                f_write.write("Deleted:\n" + excluded_type_trace)
-            f_write.write("\n")
-            f_write.close()
-
-            result_df = temp_result_df
-            result_df.to_csv(RESULT_FILE, sep='\t', index=False, encoding='utf-8')
-
-            noun = f_read.readline().strip()
-
-        clean_df = clean_parts_materials(result_df, col_names)
-        clean_df.to_csv(CLEAN_RESULT_FILE, sep='\t', index=False, encoding='utf-8')
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1, help='number of nouns processed concurrently')
+    parser.add_argument('--concurrency', type=int, default=None,
+                        help=f'number of requests in flight (default: max({MAX_CONCURRENCY}, workers))')
+    parser.add_argument('--resume', action='store_true',
+                        help=f'skip the nouns already completed in {RESULT_FILE}')
+    parser.add_argument('--plan', metavar='BATCH_FILE', default=None,
+                        help='write the requests without cached responses to a Batch API file instead of sending them')
+    parser.add_argument('--ingest', metavar='RESULTS_FILE', default=None,
+                        help='store the responses of a Batch API results file before planning the next requests')
+    parser.add_argument('--clean-workers', type=int, default=1,
+                        help='number of processes cleaning the intermediate file (0: all cores)')
+    args = parser.parse_args()
+    if args.workers < 1:
+        raise ValueError("Please specify a positive number of workers.")
+    if args.ingest and not args.plan:
+        raise ValueError("Please specify the next batch file with ``--plan`` when ingesting results.")
+    set_concurrency(args.concurrency or max(MAX_CONCURRENCY, args.workers))
+
+    cache = set_response_cache(CACHE_FILE, CACHE_MODE)
+    verdict_memo = set_verdict_memo(VERDICT_FILE)
+    set_max_tokens(MAX_TOKENS_FILE)
+    if args.ingest:
+        ingest_results(args.ingest, cache)
+    if args.plan:
+        cache.plan(args.plan)
+    col_names = ['item', 'subtype', 'subsubtype', 'optionality', 'response']
+    # in plan mode, the nouns completed by earlier waves are kept
+    writer = ResultWriter(RESULT_FILE, col_names, resume=args.resume or bool(args.plan))
+    nouns = [noun for noun in read_nouns(NOUN_FILE) if noun not in writer.completed]
+    unfinished = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        # ``map`` yields the results in the order of the noun list,
+        # so the output files are the same regardless of the number of workers
+        try:
+            for noun, outcome in zip(nouns, executor.map(try_process_noun, nouns, repeat(col_names))):
+                if outcome is None or unfinished:
+                    # the nouns after an unfinished one are written in a later wave to keep the noun order;
+                    # their responses are cached by then
+                    unfinished += 1
+                    continue
+                noun_rows, log = outcome
+                with open(LOG_FILE, 'a') as f_write:
+                    f_write.write(log)
+                writer.write(noun, noun_rows.rows())
+        except BaseException:
+            # a noun failed (or the run was interrupted): the nouns still queued are not started,
+            # since their rows couldn't be written after the failed one anyway
+            executor.shutdown(cancel_futures=True)
+            raise
+
+    verdict_memo.save()
+    TELEMETRY.export(METRICS_FILE)
+    BUDGET_LOG.export(BUDGET_FILE)
+    print(TELEMETRY.summary())
+    print(verdict_memo.summary())
+    print(BUDGET_LOG.summary())
+    if args.plan:
+        print(plan_summary(cache, unfinished))
+        if unfinished:
+            return
+
+    # clean the whole intermediate file in one pass, split over ``--clean-workers`` processes
+    clean_df = clean_in_chunks(writer.read(), partial(clean_parts_materials, col_names=col_names),
+                               args.clean_workers or None)
+    clean_df.to_csv(CLEAN_RESULT_FILE, sep='\t', index=False, encoding='utf-8')
+    print(cache.summary())
 
 
 if __name__ == "__main__":
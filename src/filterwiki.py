@@ -1,4 +1,5 @@
-import pandas as pd
+import pyarrow.parquet as pq
+from wikigraph import load_graph
 from os import listdir
 from os.path import isfile, join
 import wikipedia
@@ -18,6 +19,7 @@ DIRPATH = 'nouns/wiki-all/'
 if not DIRPATH.endswith('/'):
     DIRPATH += '/'
 RESULT_FILE = 'nouns/filtered_wikidata.csv'
+GRAPH_DIR = 'nouns/wiki-graph/'  # the subclass graph of the shards, built by the first run
 
 exclude_keywords = {
     'abstract data type', 'administrative division', 'algebra', 'algebraic geometry', 'alphabet', 'annotation',
@@ -78,6 +80,19 @@ soft_exclude_wiki_under = {
 }
 
 
+# Nouns under these are kept even if they are under the entities in 'soft_exclude_wiki_under'
+soft_exclude_exceptions = {
+    'Q2858615': 'electronic machine',
+    'Q32914898': 'portable object',
+    'Q10273457': 'equipment',
+    'Q1485500': 'tangible good',
+    'Q122853586': 'physical component'
+}
+
+# Flags of the entities under (at any depth) artificial object (Q16686448) and the entities above
+UNDER_ARTIFICIAL, UNDER_HARD_EXCLUDE, UNDER_SOFT_EXCLUDE, UNDER_SOFT_EXCEPTION = 1, 2, 4, 8
+
+
 exclude_headnouns = {'area', 'areas', 'art', 'arts', 'base', 'body', 'business',
                      'capability', 'cemetery', 'city', 'cities', 'community',
                      'establishment', 'facility', 'facilities', 'garden', 'hall', 'housing',
@@ -89,33 +104,20 @@ exclude_headnouns = {'area', 'areas', 'art', 'arts', 'base', 'body', 'business',
                      'venue', 'venues', 'way', 'work', 'workplace'}
 
 
+def shard_files():
+    # The Parquet shards written by ``wikiall.py``
+    return [f for f in listdir(DIRPATH) if isfile(join(DIRPATH, f)) and f.endswith('.parquet')]
+
+
 def wiki_parents():
-    # For each of the Wikidata items, get its parents
-    file_list = [f for f in listdir(DIRPATH) if isfile(join(DIRPATH, f)) and f.endswith('.csv')]
-    superclass_dict = dict()
-
-    for filename in file_list:
-        wiki_df = pd.read_csv(DIRPATH + filename, encoding='utf-8')
-        for index, row in wiki_df.iterrows():
-            if row['parent'] == "[]":
-                superclass_dict[row['id']] = ''
-            else:
-                superclass_dict[row['id']] = list()
-                for parent in row['parent'].replace('[', '').replace(']', '').replace("'", "").split(", "):
-                    superclass_dict[row['id']].append(parent)
-    return superclass_dict
-
-
-def all_ancestors(child, trace, superclass_dict):
-    # Return the ancestors of the given child
-    if (child not in superclass_dict.keys()) or (child in trace):
-        return set()
-    parent_list = superclass_dict[child]
-    if not parent_list:
-        return set()
-    trace.add(child)
-    return set(parent_list + [ancestor for parent in parent_list
-                              for ancestor in all_ancestors(parent, trace, superclass_dict)])
+    # For each of the Wikidata items, get its parents: a memory-mapped ``wikigraph.SubclassGraph``
+    return load_graph(DIRPATH, GRAPH_DIR)
+
+
+def under_roots(superclass_graph):
+    # The UNDER_* flags of every node of the graph, by searching down from the roots once
+    return superclass_graph.descendant_flags([['Q16686448'], hard_exclude_wiki_under.keys(),
+                                              soft_exclude_wiki_under.keys(), soft_exclude_exceptions.keys()])
 
 
 def get_synset_lemma(wn_version):
@@ -249,7 +251,7 @@ def find_head_noun(sent, parser):
         return ""
 
 
-def filter_wikidata(superclass_dict, parser, synset_wn30_set, synset_wn31_set, lemma_wn_set):
+def filter_wikidata(superclass_graph, parser, synset_wn30_set, synset_wn31_set, lemma_wn_set):
     """
     Generates a csv file which includes things under
     'artificial physical object',  'artificial physical structure', or 'artificial entity'
@@ -265,37 +267,36 @@ def filter_wikidata(superclass_dict, parser, synset_wn30_set, synset_wn31_set, l
     filtered_wiki_dict['wordnet'] = list()
     filtered_wiki_dict['synonym'] = list()
 
-    file_list = [f for f in listdir(DIRPATH) if isfile(join(DIRPATH, f)) and f.endswith('.csv')]
+    file_list = shard_files()
+    node_flags = under_roots(superclass_graph)
 
     with open(RESULT_FILE, 'w') as wiki_f:
         writer = csv.writer(wiki_f, delimiter='\t')
         writer.writerow(filtered_wiki_dict.keys())
 
         for filename in tqdm.tqdm(file_list):
-            wiki_df = pd.read_csv(DIRPATH+filename, encoding='utf-8').fillna('')
-
-            for index, row in wiki_df.iterrows():
+            for row in pq.read_table(DIRPATH + filename).to_pylist():
                 # filter out by keywords from their Wikipedia article names or from the hierarchy data
-                if pd.isnull(row['wikipedia']) or \
+                if row['wikipedia'] is None or \
                         any('('+keyword+')' in str(row['wikipedia']) for keyword in exclude_keywords) or \
                         (row['id'] in hard_exclude_wiki_under.keys()) or (row['id'] in soft_exclude_wiki_under.keys()):
                     continue
                 wiki_id = row['id']
                 entry = str(row['label'])
                 wikipedia_title = str(row['wikipedia'])
-                wordnet_link = row['wordnet'].replace("[", "").replace("]", "").replace("'", "")
-                synonyms = row['synonym'].replace("[", "").replace("]", "").replace("'", "")
+                wordnet_link = ", ".join(row['wordnet'])
+                synonyms = ", ".join(row['synonym'])
                 # synonyms help detecting words like bicycle saddle, swim fins, etc.
 
                 # Pick nouns that exist in WordNet
                 if entry in lemma_wn_set or \
                         any(any(synonym_var in lemma_wn_set for synonym_var in
                                 [synonym, synonym.replace(" ", ""), synonym.replace(" ", "-"), synonym.rstrip('\s'),
-                                 synonym.rstrip('\s').rstrip('\e')]) for synonym in synonyms.split(", ")) or \
+                                 synonym.rstrip('\s').rstrip('\e')]) for synonym in row['synonym']) or \
                         any(('wn30/' in link and link.split("/")[-1] in synset_wn30_set) for link in
-                            wordnet_link.split(", ")) or \
+                            row['wordnet']) or \
                         any(('wn30/' not in link and link.split("/")[-1] in synset_wn31_set) for link in
-                            wordnet_link.split(", ")):
+                            row['wordnet']):
 
                     wikipedia_strip = wikipedia_title.split("(")[0].strip()
                     # Filtering out nouns based on their Wikipedia article title would be more accurate
@@ -319,21 +320,17 @@ def filter_wikidata(superclass_dict, parser, synset_wn30_set, synset_wn31_set, l
                         # list to exclude -- mostly for structures/places without parts
                         continue
 
-                    ancestors = set(all_ancestors(wiki_id, set(), superclass_dict))
+                    node = superclass_graph.node(wiki_id)
+                    flags = int(node_flags[node]) if node >= 0 else 0
 
                     # Only interested in nouns under artificial object (Q16686448) with exceptions.
                     # This should cover nouns under artificial physical object (Q8205328),
                     # artificial physical structure (Q11908691), etc.
                     # Exceptions are any nouns under the entities in 'hard_exclude_wiki_under'
-                    # and some of the nouns under the entities in 'soft_exclude_wiki_under', except:
-                    # Q2858615: electronic machine
-                    # Q32914898: portable object
-                    # Q10273457: equipment
-                    # Q1485500: tangible good
-                    # Q122853586: physical component
-                    if ('Q16686448' in ancestors) and not (hard_exclude_wiki_under.keys() & ancestors) and \
-                            (not (soft_exclude_wiki_under.keys() & ancestors) or \
-                             ({'Q2858615', 'Q32914898', 'Q10273457', 'Q1485500', 'Q122853586'} & ancestors)):
+                    # and some of the nouns under the entities in 'soft_exclude_wiki_under',
+                    # except for the nouns under the entities in 'soft_exclude_exceptions'
+                    if (flags & UNDER_ARTIFICIAL) and not (flags & UNDER_HARD_EXCLUDE) and \
+                            (not (flags & UNDER_SOFT_EXCLUDE) or (flags & UNDER_SOFT_EXCEPTION)):
                         try:
                             wikipedia_page = wikipedia.page(wikipedia_title, auto_suggest=False)
                         # except wikipedia.exceptions.PageError:
@@ -381,13 +378,13 @@ def main():
     warnings.filterwarnings("ignore")
 
     print("Preparing reference data...")
-    superclass_dict = wiki_parents()
+    superclass_graph = wiki_parents()
     synset_wn30_set, lemma_wn30_set = get_synset_lemma(wn)
     synset_wn31_set, lemma_wn31_set = get_synset_lemma(wn31)
     parser = benepar.Parser("benepar_en3")
 
     print("Getting filtered entries from Wikidata...")
-    filter_wikidata(superclass_dict, parser, synset_wn30_set, synset_wn31_set, lemma_wn30_set | lemma_wn31_set)
+    filter_wikidata(superclass_graph, parser, synset_wn30_set, synset_wn31_set, lemma_wn30_set | lemma_wn31_set)
 
 
 if __name__ == "__main__":
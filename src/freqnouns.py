@@ -1,16 +1,40 @@
-import openai
-from retry import retry
+import argparse
+from openai import OpenAI
 import pandas as pd
 import re
-import sys
 import os
+from batch import ingest_results, plan_summary
+from budget import BUDGET_LOG, loop_budget
+from cache import PendingRequest
+from prompt import TELEMETRY, receive_response as receive_chat_response, set_response_cache
+from telemetry import call_site
 
 PROMPT_FOLDER = 'nouns/filtering-nouns/'
 if not PROMPT_FOLDER.endswith('/'):
     PROMPT_FOLDER += '/'
 SAVE_FILE = 'nouns/nounlist.txt'
+CACHE_FILE = PROMPT_FOLDER + 'cache/freq_cache.sqlite'
+METRICS_FILE = PROMPT_FOLDER + 'freq_metrics.jsonl'  # one line per request; ".csv" for CSV
+BUDGET_FILE = PROMPT_FOLDER + 'freq_budget.jsonl'  # retry loops stopped by their limits
+CACHE_MODE = 'read-through'  # 'read-through', 'replay' or 'bypass'
+MAX_TOKENS = 1024
+MODEL = "gpt-4-0613"
 
 OPENAI_API_KEY = '[API_KEY]'
+# e.g., "http://127.0.0.1:8000/v1" for the mock server in src/mockserver.py; None for the OpenAI API
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL')
+CLIENT = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
+
+
+def prepare_folder(folder, filename):
+    # The prompt files are appended to and every response file is read by the next stage,
+    # so remove the files of this stage written by an earlier run (e.g., an earlier plan wave);
+    # other files in the folder are kept
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    for old_filename in os.listdir(folder):
+        if old_filename.startswith(filename) and old_filename.endswith('.txt'):
+            os.remove(folder + old_filename)
 
 
 def reformat_last_file(folder, filename, file_number):
@@ -33,8 +57,7 @@ def write_easy_prompts(folder, filename, wiki_df):
     # This function avoids duplicates of Wikipedia articles
     count = 0
     all_nouns = set()
-    if not os.path.exists(folder):
-        os.makedirs(folder)
+    prepare_folder(folder, filename)
 
     # Write prompts to get easy (well-perceived) nouns
     for index, row in wiki_df.iterrows():
@@ -63,8 +86,7 @@ def write_easy_prompts(folder, filename, wiki_df):
 
 def write_phys_prompts(response_folder, prompt_folder, prompt_filename):
     count = 0
-    if not os.path.exists(prompt_folder):
-        os.makedirs(prompt_folder)
+    prepare_folder(prompt_folder, prompt_filename)
 
     # Write prompts to get physical entities
     for response_filename in sorted(os.listdir(response_folder)):
@@ -104,8 +126,7 @@ def write_phys_prompts(response_folder, prompt_folder, prompt_filename):
 
 def write_count_prompts(response_folder, prompt_folder, prompt_filename):
     count = 0
-    if not os.path.exists(prompt_folder):
-        os.makedirs(prompt_folder)
+    prepare_folder(prompt_folder, prompt_filename)
 
     # Write prompts to get countable entities
     for response_filename in sorted(os.listdir(response_folder)):
@@ -139,8 +160,7 @@ def write_indiv_prompts(response_folder, prompt_folder, prompt_filename):
     # as well as non-containment entities as well (e.g., City district, Campsite)
     # and non-tangible entities (e.g., Scenic viewpoint, Tree plantation).
     count = 0
-    if not os.path.exists(prompt_folder):
-        os.makedirs(prompt_folder)
+    prepare_folder(prompt_folder, prompt_filename)
 
     # Write prompts to get individual entities
     for response_filename in sorted(os.listdir(response_folder)):
@@ -172,35 +192,36 @@ def write_indiv_prompts(response_folder, prompt_folder, prompt_filename):
     reformat_last_file(prompt_folder, prompt_filename, file_number)
 
 
-@retry(tries=4)
 def receive_response(prompt):
-    response = openai.ChatCompletion.create(
-        model="gpt-4-0613",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=1,  #default
-        top_p=1,  #default
-        max_tokens=1024
-    )
-    response_message = response["choices"][0]["message"]["content"]
-    return response_message
+    # temperature and top_p are the defaults (1), see ``prompt.SAMPLING_PARAMS``
+    return receive_chat_response(prompt, MAX_TOKENS, MODEL, CLIENT)
 
 
 def write_response(prompt_folder, response_folder, response_filename):
-    if not os.path.exists(response_folder):
-        os.makedirs(response_folder)
+    # Returns the number of prompts without a response, i.e., whose requests are pending in plan mode
+    prepare_folder(response_folder, response_filename)
 
+    pending = 0
     for prompt_filename in sorted(os.listdir(prompt_folder)):
         if prompt_filename.endswith('.txt'):
             file_ending = prompt_filename.rsplit("-", 1)[-1]
             with open(prompt_folder+prompt_filename, 'r') as f_read:
-                with open(response_folder+response_filename+file_ending, 'w') as f_write:
-                    prompt = f_read.read()
-                    prompt_noun_list = prompt.split("\n\n")[-1].split("\n")
-                    response = receive_response(prompt)
-                    # make sure the names of the nouns are not altered
-                    while any(prompt_noun not in response for prompt_noun in prompt_noun_list):
+                prompt = f_read.read()
+            prompt_noun_list = prompt.split("\n\n")[-1].split("\n")
+            try:
+                response = receive_response(prompt)
+                # make sure the names of the nouns are not altered;
+                # out of budget, the last response is kept with the altered names
+                with loop_budget('noun_names') as budget:
+                    while any(prompt_noun not in response for prompt_noun in prompt_noun_list) and\
+                            budget.next_round():
                         response = receive_response(prompt)
-                    f_write.write(response)
+            except PendingRequest:
+                pending += 1
+                continue
+            with open(response_folder+response_filename+file_ending, 'w') as f_write:
+                f_write.write(response)
+    return pending
 
 
 def obtain_noun_list(response_folder, save_file, exclude_list, ending_list):
@@ -227,14 +248,21 @@ def obtain_noun_list(response_folder, save_file, exclude_list, ending_list):
 
 
 def main():
-    # Obtain a csv file with Wikidata entities
-    if len(sys.argv) < 2:
-        raise ValueError("Please specify the Wikidata file. "
-                         "Example: ``python3 src/freqnouns.py nouns/filtered_wikidata.csv``")
-    elif len(sys.argv) > 2:
-        raise ValueError('Too many arguments are given. Please specify the Wikidata file only.')
-
-    openai.api_key = OPENAI_API_KEY
+    parser = argparse.ArgumentParser()
+    parser.add_argument('wiki_file', help='csv file with Wikidata entities, e.g., nouns/filtered_wikidata.csv')
+    parser.add_argument('--plan', metavar='BATCH_FILE', default=None,
+                        help='write the requests without cached responses to a Batch API file instead of sending them')
+    parser.add_argument('--ingest', metavar='RESULTS_FILE', default=None,
+                        help='store the responses of a Batch API results file before planning the next requests')
+    args = parser.parse_args()
+    if args.ingest and not args.plan:
+        raise ValueError("Please specify the next batch file with ``--plan`` when ingesting results.")
+
+    cache = set_response_cache(CACHE_FILE, CACHE_MODE)
+    if args.ingest:
+        ingest_results(args.ingest, cache)
+    if args.plan:
+        cache.plan(args.plan)
     # simple machines and bio/organism-related terms
     non_phys_nouns = ['Lever', 'Wheel and axle', 'Pulley', 'Inclined plane', 'Wedge', 'Screw',
                       'Animal product', 'Unidentified flying object', 'Flying saucer']
@@ -244,34 +272,43 @@ def main():
 
     print("Reading the Wikidata file...")
     # Read the Wikidata file
-    wiki_file = sys.argv[1]
-    wiki_df = pd.read_csv(wiki_file, header=0, sep='\t').fillna('')
+    wiki_df = pd.read_csv(args.wiki_file, header=0, sep='\t').fillna('')
 
     print(f'Started the filtering process. See ``{PROMPT_FOLDER}`` directory to check progress.')
     easy_folder = PROMPT_FOLDER + 'easy-nouns/'
     phys_folder = PROMPT_FOLDER + 'phys-nouns/'
     count_folder = PROMPT_FOLDER + 'count-nouns/'
     indiv_folder = PROMPT_FOLDER + 'indiv-nouns/'
+    stages = [("Processing physical object nouns...", write_phys_prompts, easy_folder, phys_folder, 'phys'),
+              ("Processing count noun objects...", write_count_prompts, phys_folder, count_folder, 'count'),
+              ("Processing individual-entity nouns...", write_indiv_prompts, count_folder, indiv_folder, 'indiv')]
 
     print("Processing well-perceived nouns...")
     write_easy_prompts(easy_folder+'prompt/', 'easy-prompt-', wiki_df)
-    write_response(easy_folder+'prompt/', easy_folder+'response/', 'easy-nouns-')
-
-    print("Processing physical object nouns...")
-    write_phys_prompts(easy_folder+'response/', phys_folder+'prompt/', 'phys-prompt-')
-    write_response(phys_folder+'prompt/', phys_folder+'response/', 'phys-nouns-')
-
-    print("Processing count noun objects...")
-    write_count_prompts(phys_folder + 'response/', count_folder + 'prompt/', 'count-prompt-')
-    write_response(count_folder + 'prompt/', count_folder + 'response/', 'count-nouns-')
-
-    print("Processing individual-entity nouns...")
-    write_indiv_prompts(count_folder + 'response/', indiv_folder + 'prompt/', 'indiv-prompt-')
-    write_response(indiv_folder + 'prompt/', indiv_folder + 'response/', 'indiv-nouns-')
+    with call_site('easy'):
+        pending = write_response(easy_folder+'prompt/', easy_folder+'response/', 'easy-nouns-')
+
+    for message, write_prompts, previous_folder, folder, name in stages:
+        if pending:
+            # each stage needs all the responses of the previous one
+            break
+        print(message)
+        write_prompts(previous_folder + 'response/', folder + 'prompt/', name + '-prompt-')
+        with call_site(name):
+            pending = write_response(folder + 'prompt/', folder + 'response/', name + '-nouns-')
+
+    TELEMETRY.export(METRICS_FILE)
+    BUDGET_LOG.export(BUDGET_FILE)
+    print(TELEMETRY.summary())
+    print(BUDGET_LOG.summary())
+    if args.plan:
+        print(plan_summary(cache, pending))
+        if pending:
+            return
 
     obtain_noun_list(indiv_folder+'response/', SAVE_FILE, non_phys_nouns+general_nouns, group_endings)
     print("Done!")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
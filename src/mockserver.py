@@ -0,0 +1,496 @@
+import argparse
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import math
+import random
+import re
+import threading
+import time
+import pandas as pd
+from ratelimit import estimate_tokens
+
+# A local stand-in for the OpenAI chat completions endpoint, e.g., to benchmark the pipeline's own
+# throughput, retries and rate limiting without spending API credit:
+#   python3 src/mockserver.py --latency lognormal:1.5,0.6 --error-429 0.05
+#   OPENAI_BASE_URL=http://127.0.0.1:8000/v1 python3 src/fewshot.py
+# The answers are built from the results shipped in data/csv, so the scripts parse them as usual.
+
+CANNED_FILE = 'data/csv/few_interm_result.csv'
+HOST = '127.0.0.1'
+PORT = 8000
+# used for nouns that are not in the canned results
+DEFAULT_ENTRY = {'subtypes': [], 'parts': [('body', False), ('handle', False)],
+                 'materials': "1. body: plastic\n2. handle: plastic"}
+MALFORMED_RESPONSES = ["I'm sorry, but I can't answer that.", "", "As an AI language model"]
+# What a model may add after listing the subtypes and parts of a few-shot prompt: a note and a made-up next example
+RUN_ON = ("\nNote: The subtypes above are distinguished by the unique presence of their essential parts, "
+          "not by their shape, size, material or function.\n\n##\nEntity 7: Bicycle\nSubtypes 7:\n"
+          "1. Road bicycle: frame, fork, wheels, handlebar, saddle, pedals, chain, drop handlebar\n"
+          "2. Mountain bicycle: frame, fork, wheels, handlebar, saddle, pedals, chain, suspension fork\n"
+          "3. Tandem bicycle: frame, fork, wheels, handlebars, saddles, pedals, chains, timing chain\n"
+          "4. Electric bicycle: frame, fork, wheels, handlebar, saddle, pedals, chain, battery, electric motor\n"
+          "5. Cargo bicycle: frame, fork, wheels, handlebar, saddle, pedals, chain, cargo box\n##")
+RUN_ON_PATTERN = re.compile(r'Entity 6: (.*)\nSubtypes 6:$')  # the prompts of fewshot.PART_PROMPT
+STREAM_CHUNK = 4  # characters per streamed chunk, about one token
+
+
+def parse_latency(spec):
+    # Returns a function sampling a latency in seconds from a distribution given as
+    # "0.5" or "fixed:0.5", "uniform:LOW,HIGH", "lognormal:MEDIAN,SIGMA" or "exponential:MEAN"
+    name, _, params = spec.partition(':') if ':' in spec else ('fixed', '', spec)
+    try:
+        params = [float(param) for param in params.split(',')]
+    except ValueError:
+        raise ValueError(f"Invalid latency distribution {spec}.")
+    if name == 'fixed' and len(params) == 1:
+        return lambda rng: params[0]
+    if name == 'uniform' and len(params) == 2:
+        return lambda rng: rng.uniform(params[0], params[1])
+    if name == 'lognormal' and len(params) == 2:
+        return lambda rng: rng.lognormvariate(math.log(params[0]), params[1])
+    if name == 'exponential' and len(params) == 1:
+        return lambda rng: rng.expovariate(1 / params[0])
+    raise ValueError(f"Invalid latency distribution {spec}.")
+
+
+def new_entry():
+    return {'subtypes': [], 'parts': [], 'materials': ''}
+
+
+def strip_parentheses(name):
+    return re.sub(r'\([^)]*\)( *)', '', name).strip()
+
+
+def normalize_name(name):
+    name = name.strip().strip('"').strip().lower()
+    return re.sub(r'^(a|an|the) ', '', name)
+
+
+def list_parts(parts):
+    if not parts:
+        return "No distinct parts"
+    return ", ".join(part + (" (optional)" if optional else "") for part, optional in parts)
+
+
+def valid_part(part):
+    # The part names fewshot.get_wrong_parts would ask about again
+    part = part.lower()
+    return not ((part.endswith('mechanism') and part != 'internal mechanism') or part.endswith('system') or
+                'additional' in part or 'various' in part or len(part.split(" ")) > 5)
+
+
+def summarize_materials(materials):
+    # "1. casing: metal or plastic\n2. anode: zinc" -> "metal, plastic, and/or zinc"
+    found = list()
+    for line in materials.split("\n"):
+        for material in re.split(r',\s*|\s+and/or\s+|\s+or\s+|\s+and\s+', line.split(":", 1)[-1].strip()):
+            material = material.strip(' .')
+            if material and material != '-' and material not in found:
+                found.append(material)
+    if not found:
+        return "plastic"
+    if len(found) == 1:
+        return found[0]
+    return ", ".join(found[:-1]) + ", and/or " + found[-1]
+
+
+def part_materials(entry):
+    # Material of each part, taken from the numbered lines of the canned response
+    materials = dict()
+    for line in entry['materials'].split("\n"):
+        if ': ' in line:
+            part, material = line.split(". ", 1)[-1].split(": ", 1)
+            materials[part.strip()] = material.strip()
+    return materials
+
+
+def answer_parts(entry, with_materials):
+    # In the format of zeroshot.py's Questions 7 and 8
+    materials = part_materials(entry)
+    lines = list()
+    for number, (part, optional) in enumerate(entry['parts'] or DEFAULT_ENTRY['parts'], 1):
+        lines.append(f"{number}. {part[0].upper() + part[1:]}: a part of it")
+        lines.append("- Optional: " + ("yes" if optional else "no"))
+        if with_materials:
+            lines.append("- Materials: " + materials.get(part, summarize_materials(entry['materials'])))
+    return "\n".join(lines)
+
+
+def parse_parts(optionality):
+    # "casing: F\nlid: T" -> [('casing', False), ('lid', True)]; no parts for "-" or "-: F"
+    parts = list()
+    if optionality.strip() not in {'-', '-: F'}:
+        for line in optionality.split("\n"):
+            part, _, optional = line.rpartition(": ")
+            parts.append((part, optional == 'T'))
+    return parts
+
+
+class CannedResponses:
+    # Answers to the prompts of fewshot.py, zeroshot.py and freqnouns.py built from a result file
+    def __init__(self, path=CANNED_FILE):
+        self.nouns = dict()  # noun -> {subtype: {subsubtype: parts}}, in the order of the file
+        self.items = dict()  # normalized noun -> {'subtypes', 'parts', 'materials'}
+        self.types = dict()  # normalized subtype or subsubtype -> the same, the first one found
+        result_df = pd.read_csv(path, sep='\t', encoding='utf-8', dtype=str, keep_default_na=False)
+        for noun, subtype, subsubtype, optionality, materials in result_df.itertuples(index=False):
+            parts = parse_parts(optionality)
+            self.nouns.setdefault(noun, dict()).setdefault(subtype, dict())[subsubtype] = parts
+
+            category = " (" + noun.split(" (")[-1] if " (" in noun else ""
+            entry = {'subtypes': [], 'parts': parts, 'materials': materials if materials != '-' else 'unknown'}
+            if subtype == '-':
+                self.items[normalize_name(noun)] = entry
+                continue
+            supertype_entries = [self.items.setdefault(normalize_name(noun), new_entry())]
+            if subsubtype == '-':
+                type_names = [subtype]
+            else:
+                supertype_entries.append(self.types.setdefault(normalize_name(strip_parentheses(subtype)), new_entry()))
+                type_names = [subsubtype]
+            for supertype_entry, name in zip(supertype_entries, [subtype, subsubtype]):
+                if name not in supertype_entry['subtypes']:
+                    supertype_entry['subtypes'].append(name)
+                    supertype_entry['materials'] += ("\n" if supertype_entry['materials'] else "") + entry['materials']
+            for name in type_names:
+                self.types.setdefault(normalize_name(strip_parentheses(name) + category), entry)
+                self.types.setdefault(normalize_name(strip_parentheses(name)), entry)
+
+    def lookup(self, name):
+        name = normalize_name(name)
+        for candidate in [name, strip_parentheses(name), name.rstrip('s')]:
+            for items in [self.items, self.types]:
+                if candidate in items:
+                    return items[candidate]
+        return DEFAULT_ENTRY
+
+    def answer(self, message_list):
+        question = message_list[-1]['content']
+
+        # fewshot.py
+        match = re.search(r'Entity 6: (.*)\nSubtypes 6:$', question)
+        if match:
+            return self.answer_types(match.group(1))
+        match = re.search(r'Entity 6: (.*)\nParts: (.*)\nMaterials:$', question)
+        if match:
+            return self.answer_materials(self.lookup(match.group(1)), match.group(2))
+
+        # prompt.py
+        if question.startswith('For each numbered term below, choose the most accurate response'):
+            terms = question.split("\n\n")[-1].split("\n")
+            return "\n".join(f"{number}. 1)" for number in range(1, len(terms) + 1))
+        if question.startswith('Choose the most accurate response from below.'):
+            return '1) "' + re.search(r'"(.*?)"', question).group(1) + '" is an appropriate name.'
+        if question.endswith('Write the best answer with quotation marks.'):
+            return '"' + re.search(r'"(.*?)"', question).group(1) + '"'
+
+        # zeroshot.py
+        match = re.search(r'present in one type of (.*) but absent', question)
+        if match:
+            return 'yes' if self.lookup(match.group(1))['subtypes'] else 'no'
+        match = re.search(r'list physically distinct types of (.*), where each type', question)
+        if match:
+            subtypes = self.lookup(match.group(1))['subtypes']
+            return "\n".join(f"{number}. {subtype}" for number, subtype in enumerate(subtypes, 1))
+        if re.search(r'How likely would the following types of (.*) be recognized', question):
+            return "\n".join(line + " - likely recognized by most people"
+                             for line in question.split("\n\n", 1)[-1].split("\n") if line.strip())
+        match = re.search(r'How many parts does (.*) have\?', question)
+        if match:
+            return str(max(1, len(self.lookup(match.group(1))['parts'])))
+        match = re.search(r'list solely the types of materials that (.*) are typically made of', question)
+        if match:
+            return summarize_materials(self.lookup(match.group(1))['materials'])
+        match = re.search(r'Are distinct parts of (.*) made of the same materials\?', question)
+        if match:
+            materials = set(part_materials(self.lookup(match.group(1))).values())
+            return 'yes' if len(materials) <= 1 else 'no'
+        match = re.search(r'please list clearly distinct, essential parts of (.*) with succinct', question)
+        if match:
+            entry = self.lookup(match.group(1))
+            return "<Parts>\n" + answer_parts(entry, False) + \
+                   "\n\n<Materials>: " + summarize_materials(entry['materials'])
+        match = re.search(r'the clearly distinct, essential parts of (.*) that are attached', question)
+        if match:
+            return answer_parts(self.lookup(match.group(1)), True)
+
+        # freqnouns.py
+        for pattern, label in [(r'sixth-grader', 'likely to be recognized by sixth-graders'),
+                               (r'standalone physical objects', 'is a physical object'),
+                               (r'mass noun or a count noun', 'count noun'),
+                               (r'entity on their own', 'a single entity')]:
+            if re.search(pattern, question):
+                return "\n".join(line + " - " + label
+                                 for line in question.split("\n\n")[-1].split("\n") if line.strip())
+        return "I'm not sure."
+
+    def answer_types(self, noun):
+        # In the format of ``fewshot.PART_PROMPT``
+        types = self.nouns.get(noun)
+        if types is None or list(types.keys()) == ['-']:
+            parts = types['-']['-'] if types else DEFAULT_ENTRY['parts']
+            parts = [(part, optional) for part, optional in parts if valid_part(part)]
+            return "No distinct subtypes based on the constituent parts.\nPhysical parts: " + list_parts(parts)
+        # a real model eventually answers without the problems fewshot.py checks for,
+        # so types sharing the same parts and part names it would ask about again are left out
+        lines = list()
+        seen_parts = list()
+        for subtype, subsubtypes in types.items():
+            listed = list()
+            for subsubtype, parts in subsubtypes.items():
+                parts = [(part, optional) for part, optional in parts if valid_part(part)]
+                if set(parts) not in seen_parts:
+                    seen_parts.append(set(parts))
+                    listed.append((subsubtype, parts))
+            if not listed:
+                continue
+            number = len([line for line in lines if line[0].isdigit() and ')' not in line.split(" ", 1)[0]]) + 1
+            if list(subsubtypes.keys()) == ['-']:
+                lines.append(f"{number}. {subtype}: {list_parts(listed[0][1])}")
+                continue
+            lines.append(f"{number}. {subtype}")
+            for letter, (subsubtype, parts) in zip('abcdefghijklmnopqrstuvwxyz', listed):
+                lines.append(f"{number}.{letter}) {subsubtype}: {list_parts(parts)}")
+        return "\n".join(lines)
+
+    def answer_materials(self, entry, parts_str):
+        # In the format of ``fewshot.MATERIAL_PROMPT``; the canned answer is used as it is if
+        # it has the number of lines fewshot.ask_materials expects for the asked parts
+        parts = [part for part in re.split(r",\s*(?![^()]*\))", parts_str) if part and part != '-']
+        conjunctions = sum(part.count(' or ') + part.count(' and ') + part.count(' and/or ') for part in parts)
+        if len(entry['materials'].split("\n")) == max(1, len(parts) + conjunctions):
+            return entry['materials']
+        if not parts:
+            return summarize_materials(entry['materials'])
+        materials = part_materials(entry)
+        lines = list()
+        for part in parts:
+            material = materials.get(part, summarize_materials(entry['materials']))
+            # e.g., "rods or wires" gets a line for each of "rods" and "wires"
+            for piece in re.split(r' and/or | and | or ', part):
+                lines.append(f"{len(lines) + 1}. {piece}: {material}")
+        return "\n".join(lines)
+
+
+class MockLLM:
+    # The behavior of the mock server: canned answers, latency, faults and its own rate limits
+    def __init__(self, canned, latency='0', token_latency=0.0, error_429=0.0, timeout=0.0, timeout_delay=600,
+                 malformed=0.0, rpm=None, tpm=None, seed=None, run_on=0.0, ignore_stop=False):
+        self.canned = canned
+        self.latency = parse_latency(latency)
+        self.token_latency = token_latency  # seconds per completion token
+        self.error_429 = error_429  # probabilities of each fault per request
+        self.timeout = timeout
+        self.timeout_delay = timeout_delay
+        self.malformed = malformed
+        self.run_on = run_on  # probability that a parts answer runs on with RUN_ON
+        self.ignore_stop = ignore_stop  # like an endpoint without the ``stop`` parameter
+        self.rpm = rpm
+        self.tpm = tpm
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.window = deque()  # (time, tokens) of the requests accepted in the last minute
+        self.stats = {'requests': 0, 'completed': 0, 'rate_limited': 0, 'injected_429': 0,
+                      'timeouts': 0, 'malformed': 0}
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def admit(self, tokens):
+        # Sliding one-minute window of requests and tokens, like the API's rate limits.
+        # Returns the rate limit headers and, if the request is rejected, the seconds until a retry.
+        now = time.time()
+        with self.lock:
+            while self.window and self.window[0][0] <= now - 60:
+                self.window.popleft()
+            used_tokens = sum(window_tokens for _, window_tokens in self.window)
+            reset = self.window[0][0] + 60 - now if self.window else 0.0
+            rejected = (self.rpm is not None and len(self.window) >= self.rpm) or \
+                       (self.tpm is not None and used_tokens + tokens > self.tpm)
+            if not rejected:
+                self.window.append((now, tokens))
+            headers = dict()
+            if self.rpm is not None:
+                headers['x-ratelimit-limit-requests'] = str(self.rpm)
+                headers['x-ratelimit-remaining-requests'] = str(max(0, self.rpm - len(self.window)))
+                headers['x-ratelimit-reset-requests'] = f'{reset:.3f}s'
+            if self.tpm is not None:
+                headers['x-ratelimit-limit-tokens'] = str(self.tpm)
+                headers['x-ratelimit-remaining-tokens'] = str(max(0, self.tpm - used_tokens - tokens))
+                headers['x-ratelimit-reset-tokens'] = f'{reset:.3f}s'
+        return headers, (max(reset, 0.001) if rejected else None)
+
+    def complete(self, request):
+        # Returns the status, headers and body of a chat completion response
+        with self.lock:
+            self.stats['requests'] += 1
+        message_list = request['messages']
+        headers, retry_after = self.admit(estimate_tokens(message_list, request.get('max_tokens') or 0))
+        if retry_after is None and self.random() < self.error_429:
+            retry_after = 1.0
+            with self.lock:
+                self.stats['injected_429'] += 1
+        elif retry_after is not None:
+            with self.lock:
+                self.stats['rate_limited'] += 1
+        if retry_after is not None:
+            headers['retry-after'] = f'{retry_after:.3f}'
+            return 429, headers, {'error': {'message': 'Rate limit reached.', 'type': 'requests',
+                                            'code': 'rate_limit_exceeded'}}
+
+        answer = self.canned.answer(message_list)
+        stop = request.get('stop') or list()
+        stop = [stop] if isinstance(stop, str) else stop
+        choices = list()
+        for index in range(request.get('n') or 1):
+            content = answer
+            if self.random() < self.malformed:
+                # a truncated or unusable answer instead of the canned one
+                with self.lock:
+                    content = self.rng.choice(MALFORMED_RESPONSES + [answer[:len(answer) // 2]])
+                    self.stats['malformed'] += 1
+            elif self.run_on and RUN_ON_PATTERN.search(message_list[-1]['content']) and self.random() < self.run_on:
+                content += RUN_ON
+            finish_reason = 'stop'
+            stop_positions = [content.find(sequence) for sequence in stop if sequence in content]
+            if stop_positions and not self.ignore_stop:
+                content = content[:min(stop_positions)]
+            if request.get('max_tokens') and len(content) // 4 > request['max_tokens']:
+                content = content[:request['max_tokens'] * 4]
+                finish_reason = 'length'
+            choices.append({'index': index, 'message': {'role': 'assistant', 'content': content},
+                            'finish_reason': finish_reason})
+        prompt_tokens = sum(len(message['content']) for message in message_list) // 4
+        completion_tokens = sum(len(choice['message']['content']) for choice in choices) // 4
+
+        with self.lock:
+            # a stream sends its chunks after the first-token latency, one every ``token_latency``
+            delay = self.latency(self.rng) + (0 if request.get('stream') else completion_tokens * self.token_latency)
+        if self.random() < self.timeout:
+            # the client gives up before the response arrives
+            delay = self.timeout_delay
+            with self.lock:
+                self.stats['timeouts'] += 1
+        time.sleep(max(0.0, delay))
+        with self.lock:
+            self.stats['completed'] += 1
+        return 200, headers, {'id': f"chatcmpl-mock{self.stats['requests']}", 'object': 'chat.completion',
+                              'created': int(time.time()), 'model': request.get('model', 'mock'),
+                              'choices': choices,
+                              'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                                        'total_tokens': prompt_tokens + completion_tokens}}
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, dict(), {'error': {'message': f'Unknown path {self.path}.'}})
+            return
+        length = int(self.headers.get('content-length', 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_json(400, dict(), {'error': {'message': 'Invalid JSON body.'}})
+            return
+        status, headers, body = self.server.mock.complete(request)
+        if request.get('stream') and status == 200:
+            self.send_stream(headers, body)
+        else:
+            self.send_json(status, headers, body)
+
+    def do_GET(self):
+        # the counters of the requests served so far
+        self.send_json(200, dict(), self.server.mock.stats)
+
+    def send_json(self, status, headers, body):
+        content = json.dumps(body).encode('utf-8')
+        try:
+            self.send_response(status)
+            self.send_header('content-type', 'application/json')
+            self.send_header('content-length', str(len(content)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(content)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client timed out
+
+    def send_stream(self, headers, body):
+        # The completion as server-sent events of STREAM_CHUNK characters, interleaving the choices
+        chunk_head = {'id': body['id'], 'object': 'chat.completion.chunk', 'created': body['created'],
+                      'model': body['model']}
+        events = list()
+        for choice in body['choices']:
+            content = choice['message']['content']
+            for start in range(0, len(content), STREAM_CHUNK):
+                events.append((start, {'index': choice['index'], 'finish_reason': None,
+                                       'delta': {'content': content[start:start + STREAM_CHUNK]}}))
+            events.append((len(content), {'index': choice['index'], 'delta': dict(),
+                                          'finish_reason': choice['finish_reason']}))
+        try:
+            self.send_response(200)
+            self.send_header('content-type', 'text/event-stream')
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            for position in sorted(set(start for start, _ in events)):
+                choices = [choice for start, choice in events if start == position]
+                self.wfile.write(f"data: {json.dumps({**chunk_head, 'choices': choices})}\n\n".encode('utf-8'))
+                self.wfile.flush()
+                time.sleep(self.server.mock.token_latency)
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client read what it needed
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(mock, host=HOST, port=PORT):
+    # Serve in a background thread; ``port=0`` picks a free port.
+    # The base URL for ``OpenAI(base_url=...)`` is f"http://{host}:{server.server_port}/v1".
+    server = ThreadingHTTPServer((host, port), MockHandler)
+    server.daemon_threads = True
+    server.mock = mock
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI-compatible mock server replaying canned responses')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--canned', default=CANNED_FILE, help='result file the answers are built from')
+    parser.add_argument('--latency', default='0',
+                        help='"SECONDS", "uniform:LOW,HIGH", "lognormal:MEDIAN,SIGMA" or "exponential:MEAN"')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='extra seconds per completion token')
+    parser.add_argument('--error-429', type=float, default=0.0, help='probability of an injected 429 response')
+    parser.add_argument('--timeout', type=float, default=0.0, help='probability of answering after --timeout-delay')
+    parser.add_argument('--timeout-delay', type=float, default=600)
+    parser.add_argument('--malformed', type=float, default=0.0, help='probability of a malformed answer')
+    parser.add_argument('--rpm', type=int, default=None, help='requests per minute before answering 429')
+    parser.add_argument('--tpm', type=int, default=None, help='tokens per minute before answering 429')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--run-on', type=float, default=0.0,
+                        help='probability that a list of subtypes and parts runs on into a note and a next example')
+    parser.add_argument('--ignore-stop', action='store_true', help='ignore the stop sequences of the requests')
+    args = parser.parse_args()
+
+    mock = MockLLM(CannedResponses(args.canned), args.latency, args.token_latency, args.error_429,
+                   args.timeout, args.timeout_delay, args.malformed, args.rpm, args.tpm, args.seed,
+                   args.run_on, args.ignore_stop)
+    server = start_server(mock, args.host, args.port)
+    print(f"Serving on http://{args.host}:{server.server_port}/v1 (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+        print(json.dumps(mock.stats))
+
+
+if __name__ == "__main__":
+    main()
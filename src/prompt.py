@@ -1,53 +1,390 @@
 from tenacity import (
     retry,
+    retry_if_not_exception_type,
     stop_after_attempt,
     wait_random_exponential
 )
+from openai import (AsyncOpenAI, AuthenticationError, BadRequestError, NotFoundError, OpenAI,
+                    PermissionDeniedError, RateLimitError)
+from ratelimit import RateLimiter, estimate_tokens
+from budget import check_budgets, current_budgets, loop_budget
+from cache import ResponseCache, VerdictMemo, current_scope
+from telemetry import Telemetry, call_site, current_call_site
+import asyncio
+import json
+import os
+import threading
 import time
 import re
 import pandas as pd
 
-RPM = 10000  # rate limit per minute
-DELAY = 60.0 / RPM  # calculate the delay based on your rate limit
-
-
-def receive_response(message, max_tokens, model, client):
+RPM = 10000  # rate limit of requests per minute
+TPM = 2000000  # rate limit of tokens per minute
+# Set a file path to share one rate limit budget among several processes
+RATE_LIMIT_FILE = None
+MAX_CONCURRENCY = 16  # number of requests kept in flight at the same time
+CALL_TIMEOUT = 60 * 2  # deadline for a single request in seconds
+RESPONSE_TIMEOUT = 60 * 15  # time limit for a prompt, including all of its retries
+SAMPLING_PARAMS = {'temperature': 1, 'top_p': 1}  # defaults
+# Whether the endpoint takes the ``n`` parameter; otherwise ``sample_responses`` sends n requests at once
+N_SAMPLING = True
+# Stream the responses of the requests with stop sequences and stop reading at the first one,
+# e.g., for endpoints that ignore ``stop``; the token usage of a stream is estimated from its length
+STREAMING = False
+VERDICT_MEMO_SIZE = 10000  # number of subtype confirmations and renamings remembered
+# errors that a retry cannot fix, e.g., an invalid request or API key, raised right away
+NON_RETRYABLE_ERRORS = (AuthenticationError, BadRequestError, NotFoundError, PermissionDeniedError)
+
+_LLM_CLIENTS = dict()
+_LLM_CLIENTS_LOCK = threading.Lock()
+RATE_LIMITER = RateLimiter(RPM, TPM, RATE_LIMIT_FILE)
+RESPONSE_CACHE = None  # no cache unless ``set_response_cache`` is called
+TELEMETRY = Telemetry()  # one record per request; see ``telemetry.Telemetry``
+VERDICT_MEMO = VerdictMemo(None, VERDICT_MEMO_SIZE)  # for this run only unless ``set_verdict_memo`` is called
+MAX_TOKENS_BY_CALL_SITE = dict()  # caps of max_tokens per call site; see ``set_max_tokens``
+
+
+class LLMClient:
+    # Sends chat completion requests from a background event loop,
+    # so that up to ``concurrency`` requests can be in flight at the same time
+    # no matter how many threads or coroutines are waiting for their responses.
+    def __init__(self, client, concurrency=MAX_CONCURRENCY, call_timeout=CALL_TIMEOUT, rate_limiter=None):
+        if isinstance(client, OpenAI):
+            # share the settings of the given client, but send the requests asynchronously;
+            # failed requests are retried by ``retry_prompt`` instead, so that every 429 reaches
+            # the rate limiter and every attempt is counted
+            client = AsyncOpenAI(api_key=client.api_key, organization=client.organization,
+                                 base_url=client.base_url, timeout=client.timeout, max_retries=0)
+        self.client = client
+        self.call_timeout = call_timeout
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RATE_LIMITER
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    async def create(self, message_list, max_tokens, model, timeout=None, record=None, params=None):
+        # ``record`` (see ``telemetry.Telemetry``) counts the attempts and keeps the token usage.
+        # ``params`` are the sampling parameters (default: ``SAMPLING_PARAMS``); with ``n``,
+        # the list of all sampled responses is returned instead of the first one.
+        if timeout is None:
+            timeout = self.call_timeout
+        if params is None:
+            params = SAMPLING_PARAMS
+        if record is not None:
+            record['attempts'] += 1
+        async with self.semaphore:
+            await self.rate_limiter.async_acquire(estimate_tokens(message_list, max_tokens * params.get('n', 1)))
+            if isinstance(self.client, AsyncOpenAI) and STREAMING and params.get('stop'):
+                request = self.read_stream(message_list, max_tokens, model, params)
+            elif isinstance(self.client, AsyncOpenAI):
+                # the raw response carries the rate limit headers
+                request = self.client.chat.completions.with_raw_response.create(
+                    model=model,
+                    messages=message_list,
+                    max_tokens=max_tokens,
+                    **params
+                )
+            else:
+                # any other client with the synchronous OpenAI interface runs in a worker thread
+                request = asyncio.to_thread(
+                    self.client.chat.completions.create,
+                    model=model,
+                    messages=message_list,
+                    max_tokens=max_tokens,
+                    **params
+                )
+            try:
+                response = await asyncio.wait_for(request, timeout)
+            except RateLimitError as error:
+                await self.rate_limiter.async_backoff(error.response.headers)
+                raise
+        if isinstance(response, tuple):
+            # a stream read up to its stop sequences
+            contents, finish_reasons = response
+            usage = None
+        else:
+            if hasattr(response, 'headers'):
+                await self.rate_limiter.async_update(response.headers)
+                response = response.parse()
+            contents = [choice.message.content for choice in response.choices]
+            finish_reasons = [choice.finish_reason for choice in response.choices]
+            usage = getattr(response, 'usage', None)
+        if record is not None:
+            record['truncated'] = 'length' in finish_reasons
+            if usage is not None:
+                record['prompt_tokens'] += usage.prompt_tokens
+                record['completion_tokens'] += usage.completion_tokens
+            else:
+                record['prompt_tokens'] += sum(len(message['content']) for message in message_list) // 4
+                record['completion_tokens'] += sum(len(content or '') for content in contents) // 4
+                record['estimated_tokens'] = True
+        return contents if 'n' in params else contents[0]
+
+    async def read_stream(self, message_list, max_tokens, model, params):
+        # Read the streamed choices until each of them reaches one of the stop sequences, which are cut off
+        # like the endpoint does, and close the connection instead of waiting for the rest of the completion
+        stop = params['stop'] if isinstance(params['stop'], list) else [params['stop']]
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=message_list,
+            max_tokens=max_tokens,
+            stream=True,
+            **params
+        )
+        await self.rate_limiter.async_update(stream.response.headers)
+        contents = [''] * params.get('n', 1)
+        finish_reasons = [None] * len(contents)
+        try:
+            async for chunk in stream:
+                for choice in chunk.choices:
+                    if finish_reasons[choice.index] is not None:
+                        continue
+                    content = contents[choice.index] + (choice.delta.content or '')
+                    stop_positions = [content.find(sequence) for sequence in stop if sequence in content]
+                    if stop_positions:
+                        content = content[:min(stop_positions)]
+                        finish_reasons[choice.index] = 'stop'
+                    elif choice.finish_reason is not None:
+                        finish_reasons[choice.index] = choice.finish_reason
+                    contents[choice.index] = content
+                if all(reason is not None for reason in finish_reasons):
+                    break
+        finally:
+            await stream.response.aclose()
+        return contents, finish_reasons
+
+    def submit(self, coroutine):
+        # Schedule the coroutine on the background loop and return a ``concurrent.futures.Future``
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine):
+        # Block until the coroutine finishes on the background loop.
+        # This must not be called from a coroutine running on the same loop.
+        return self.submit(coroutine).result()
+
+
+def get_llm_client(client):
+    # One ``LLMClient`` (and so one concurrency limit) is shared per OpenAI client
+    if isinstance(client, LLMClient):
+        return client
+    with _LLM_CLIENTS_LOCK:
+        if id(client) not in _LLM_CLIENTS:
+            _LLM_CLIENTS[id(client)] = (client, LLMClient(client))
+        return _LLM_CLIENTS[id(client)][1]
+
+
+def set_concurrency(concurrency=None, call_timeout=None):
+    # Change the number of requests in flight and the per-request deadline.
+    # Call this before any request is sent.
+    global MAX_CONCURRENCY, CALL_TIMEOUT
+    if concurrency is not None:
+        if concurrency < 1:
+            raise ValueError("`concurrency` must be a positive integer.")
+        MAX_CONCURRENCY = concurrency
+    if call_timeout is not None:
+        CALL_TIMEOUT = call_timeout
+    with _LLM_CLIENTS_LOCK:
+        for _, llm_client in _LLM_CLIENTS.values():
+            llm_client.semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+            llm_client.call_timeout = CALL_TIMEOUT
+
+
+def set_rate_limit(rpm=None, tpm=None, state_file=None):
+    # Replace the shared rate limiter; with ``state_file``, every process
+    # pointing at the same file draws from one requests/tokens budget.
+    global RPM, TPM, RATE_LIMIT_FILE, RATE_LIMITER
+    if rpm is not None:
+        RPM = rpm
+    if tpm is not None:
+        TPM = tpm
+    if state_file is not None:
+        RATE_LIMIT_FILE = state_file
+    RATE_LIMITER = RateLimiter(RPM, TPM, RATE_LIMIT_FILE)
+    with _LLM_CLIENTS_LOCK:
+        for _, llm_client in _LLM_CLIENTS.values():
+            llm_client.rate_limiter = RATE_LIMITER
+
+
+def set_response_cache(path, mode='read-through', max_entries=None, max_bytes=None, max_age=None):
+    # Keep the responses in an on-disk cache; see ``cache.ResponseCache`` for the modes
+    global RESPONSE_CACHE
+    RESPONSE_CACHE = ResponseCache(path, mode, max_entries, max_bytes, max_age)
+    return RESPONSE_CACHE
+
+
+def set_max_tokens(path):
+    # Cap max_tokens per call site with the caps written by ``telemetry.py --suggest-max-tokens``;
+    # no caps if the file doesn't exist. A response cut off by a cap is asked again without it.
+    global MAX_TOKENS_BY_CALL_SITE
+    MAX_TOKENS_BY_CALL_SITE = dict()
+    if path and os.path.exists(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            MAX_TOKENS_BY_CALL_SITE = json.load(f)
+    return MAX_TOKENS_BY_CALL_SITE
+
+
+def set_verdict_memo(path=None, max_entries=None):
+    # Remember the subtype confirmations in ``path`` across runs; see ``cache.VerdictMemo``
+    global VERDICT_MEMO
+    VERDICT_MEMO = VerdictMemo(path, max_entries or VERDICT_MEMO_SIZE)
+    return VERDICT_MEMO
+
+
+def receive_response(message, max_tokens, model, client, timeout=None, stop=None):
+    # Synchronous shim around ``async_receive_response`` for the existing callers.
+    # ``stop``: sequences where the response ends, e.g., the start of the next example of a few-shot prompt
+    llm_client = get_llm_client(client)
+    return llm_client.run(_receive_response(*_request(message, max_tokens, model, stop=stop), llm_client, timeout))
+
+
+async def async_receive_response(message, max_tokens, model, client, timeout=None, stop=None):
+    # Can be awaited from any event loop; the request itself runs on the client's background loop
+    llm_client = get_llm_client(client)
+    return await asyncio.wrap_future(
+        llm_client.submit(_receive_response(*_request(message, max_tokens, model, stop=stop), llm_client, timeout)))
+
+
+def gather_responses(messages, max_tokens, model, client, timeout=None, stop=None):
+    # Send all messages at once and return the responses in the same order
+    llm_client = get_llm_client(client)
+    futures = [llm_client.submit(_receive_response(*_request(message, max_tokens, model, stop=stop),
+                                                   llm_client, timeout))
+               for message in messages]
+    return [future.result() for future in futures]
+
+
+def sample_responses(message, max_tokens, model, client, n, timeout=None, stop=None):
+    # ``n`` samples of the same prompt, e.g., for a majority vote: one request with the ``n`` parameter,
+    # or ``n`` requests sent at once if the endpoint doesn't take it (``N_SAMPLING``) or ignores it
+    if not N_SAMPLING or n == 1:
+        return gather_responses([message] * n, max_tokens, model, client, timeout, stop)
+    llm_client = get_llm_client(client)
+    responses = llm_client.run(_receive_response(*_request(message, max_tokens, model, n, stop),
+                                                 llm_client, timeout))
+    if isinstance(responses, str):
+        # e.g., a batch result with a single choice
+        responses = [responses]
+    if len(responses) < n:
+        responses += gather_responses([message] * (n - len(responses)), max_tokens, model, client, timeout, stop)
+    return responses[:n]
+
+
+def _request(message, max_tokens, model, n=None, stop=None):
+    # The cache keys, the telemetry record and the budgets are taken in the calling thread,
+    # where the noun's cache scope, the call site and the budgets are set
+    budgets = current_budgets()
+    check_budgets(budgets)
     if not isinstance(message, list):
         message = [{"role": "user", "content": message}]
+    params = SAMPLING_PARAMS
+    if n is not None:
+        params = {**params, 'n': n}
+    if stop:
+        params = {**params, 'stop': stop}
+    record = TELEMETRY.start(current_call_site(), current_scope(), model, max_tokens)
+    if MAX_TOKENS_BY_CALL_SITE.get(record['call_site']):
+        max_tokens = min(max_tokens, MAX_TOKENS_BY_CALL_SITE[record['call_site']])
+    # max_tokens -> cache key; with a cap, the request with the caller's max_tokens has a key of its own
+    # in case the capped response is cut off
+    cache_keys = dict()
+    if RESPONSE_CACHE is not None:
+        for tokens in sorted({max_tokens, record['max_tokens']}):
+            cache_keys[tokens] = RESPONSE_CACHE.key(model, message, tokens, params)
+    return message, max_tokens, model, cache_keys, record, params, budgets
+
+
+def _cached_response(message_list, max_tokens, model, cache_keys, record, params, budgets):
+    # The cached response of the request with ``max_tokens``, or None; a hit finishes the record
+    # the request body is only needed to plan a batch of requests without cached responses
+    request = {'model': model, 'messages': message_list, 'max_tokens': max_tokens, **params}
+    response = RESPONSE_CACHE.get(cache_keys[max_tokens], request)
+    if response is not None:
+        record['cached'] = True
+        TELEMETRY.finish(record)
+        charge_budgets(budgets, record)
+    return response
+
 
-    timeout = time.time() + 60 * 15  # time limit set for 15 minutes
+async def _receive_response(message_list, max_tokens, model, cache_keys, record, params, budgets,
+                            llm_client, timeout):
+    if cache_keys:
+        response = _cached_response(message_list, max_tokens, model, cache_keys, record, params, budgets)
+        if response is not None:
+            return response
+
+    deadline = time.time() + RESPONSE_TIMEOUT  # time limit set for 15 minutes
     while True:
         try:
-            response = retry_prompt(message, max_tokens, model, client)
-            break
-        except:
-            pass
+            response = await retry_prompt(message_list, max_tokens, model, llm_client, timeout, record, params)
+        except NON_RETRYABLE_ERRORS as error:
+            print(f"Request from {record['call_site']} failed: {error!r}")
+            TELEMETRY.finish(record, error)
+            charge_budgets(budgets, record)
+            raise
+        except Exception as error:
+            if time.time() > deadline:
+                print(f"Suspending because of an error from OpenAI ({record['call_site']}).\n{error!r}")
+                TELEMETRY.finish(record, error)
+                charge_budgets(budgets, record)
+                raise
+            print(f"Request from {record['call_site']} still failing after {record['attempts']} attempts, "
+                  f"retrying: {error!r}")
+            continue
+        if record['truncated'] and max_tokens < record['max_tokens']:
+            # cut off by the cap of the call site; ask again with the max_tokens of the caller
+            max_tokens = record['max_tokens']
+            if cache_keys:
+                response = _cached_response(message_list, max_tokens, model, cache_keys, record, params, budgets)
+                if response is not None:
+                    return response
+            continue
+        break
+
+    if cache_keys:
+        # under the key of the request that produced the response
+        RESPONSE_CACHE.put(cache_keys[max_tokens], response)
+    TELEMETRY.finish(record)
+    charge_budgets(budgets, record)
+    return response
 
-        if time.time() > timeout:
-            print(f'Suspending because an error from OpenAI.\n{response}')
-            break
 
-    return response
+def charge_budgets(budgets, record):
+    for budget in budgets:
+        budget.charge(record)
+
+
+@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6),
+       retry=retry_if_not_exception_type(NON_RETRYABLE_ERRORS), reraise=True)
+async def retry_prompt(message_list, max_tokens, model, llm_client, timeout=None, record=None, params=None):
+    # The client's rate limiter decides when the request can be sent
+    return await llm_client.create(message_list, max_tokens, model, timeout, record, params)
+
+
+def read_nouns(noun_file):
+    # Nouns are listed one per line, up to the first empty line
+    nouns = list()
+    with open(noun_file, 'r') as f_read:
+        noun = f_read.readline().strip()
+        while noun:
+            nouns.append(noun)
+            noun = f_read.readline().strip()
+    return nouns
 
 
-@retry(wait=wait_random_exponential(min=1, max=60), stop=stop_after_attempt(6))
-def retry_prompt(message_list, max_tokens, model, client):
-    # Sleep for the delay
-    time.sleep(DELAY)
-    response = client.chat.completions.create(
-        model=model,
-        messages=message_list,
-        temperature=1,  # default
-        top_p=1,  # default
-        max_tokens=max_tokens
-    )
-    response_message = response.choices[0].message.content
-    return response_message
+def forget_verdict(subtype, supertype):
+    # The remembered name of a subtype led to listing the types again (e.g., it clashes with another subtype),
+    # so ask about it again instead of repeating the same answer
+    VERDICT_MEMO.forget(subtype, supertype)
 
 
+@call_site('confirm_subtype')
 def confirm_subtype(subtype, supertype, max_tokens, renaming_max_tokens, model, client):
     if subtype == '-':
         return '-'
+    memo_name = VERDICT_MEMO.name('confirm', subtype, supertype)
+    if memo_name is not None:
+        return memo_name
 
     question = f"""\
 Choose the most accurate response from below.
@@ -56,29 +393,111 @@ Choose the most accurate response from below.
 3) "{subtype}" is not an appropriate name, but "{subtype}" describes a type of {supertype}.
 4) "{subtype}" does not belong to {supertype}."""
     answer_choice = ""
-    while not answer_choice:
-        response = receive_response(question, max_tokens, model, client)
-        answer_choice = re.search(r"\d[\)|\.]", response)
+    with loop_budget('confirm_subtype') as budget:
+        while not answer_choice and budget.next_round():
+            response = receive_response(question, max_tokens, model, client)
+            answer_choice = re.search(r"\d[\)|\.]", response)
+    if not answer_choice:
+        # out of budget; keep the subtype, but ask again in the next run
+        return subtype
     answer_choice = answer_choice.group(0)
     if answer_choice[0] == '1':
+        VERDICT_MEMO.put('confirm', subtype, supertype, 'keep')
         return subtype
     elif answer_choice[0] in {'2', '3'}:
-        return rename_subtype(subtype, supertype, renaming_max_tokens, model, client)
+        new_subtype = rename_subtype(subtype, supertype, renaming_max_tokens, model, client)
+        VERDICT_MEMO.put('confirm', subtype, supertype, 'rename', new_subtype)
+        return new_subtype
     else:
+        VERDICT_MEMO.put('confirm', subtype, supertype, 'remove')
         return ''
 
 
+@call_site('rename_subtype')
 def rename_subtype(subtype, supertype, max_tokens, model, client):
+    memo_name = VERDICT_MEMO.name('rename', subtype, supertype)
+    if memo_name is not None:
+        return memo_name
+
     question = f'If necessary, convert "{subtype}" to an appropriate and correct noun phrase that accurately refers to a type of {supertype}, distinguishing "{subtype}" from other types of {supertype}. Otherwise, you may just return "{subtype}".\nWrite the best answer with quotation marks.'
 
     response = receive_response(question, max_tokens, model, client)
     name_in_quotes = re.search(r'"(.*?)"', response)
-    while not name_in_quotes:
-        response = receive_response(question, max_tokens, model, client)
-        name_in_quotes = re.search(r'"(.*?)"', response)
+    with loop_budget('rename_subtype') as budget:
+        while not name_in_quotes and budget.next_round():
+            response = receive_response(question, max_tokens, model, client)
+            name_in_quotes = re.search(r'"(.*?)"', response)
+    if not name_in_quotes:
+        # out of budget; keep the name, but ask again in the next run
+        return subtype
 
     # get the first mention within quotation marks
-    return name_in_quotes.group(0).strip('"')
+    new_subtype = name_in_quotes.group(0).strip('"')
+    VERDICT_MEMO.put('rename', subtype, supertype, 'rename', new_subtype)
+    return new_subtype
+
+
+# one line per term of ``confirm_subtypes``, e.g., '2. 1)' or '3. 3) "Electric knife"'
+_VERDICT_PATTERN = re.compile(r'^\W*(\d+)[.)]\W*([1-4])\b[).]?(.*)$')
+
+
+@call_site('confirm_subtypes')
+def confirm_subtypes(subtypes, supertype, max_tokens, renaming_max_tokens, model, client):
+    # ``confirm_subtype`` for all siblings at once: one question lists every subtype of ``supertype``
+    # and asks for the choice and, for choices 2) and 3), the new name of each of them.
+    # Returns {subtype: confirmed name, or '' if it doesn't belong to the supertype}.
+    # Subtypes whose answer can't be parsed are asked about one by one.
+    verdicts = {subtype: '-' for subtype in subtypes if subtype == '-'}
+    for subtype in dict.fromkeys(subtypes):
+        memo_name = VERDICT_MEMO.name('confirm', subtype, supertype) if subtype != '-' else None
+        if memo_name is not None:
+            verdicts[subtype] = memo_name
+    # only the subtypes without a remembered verdict are asked about
+    terms = [subtype for subtype in dict.fromkeys(subtypes) if subtype not in verdicts]
+    if len(terms) == 1:
+        verdicts[terms[0]] = confirm_subtype(terms[0], supertype, max_tokens, renaming_max_tokens, model, client)
+    if len(terms) <= 1:
+        return verdicts
+
+    term_list = "\n".join(f"{number}. {term}" for number, term in enumerate(terms, 1))
+    question = f"""\
+For each numbered term below, choose the most accurate response from the following.
+1) "[term]" is an appropriate name for a type of {supertype}.
+2) The ill-formed term "[term]" doesn't necessarily indicate it's {supertype}.
+3) "[term]" is not an appropriate name, but "[term]" describes a type of {supertype}.
+4) "[term]" does not belong to {supertype}.
+
+For 2) and 3), also convert the term to an appropriate and correct noun phrase that accurately refers to a type of {supertype}, distinguishing it from the other types of {supertype}, and write it with quotation marks.
+Answer with one line per term, e.g., "1. 1)" or "2. 3) \"[noun phrase]\"".
+
+{term_list}"""
+    response = receive_response(question, max_tokens, model, client)
+
+    answers = dict()
+    for line in response.split("\n"):
+        match = _VERDICT_PATTERN.match(line)
+        if match and 1 <= int(match.group(1)) <= len(terms):
+            answers.setdefault(terms[int(match.group(1)) - 1], (match.group(2), match.group(3)))
+    for term in terms:
+        if term not in answers:
+            verdicts[term] = confirm_subtype(term, supertype, max_tokens, renaming_max_tokens, model, client)
+            continue
+        choice, rest = answers[term]
+        name_in_quotes = re.search(r'"(.*?)"', rest)
+        if choice == '1':
+            verdicts[term] = term
+            VERDICT_MEMO.put('confirm', term, supertype, 'keep')
+            continue
+        if choice == '4':
+            verdicts[term] = ''
+            VERDICT_MEMO.put('confirm', term, supertype, 'remove')
+            continue
+        if name_in_quotes and name_in_quotes.group(1).strip():
+            verdicts[term] = name_in_quotes.group(1).strip()
+        else:
+            verdicts[term] = rename_subtype(term, supertype, renaming_max_tokens, model, client)
+        VERDICT_MEMO.put('confirm', term, supertype, 'rename', verdicts[term])
+    return verdicts
 
 
 def verbose_materials(response):
@@ -99,87 +518,117 @@ def find_last_conjuction(text, conj_list):
     return last_conj, last_conj_ind
 
 
+MATERIAL_KEYWORDS = ('alloy', 'aluminium', 'aluminum',
+                     'bamboo', 'bone', 'brass', 'brick', 'bronze',
+                     'cardboard', 'cement', 'cements', 'ceramic',
+                     'chemical', 'clay', 'concrete', 'copper', 'cotton',
+                     'electronic', 'fabric', 'felt', 'fiber', 'foam',
+                     'gel', 'gem', 'glass', 'gold', 'hardboard', 'hardwood',
+                     'iron', 'ivory', 'ivories', 'leather', 'linen', 'liquid', 'lumber',
+                     'metal', 'nickel', 'nylon', 'paper', 'plastic', 'platinum', 'plywood',
+                     'polyester', 'porcelain', 'powder', 'quartz', 'rubber', 'satin', 'silicon', 'silk',
+                     'silver', 'slate', 'spandex', 'steel', 'stone', 'synthetic',
+                     'textile', 'tile', 'titanium', 'vinyl', 'wood', 'wool')
+VARYING_TOKENS = ('varied', 'varies', 'various', 'vary')
+NEGATIVE_TOKENS = ('not ', 'no ', 'none', 'n/a')
+MATERIAL_CONJUNCTIONS = [' and/or ', ' or ', ' and ', ', ']
+# The patterns of ``extract_material_str``, compiled once instead of at every call
+_INCLUDE_PATTERN = re.compile(r'^(includ)| includ|\(includ')
+_TOKEN_SPLIT_PATTERN = re.compile(r'\s|\(')
+_PREDICATE_PATTERN = re.compile(r'(be|is|are) ([\sa-zA-Z]*)made [a-zA-Z]* ')
+_PARENTHESES_PATTERN = re.compile(r'(\s)*\([^)]*\)')
+_CONJUNCTION = '(?:' + '|'.join(re.escape(conj) for conj in MATERIAL_CONJUNCTIONS) + ')'
+_CONJUNCTION_OR_END = '(?:' + '|'.join(re.escape(conj) for conj in MATERIAL_CONJUNCTIONS) + r'|\Z)'
+
+
+def _combination_phrases():
+    # (phrase, pattern of the phrase between two conjunctions or after the last one), in the order they are replaced;
+    # e.g., 'A, B, a blend thereof', 'A, B, or a blend', 'A or B or both'
+    phrases = list()
+    for comb_head, plural in {'combination': 's', 'blend': 's', 'mix': 'es'}.items():
+        for comb_word in ['a ' + comb_head, comb_head + plural]:
+            phrases.append((comb_word + ' of both', None))
+            phrases.append((comb_word + ' thereof', None))
+            phrases.append((comb_word, re.compile(_CONJUNCTION + re.escape(comb_word) + _CONJUNCTION_OR_END)))
+    phrases.append(('both', re.compile(_CONJUNCTION + 'both' + _CONJUNCTION_OR_END)))
+    return phrases
+
+
+_COMBINATION_PHRASES = _combination_phrases()
+
+
 def extract_material_str(material_str):
-    material_keywords = {'alloy', 'aluminium', 'aluminum',
-                        'bamboo', 'bone', 'brass', 'brick', 'bronze',
-                        'cardboard', 'cement', 'cements', 'ceramic',
-                        'chemical', 'clay', 'concrete', 'copper', 'cotton',
-                        'electronic', 'fabric', 'felt', 'fiber', 'foam',
-                        'gel', 'gem', 'glass', 'gold', 'hardboard', 'hardwood',
-                        'iron', 'ivory', 'ivories', 'leather', 'linen', 'liquid', 'lumber',
-                        'metal', 'nickel', 'nylon', 'paper', 'plastic', 'platinum', 'plywood',
-                        'polyester', 'porcelain', 'powder', 'quartz', 'rubber', 'satin', 'silicon', 'silk',
-                        'silver', 'slate', 'spandex', 'steel', 'stone', 'synthetic',
-                        'textile', 'tile', 'titanium', 'vinyl', 'wood', 'wool'}
+    lower_str = material_str.lower()
 
     # if materials are listed after 'various/varied', then take the listed materials
     # otherwise, simplify it by changing it to 'various materials'
-    if any(material_str.lower().startswith(varying_token) for varying_token in {'varied', 'varies', 'various', 'vary'}) or \
-            (' varies' in material_str.lower() or ' vary' in material_str.lower()):
-        has_include_token = re.search(r'^(includ)| includ|\(includ', material_str.lower())
+    if lower_str.startswith(VARYING_TOKENS) or (' varies' in lower_str or ' vary' in lower_str):
+        has_include_token = _INCLUDE_PATTERN.search(lower_str)
         if has_include_token:
             material_str = material_str[has_include_token.end():].split(" ", 1)[-1]
-        elif any(any(token.lower().startswith(keyword) for keyword in material_keywords) for token in
-                 re.split(r'\s|\(', material_str)):
-            for token in re.split(r'\s|\(', material_str):
-                if any(token.lower().startswith(keyword) for keyword in material_keywords):
+        else:
+            for token in _TOKEN_SPLIT_PATTERN.split(material_str):
+                if token.lower().startswith(MATERIAL_KEYWORDS):
                     material_str = material_str[material_str.find(token):].split(", depending ")[0].split(" depending ")[0]
                     break
-        else:
-            material_str = 'various materials'
+            else:
+                material_str = 'various materials'
 
     # remove parts whose material doesn't exist; e.g., "N/A", "no materials", "none".
-    elif (not material_str) or material_str in {'—', '-'} or \
-            any(material_str.lower().startswith(neg_token) for neg_token in {'not ', 'no ', 'none', 'n/a'}) or \
-            (('no ' in material_str.lower() or 'not ' in material_str.lower()) and\
-             ('material' in material_str.lower() or 'physical' in material_str.lower())):
+    elif (not material_str) or material_str in {'—', '-'} or lower_str.startswith(NEGATIVE_TOKENS) or \
+            (('no ' in lower_str or 'not ' in lower_str) and ('material' in lower_str or 'physical' in lower_str)):
         return '-'
 
     # convert a sentence to a phrase with a list of nouns
-    found_predicate = re.search(r'(be|is|are) ([\sa-zA-Z]*)made [a-zA-Z]* ', material_str)
+    found_predicate = _PREDICATE_PATTERN.search(material_str)
     if found_predicate:
         material_str = material_str[found_predicate.end():]
 
     # clean up
-    material_str = re.sub(r'(\s)*\([^)]*\)', '', material_str)
+    if '(' in material_str:
+        material_str = _PARENTHESES_PATTERN.sub('', material_str)
     material_str = material_str.split(", etc.", 1)[0].split(")", 1)[0].strip('. ')
 
     # convert 'combination/mix/blend of both' to 'and/or'
-    conj_list = [' and/or ', ' or ', ' and ', ', ']
+    if not ('combination' in material_str or 'blend' in material_str or 'mix' in material_str or
+            'both' in material_str):
+        # none of the phrases below can be found
+        return material_str
     comb_list = list()
-    for comb_head, plural in {'combination': 's', 'blend': 's', 'mix': 'es'}.items():
-        for comb_word in ['a ' + comb_head, comb_head + plural]:
-            for comb_tail in [' of both', ' thereof']:
-                # e.g., 'A, B, a blend thereof'
-                if comb_word + comb_tail in material_str:
-                    comb_list.append(comb_word + comb_tail)
-            # e.g., 'A, B, or a blend'
-            if any(any(c1 + comb_word + c2 in material_str or material_str.endswith(c1 + comb_word)
-                       for c1 in conj_list) for c2 in conj_list):
-                comb_list.append(comb_word)
-    if any(any(c1 + 'both' + c2 in material_str or material_str.endswith(c1 + 'both')
-               for c1 in conj_list) for c2 in conj_list):
-        comb_list.append('both')
+    for comb_phrase, pattern in _COMBINATION_PHRASES:
+        if (comb_phrase in material_str) if pattern is None else pattern.search(material_str):
+            comb_list.append(comb_phrase)
 
     for comb_phrase in comb_list:
         two_materials, rest_materials = material_str.split(comb_phrase, 1)
-        _, conj_ind = find_last_conjuction(two_materials, conj_list)
+        _, conj_ind = find_last_conjuction(two_materials, MATERIAL_CONJUNCTIONS)
         two_materials = two_materials[:conj_ind]
         two_materials = two_materials.strip(',')
-        last_conj, last_conj_ind = find_last_conjuction(two_materials, conj_list)
+        last_conj, last_conj_ind = find_last_conjuction(two_materials, MATERIAL_CONJUNCTIONS)
         material_str = two_materials[:last_conj_ind] + ' and/or ' + two_materials[last_conj_ind + len(
             last_conj):] + rest_materials
 
     return material_str
 
 
-def append_rows(df, col_names, col_values):
-    if len(col_names) != len(col_names):
-        raise ValueError("The two lists `col_names` and `col_values` must have the same length.")
+class RowBuffer:
+    # Collects rows column by column and builds the DataFrame only once,
+    # instead of concatenating a one-row DataFrame for every row.
+    def __init__(self, col_names):
+        self.col_names = list(col_names)
+        self.columns = [list() for _ in self.col_names]
+
+    def append(self, col_values):
+        if len(col_values) != len(self.col_names):
+            raise ValueError("The two lists `col_names` and `col_values` must have the same length.")
+        for column, value in zip(self.columns, col_values):
+            column.append(value)
+
+    def __len__(self):
+        return len(self.columns[0])
 
-    row_dict = dict()
-    for i in range(len(col_names)):
-        row_dict[col_names[i]] = col_values[i]
+    def rows(self):
+        return [list(row) for row in zip(*self.columns)]
 
-    new_df = pd.DataFrame([row_dict])
-    return pd.concat([df, new_df], axis=0, ignore_index=True)
+    def to_frame(self):
+        return pd.DataFrame(dict(zip(self.col_names, self.columns)), columns=self.col_names)
@@ -0,0 +1,164 @@
+from contextlib import contextmanager
+from filelock import FileLock
+import asyncio
+import json
+import os
+import random
+import re
+import threading
+import time
+
+MAX_BACKOFF = 60  # longest pause in seconds after repeated 429 responses
+
+
+def parse_reset_time(value):
+    # Convert the reset times in OpenAI's rate limit headers to seconds;
+    # e.g., "20ms", "1s", "6m0s", "1h2m3.5s"
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0.0
+    units = {'ms': 0.001, 'h': 3600, 'm': 60, 's': 1}
+    found = re.findall(r'([0-9.]+)(ms|h|m|s)', value)
+    if not found:
+        return None
+    for number, unit in found:
+        seconds += float(number) * units[unit]
+    return seconds
+
+
+def estimate_tokens(message_list, max_tokens):
+    # Rough count of the tokens a request is charged against the tokens-per-minute limit:
+    # about four characters per prompt token plus the completion tokens it may use
+    prompt_chars = sum(len(message['content']) for message in message_list)
+    return prompt_chars // 4 + max_tokens
+
+
+class RateLimiter:
+    # Token buckets for both requests per minute and tokens per minute.
+    # With ``state_file`` the buckets are kept in a file guarded by a file lock,
+    # so that several processes share one budget instead of each counting their own.
+    def __init__(self, rpm, tpm, state_file=None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.state_file = state_file
+        self.thread_lock = threading.Lock()
+        self.file_lock = FileLock(state_file + '.lock') if state_file else None
+        self.state = self.new_state()
+
+    def new_state(self):
+        return {'requests': float(self.rpm), 'tokens': float(self.tpm),
+                'rpm': self.rpm, 'tpm': self.tpm,
+                'updated': time.time(), 'blocked_until': 0.0, 'penalty': 0}
+
+    @contextmanager
+    def locked_state(self):
+        with self.thread_lock:
+            if self.file_lock is None:
+                yield self.state
+                return
+            with self.file_lock:
+                if os.path.exists(self.state_file):
+                    with open(self.state_file, 'r') as f:
+                        try:
+                            self.state = json.load(f)
+                        except json.JSONDecodeError:
+                            self.state = self.new_state()
+                yield self.state
+                with open(self.state_file, 'w') as f:
+                    json.dump(self.state, f)
+
+    @staticmethod
+    def refill(state, now):
+        elapsed = max(0.0, now - state['updated'])
+        state['requests'] = min(state['rpm'], state['requests'] + elapsed * state['rpm'] / 60)
+        state['tokens'] = min(state['tpm'], state['tokens'] + elapsed * state['tpm'] / 60)
+        state['updated'] = now
+
+    def reserve(self, tokens):
+        # Take one request and ``tokens`` tokens from the buckets if both have enough left.
+        # Otherwise, return how many seconds to wait before trying again.
+        with self.locked_state() as state:
+            now = time.time()
+            self.refill(state, now)
+            if state['blocked_until'] > now:
+                return state['blocked_until'] - now
+            # a request larger than the whole bucket only waits until the bucket is full
+            tokens = min(tokens, state['tpm'])
+            if state['requests'] >= 1 and state['tokens'] >= tokens:
+                state['requests'] -= 1
+                state['tokens'] -= tokens
+                return 0.0
+            request_wait = (1 - state['requests']) * 60 / state['rpm'] if state['requests'] < 1 else 0.0
+            token_wait = (tokens - state['tokens']) * 60 / state['tpm'] if state['tokens'] < tokens else 0.0
+            return max(request_wait, token_wait)
+
+    def acquire(self, tokens):
+        delay = self.reserve(tokens)
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.reserve(tokens)
+
+    async def async_acquire(self, tokens):
+        delay = await self.off_loop(self.reserve, tokens)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = await self.off_loop(self.reserve, tokens)
+
+    async def async_update(self, headers):
+        await self.off_loop(self.update, headers)
+
+    async def async_backoff(self, headers=None):
+        await self.off_loop(self.backoff, headers)
+
+    async def off_loop(self, method, *args):
+        # With ``state_file``, waiting for the file lock and reading and writing the file run in a worker thread,
+        # so that another process holding the lock doesn't hold up every request on the event loop
+        if self.file_lock is None:
+            return method(*args)
+        return await asyncio.to_thread(method, *args)
+
+    def update(self, headers):
+        # Follow the provider's own view of the limits,
+        # e.g., when another client uses the same API key at the same time.
+        if headers is None:
+            return
+        with self.locked_state() as state:
+            now = time.time()
+            self.refill(state, now)
+            for kind, limit in [('requests', 'rpm'), ('tokens', 'tpm')]:
+                limit_header = headers.get(f'x-ratelimit-limit-{kind}')
+                if limit_header:
+                    state[limit] = min(getattr(self, limit), int(limit_header))
+                remaining = headers.get(f'x-ratelimit-remaining-{kind}')
+                if remaining is None:
+                    continue
+                state[kind] = min(state[kind], float(remaining), state[limit])
+                if float(remaining) <= 0:
+                    reset = parse_reset_time(headers.get(f'x-ratelimit-reset-{kind}'))
+                    if reset:
+                        state['blocked_until'] = max(state['blocked_until'], now + reset)
+            # a successful response lowers the penalty from earlier 429s
+            state['penalty'] = max(0, state['penalty'] - 1)
+
+    def backoff(self, headers=None):
+        # Pause every worker sharing this limiter after a 429 response,
+        # for as long as the provider asks or exponentially longer on repeated 429s.
+        with self.locked_state() as state:
+            now = time.time()
+            state['penalty'] += 1
+            delay = None
+            if headers is not None:
+                delay = parse_reset_time(headers.get('retry-after'))
+                if delay is None:
+                    delay = max(parse_reset_time(headers.get('x-ratelimit-reset-requests')) or 0,
+                                parse_reset_time(headers.get('x-ratelimit-reset-tokens')) or 0) or None
+            if delay is None:
+                delay = min(MAX_BACKOFF, 2 ** state['penalty']) * random.uniform(0.5, 1.0)
+            state['requests'] = 0.0
+            state['tokens'] = 0.0
+            state['updated'] = now
+            state['blocked_until'] = max(state['blocked_until'], now + delay)
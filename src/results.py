@@ -0,0 +1,51 @@
+import csv
+import os
+import pandas as pd
+
+
+class ResultWriter:
+    # Appends the rows of each finished noun to the intermediate result file,
+    # instead of rewriting the whole file after every noun.
+    # The rows are flushed to disk before the noun is recorded in ``{path}.done``,
+    # so with ``resume`` a crashed run continues after the last completed noun.
+    def __init__(self, path, col_names, resume=False):
+        self.path = path
+        self.done_path = path + '.done'
+        self.col_names = col_names
+        self.completed = set()
+
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if resume and os.path.exists(path) and os.path.exists(self.done_path):
+            with open(self.done_path, 'r', encoding='utf-8') as f:
+                self.completed = set(line.rstrip('\n') for line in f if line.strip())
+            # drop the rows of a noun that was only partly written when the run stopped
+            result_df = self.read()
+            result_df = result_df[result_df[col_names[0]].isin(self.completed)]
+            result_df.to_csv(path + '.tmp', sep='\t', index=False, encoding='utf-8')
+            os.replace(path + '.tmp', path)
+        elif resume and os.path.exists(path):
+            # a file written before the ``.done`` record: every noun with rows in it counts as completed
+            self.completed = set(self.read()[col_names[0]])
+            with open(self.done_path, 'w', encoding='utf-8') as f:
+                f.writelines(noun + '\n' for noun in sorted(self.completed))
+        else:
+            with open(path, 'w', encoding='utf-8', newline='') as f:
+                csv.writer(f, delimiter='\t', lineterminator='\n').writerow(col_names)
+            with open(self.done_path, 'w', encoding='utf-8'):
+                pass
+
+    def write(self, noun, rows):
+        with open(self.path, 'a', encoding='utf-8', newline='') as f:
+            csv.writer(f, delimiter='\t', lineterminator='\n').writerows(rows)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.done_path, 'a', encoding='utf-8') as f:
+            f.write(noun + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.completed.add(noun)
+
+    def read(self):
+        # Read all rows back in one pass, keeping every value as a string (e.g., "-" or "None")
+        return pd.read_csv(self.path, sep='\t', encoding='utf-8', dtype=str, keep_default_na=False)
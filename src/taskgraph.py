@@ -0,0 +1,139 @@
+from concurrent.futures import Future
+import contextvars
+import threading
+import time
+
+_CURRENT_TASK = threading.local()
+
+
+class TaskGraph:
+    # Runs a graph of dependent tasks on an executor: each task starts as soon as
+    # the tasks it depends on have finished, so independent questions are asked at the same time.
+    # A running task may add new tasks, e.g., one task per subtype once the subtypes are known;
+    # such tasks implicitly depend on the task that added them.
+    def __init__(self, executor):
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.tasks = dict()  # name -> {'func', 'deps', 'waiting', 'dependents', 'future', 'start', 'end'}
+        self.unfinished = 0
+        self.done = threading.Event()
+        self.done.set()
+        self.error = None
+
+    def add(self, name, func, *args, deps=()):
+        # ``func(*args)`` runs with the results of ``deps`` available through ``result``
+        parent = getattr(_CURRENT_TASK, 'name', None)
+        deps = list(deps) + ([parent] if parent in self.tasks else [])
+        context = contextvars.copy_context()  # e.g., keep the noun's cache scope
+        with self.lock:
+            if name in self.tasks:
+                raise ValueError(f"Task {name} already exists.")
+            task = {'func': func, 'args': args, 'deps': deps, 'context': context, 'failed': False,
+                    'waiting': set(), 'dependents': list(), 'future': Future(), 'start': None, 'end': None}
+            for dep in deps:
+                if dep not in self.tasks:
+                    raise ValueError(f"Task {name} depends on an unknown task {dep}.")
+                if not self.tasks[dep]['future'].done():
+                    task['waiting'].add(dep)
+                    self.tasks[dep]['dependents'].append(name)
+            self.tasks[name] = task
+            self.unfinished += 1
+            self.done.clear()
+            ready = not task['waiting']
+        if ready and any(self.tasks[dep]['failed'] for dep in deps):
+            self.cancel(name)
+        elif ready:
+            self.submit(name)
+        return name
+
+    def submit(self, name):
+        task = self.tasks[name]
+        self.executor.submit(task['context'].run, self.execute, name)
+
+    def execute(self, name):
+        task = self.tasks[name]
+        _CURRENT_TASK.name = name
+        task['start'] = time.time()
+        try:
+            result = task['func'](*task['args'])
+        except BaseException as error:
+            result = None
+            task['failed'] = True
+            with self.lock:
+                if self.error is None:
+                    self.error = error
+        finally:
+            task['end'] = time.time()
+            _CURRENT_TASK.name = None
+        task['future'].set_result(result)
+
+        ready = list()
+        with self.lock:
+            for dependent in task['dependents']:
+                self.tasks[dependent]['waiting'].discard(name)
+                if not self.tasks[dependent]['waiting']:
+                    ready.append(dependent)
+            self.unfinished -= 1
+            if self.unfinished == 0:
+                self.done.set()
+        for dependent in ready:
+            if any(self.tasks[dep]['failed'] for dep in self.tasks[dependent]['deps']):
+                self.cancel(dependent)
+            else:
+                self.submit(dependent)
+
+    def cancel(self, name):
+        # Skip the tasks that depend on a failed one; the other tasks still run,
+        # e.g., to plan every request that can be made without the failed answer
+        task = self.tasks[name]
+        task['failed'] = True
+        task['start'] = task['end'] = time.time()
+        task['future'].set_result(None)
+        ready = list()
+        with self.lock:
+            for dependent in task['dependents']:
+                self.tasks[dependent]['waiting'].discard(name)
+                if not self.tasks[dependent]['waiting']:
+                    ready.append(dependent)
+            self.unfinished -= 1
+            if self.unfinished == 0:
+                self.done.set()
+        for dependent in ready:
+            self.cancel(dependent)
+
+    def result(self, name):
+        return self.tasks[name]['future'].result()
+
+    def run(self):
+        # Wait until every task, including the ones added on the way, has finished
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+    def critical_path(self):
+        # The chain of dependent tasks with the longest total latency;
+        # this is the serial time left after running everything else concurrently.
+        latency = dict()
+        chain = dict()
+        for name in self.topological_order():
+            task = self.tasks[name]
+            previous = max(task['deps'], key=lambda dep: latency[dep], default=None)
+            latency[name] = task['end'] - task['start'] + (latency[previous] if previous else 0.0)
+            chain[name] = (chain[previous] if previous else []) + [name]
+        if not latency:
+            return 0.0, []
+        last = max(latency, key=latency.get)
+        return latency[last], chain[last]
+
+    def topological_order(self):
+        # Tasks can only depend on tasks added before them
+        return list(self.tasks.keys())
+
+    def report(self):
+        critical_latency, critical_chain = self.critical_path()
+        starts = [task['start'] for task in self.tasks.values()]
+        ends = [task['end'] for task in self.tasks.values()]
+        wall = max(ends) - min(starts) if starts else 0.0
+        serial = sum(task['end'] - task['start'] for task in self.tasks.values())
+        return (f"{len(self.tasks)} tasks, {wall:.1f}s wall time ({serial:.1f}s if run serially), "
+                f"critical path {critical_latency:.1f}s: {' -> '.join(critical_chain)}")
@@ -0,0 +1,236 @@
+from contextlib import contextmanager
+import argparse
+import contextvars
+import csv
+import json
+import math
+import os
+import threading
+import time
+
+# Estimated prices in USD per million prompt / completion tokens; models not listed are not priced
+MODEL_PRICES = {
+    'gpt-4-1106-preview': (10.0, 30.0),
+    'gpt-4-0613': (30.0, 60.0),
+    'gpt-4': (30.0, 60.0),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-3.5-turbo': (0.5, 1.5),
+}
+RECORD_FIELDS = ['call_site', 'scope', 'model', 'cached', 'attempts', 'retries', 'error', 'latency',
+                 'max_tokens', 'truncated', 'prompt_tokens', 'completion_tokens', 'estimated_tokens', 'cost', 'started']
+HISTOGRAM_FIELDS = {'latency', 'prompt_tokens', 'completion_tokens', 'retries', 'cost'}
+# ``suggest_max_tokens``: a call site's cap is this quantile of its completion tokens times the headroom,
+# rounded up to a multiple of the step, given at least the minimum number of requests
+MAX_TOKENS_QUANTILE = 0.99
+MAX_TOKENS_HEADROOM = 1.25
+MAX_TOKENS_STEP = 16
+MAX_TOKENS_MIN_REQUESTS = 20
+
+_CALL_SITE = contextvars.ContextVar('call_site', default='')
+
+
+@contextmanager
+def call_site(name):
+    # Tag the requests made within (e.g., ``confirm_subtype`` or "Q7"); also usable as a decorator.
+    # The innermost tag wins, so a helper asking on behalf of another step can keep its own tag.
+    token = _CALL_SITE.set(name)
+    try:
+        yield
+    finally:
+        _CALL_SITE.reset(token)
+
+
+def current_call_site():
+    return _CALL_SITE.get() or 'untagged'
+
+
+def estimate_cost(model, prompt_tokens, completion_tokens):
+    if model not in MODEL_PRICES:
+        return 0.0
+    prompt_price, completion_price = MODEL_PRICES[model]
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a sorted list
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))]
+
+
+def histogram(values, bins=10):
+    # Equal-width bins between the smallest and the largest value: [(lower edge, count), ...]
+    if not values:
+        return list()
+    low, high = min(values), max(values)
+    width = (high - low) / bins or 1.0
+    counts = [0] * bins
+    for value in values:
+        counts[min(bins - 1, int((value - low) / width))] += 1
+    return [(low + i * width, count) for i, count in enumerate(counts)]
+
+
+class Telemetry:
+    # Collects one record per request: the call site and cache scope it was made from,
+    # whether it was answered from the response cache, the number of attempts (retries
+    # after 429s, timeouts and other errors), the wall time until the response was returned,
+    # the token usage and the estimated cost.
+    # If a client reports no usage (e.g., a stand-in client), the tokens are estimated
+    # from the number of characters and ``estimated_tokens`` is set.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = list()
+
+    def start(self, call_site_name, scope, model, max_tokens=0):
+        # ``max_tokens`` as requested by the caller, before the cap of the call site
+        return {'call_site': call_site_name, 'scope': scope, 'model': model, 'cached': False,
+                'attempts': 0, 'retries': 0, 'error': '', 'latency': 0.0,
+                'max_tokens': max_tokens, 'truncated': False,
+                'prompt_tokens': 0, 'completion_tokens': 0, 'estimated_tokens': False, 'cost': 0.0,
+                'started': time.time(), '_start': time.perf_counter()}
+
+    def finish(self, record, error=None):
+        record['latency'] = time.perf_counter() - record.pop('_start')
+        record['retries'] = max(0, record['attempts'] - 1)
+        if error is not None:
+            record['error'] = type(error).__name__
+        if not record['cached']:
+            record['cost'] = estimate_cost(record['model'], record['prompt_tokens'], record['completion_tokens'])
+        with self.lock:
+            self.records.append(record)
+
+    def clear(self):
+        with self.lock:
+            self.records = list()
+
+    def export(self, path):
+        # One row per request; CSV if ``path`` ends with ".csv", JSON lines otherwise
+        if os.path.dirname(path) and not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with self.lock:
+            records = list(self.records)
+        with open(path, 'w', encoding='utf-8', newline='') as f:
+            if path.endswith('.csv'):
+                writer = csv.DictWriter(f, fieldnames=RECORD_FIELDS, delimiter=',', lineterminator='\n')
+                writer.writeheader()
+                writer.writerows(records)
+            else:
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+        return len(records)
+
+    def summary(self):
+        with self.lock:
+            records = list(self.records)
+        return summarize(records)
+
+
+def summarize(records):
+    # A table per call site, the most expensive first
+    if not records:
+        return "Telemetry: no requests."
+    by_site = dict()
+    for record in records:
+        by_site.setdefault(record['call_site'], list()).append(record)
+
+    header = (f"{'call site':<34}{'calls':>7}{'cached':>8}{'retries':>9}{'errors':>8}{'trunc':>7}"
+              f"{'p50 s':>8}{'p90 s':>8}{'p99 s':>8}{'prompt tok':>12}{'compl tok':>11}{'cost $':>10}")
+    lines = [header]
+    rows = list()
+    for site, site_records in by_site.items():
+        sent = [record for record in site_records if not record['cached']]
+        latencies = sorted(record['latency'] for record in sent)
+        rows.append((sum(record['cost'] for record in site_records),
+                     f"{site[:33]:<34}{len(site_records):>7}{len(site_records) - len(sent):>8}"
+                     f"{sum(record['retries'] for record in site_records):>9}"
+                     f"{sum(1 for record in site_records if record['error']):>8}"
+                     f"{sum(1 for record in site_records if record.get('truncated')):>7}"
+                     f"{percentile(latencies, 0.5):>8.2f}{percentile(latencies, 0.9):>8.2f}"
+                     f"{percentile(latencies, 0.99):>8.2f}"
+                     f"{sum(record['prompt_tokens'] for record in site_records):>12}"
+                     f"{sum(record['completion_tokens'] for record in site_records):>11}"
+                     f"{sum(record['cost'] for record in site_records):>10.2f}"))
+    lines += [row for _, row in sorted(rows, key=lambda row: -row[0])]
+    total_cost = sum(record['cost'] for record in records)
+    lines.append(f"Telemetry: {len(records)} requests, {sum(1 for record in records if record['cached'])} cached, "
+                 f"{sum(record['retries'] for record in records)} retries, estimated cost ${total_cost:.2f}"
+                 + (" (tokens partly estimated)" if any(record['estimated_tokens'] for record in records) else ""))
+    return "\n".join(lines)
+
+
+def suggest_max_tokens(records, quantile=MAX_TOKENS_QUANTILE, headroom=MAX_TOKENS_HEADROOM,
+                       min_requests=MAX_TOKENS_MIN_REQUESTS):
+    # {call site: cap of max_tokens} from the completion tokens of the requests sent without an error;
+    # a call site gets no cap if it has too few requests or the cap wouldn't be below what it asks for
+    by_site = dict()
+    for record in records:
+        if not record['cached'] and not record['error']:
+            by_site.setdefault(record['call_site'], list()).append(record)
+    caps = dict()
+    for site, site_records in sorted(by_site.items()):
+        if len(site_records) < min_requests:
+            continue
+        tokens = sorted(record['completion_tokens'] for record in site_records)
+        cap = max(1, math.ceil(percentile(tokens, quantile) * headroom / MAX_TOKENS_STEP)) * MAX_TOKENS_STEP
+        if cap < max(record.get('max_tokens') or math.inf for record in site_records):
+            caps[site] = cap
+    return caps
+
+
+def read_records(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            records = list(csv.DictReader(f))
+            for record in records:
+                for field in ['latency', 'cost', 'started']:
+                    record[field] = float(record[field])
+                for field in ['attempts', 'retries', 'max_tokens', 'prompt_tokens', 'completion_tokens']:
+                    if field in record:
+                        record[field] = int(record[field])
+                for field in ['cached', 'truncated', 'estimated_tokens']:
+                    if field in record:
+                        record[field] = record[field] == 'True'
+            return records
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize a metrics file written by fewshot.py or zeroshot.py')
+    parser.add_argument('metrics_file')
+    parser.add_argument('--histogram', choices=sorted(HISTOGRAM_FIELDS), default=None,
+                        help='also print a histogram of this field for every call site')
+    parser.add_argument('--bins', type=int, default=10)
+    parser.add_argument('--call-site', default=None, help='only the requests of this call site')
+    parser.add_argument('--suggest-max-tokens', metavar='CAPS_FILE', default=None,
+                        help='write caps of max_tokens per call site for ``MAX_TOKENS_FILE`` of the scripts')
+    args = parser.parse_args()
+    if args.bins < 1:
+        raise ValueError("Please specify a positive number of bins.")
+
+    records = read_records(args.metrics_file)
+    if args.call_site:
+        records = [record for record in records if record['call_site'] == args.call_site]
+    print(summarize(records))
+    if args.histogram:
+        by_site = dict()
+        for record in records:
+            if not record['cached']:
+                by_site.setdefault(record['call_site'], list()).append(record[args.histogram])
+        for site, values in sorted(by_site.items()):
+            print(f"\n{site} -- {args.histogram}")
+            bins = histogram(values, args.bins)
+            widest = max(count for _, count in bins)
+            for lower, count in bins:
+                print(f"  >= {lower:>10.3f} {count:>6} {'#' * round(40 * count / widest)}")
+    if args.suggest_max_tokens:
+        caps = suggest_max_tokens(records)
+        with open(args.suggest_max_tokens, 'w', encoding='utf-8') as f:
+            json.dump(caps, f, indent=1, sort_keys=True)
+        print(f"\nmax_tokens caps ({MAX_TOKENS_QUANTILE:.0%} of the completion tokens x {MAX_TOKENS_HEADROOM}) "
+              f"written to {args.suggest_max_tokens}:")
+        for site, cap in caps.items():
+            print(f"  {site:<34}{cap:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,105 +1,111 @@
-from qwikidata.json_dump import WikidataJsonDump
-from filelock import FileLock
-import pandas as pd
-import shutil
+from wikidump import iter_range_lines, read_line, run_ranges, RANGE_BYTES
+import pyarrow as pa
+import pyarrow.parquet as pq
+import argparse
 import sys
 import os
 
-CAP = 100000
 SAVEDIR = 'nouns/wiki-all/'
-
-
-def get_proc_num():
-    with FileLock(os.path.join('temp', 'lock')):
-        filenames = os.listdir('temp/')
-        filenames.remove('lock')
-        if len(filenames) == 0:
-            new_num = 0
-        else:
-            current_num = filenames[-1]
-            new_num = int(current_num) + CAP
-            os.remove(os.path.join('temp', current_num))
-
-        with open(os.path.join('temp', str(new_num)), 'w') as fp: pass
-
-    return new_num
+# The byte ranges of the dump done so far; a run stopped or with failed ranges is continued by running it again
+PROGRESS_FILE = os.path.join(SAVEDIR, 'progress.json')
+# Byte strings in the line of every entity ``entity_row`` keeps; the other lines are skipped without decoding them
+ENTITY_FILTER = (b'"P279"', b'"en"')
+# Columns of the Parquet shards ``data-<first byte of the range>.parquet``, one per byte range of the dump
+SHARD_SCHEMA = pa.schema([('id', pa.string()), ('label', pa.string()), ('parent', pa.list_(pa.string())),
+                          ('wikipedia', pa.string()), ('wordnet', pa.list_(pa.string())),
+                          ('synonym', pa.list_(pa.string()))])
+
+
+def write_shard(rows, start):
+    # Write the rows kept from the range starting at byte ``start`` at once; the file appears complete or not at all
+    path = os.path.join(SAVEDIR, "data-" + str(start).zfill(12) + ".parquet")
+    pq.write_table(pa.Table.from_pylist(rows, schema=SHARD_SCHEMA), path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def extract_range(wiki_compressed, start, end):
+    # Runs in a worker of ``run_ranges``: write the shard of the entities owned by bytes [start, end) of the dump
+    entities = 0
+    rows = list()
+    for line in iter_range_lines(wiki_compressed, start, end):
+        for data in read_line(line, entity_row, ENTITY_FILTER):
+            entities += 1
+            if data is not None:
+                rows.append(data)
+    write_shard(rows, start)
+    return {'entities': entities, 'rows': len(rows)}
+
+
+def entity_row(entity_dict):
+    # The data of interest of an entity with an English label that is a subclass of (P279) another entity;
+    # None otherwise. Runs in the worker processes, on the lines passing ENTITY_FILTER.
+    if 'en' not in entity_dict['labels'] or 'P279' not in entity_dict['claims'].keys():
+        return None
+    data = dict()
+    data['id'] = entity_dict['id']
+    # label
+    data['label'] = entity_dict['labels']['en']['value']
+
+    # subclass of
+    data['parent'] = list()
+    for subclass in entity_dict['claims']['P279']:
+        if 'datavalue' in subclass['mainsnak'].keys():
+            data['parent'].append(subclass['mainsnak']['datavalue']['value']['id'])
+
+    # Wikipedia
+    data['wikipedia'] = ''
+    if 'sitelinks' in entity_dict.keys() and 'enwiki' in entity_dict['sitelinks'].keys():
+        data['wikipedia'] = entity_dict['sitelinks']['enwiki']['title']
+
+    # WordNet 3.1
+    data['wordnet'] = list()
+    if 'P8814' in entity_dict['claims'].keys():
+        for mainsnak_dict in entity_dict['claims']['P8814']:
+            if 'datavalue' in mainsnak_dict['mainsnak'].keys():
+                data['wordnet'].append(mainsnak_dict['mainsnak']['datavalue']['value'])
+
+    # Exact match (WordNet 3.0 and wordNet 3.1)
+    if 'P2888' in entity_dict['claims'].keys():
+        for mainsnak_dict in entity_dict['claims']['P2888']:
+            if 'datavalue' in mainsnak_dict['mainsnak'].keys():
+                if 'http://wordnet-rdf.princeton.edu/' in mainsnak_dict['mainsnak']['datavalue']['value']:
+                    data['wordnet'].append(mainsnak_dict['mainsnak']['datavalue']['value'].split("http://wordnet-rdf.princeton.edu/")[-1])
+
+    # synonyms
+    data['synonym'] = list()
+    if 'en' in entity_dict['aliases'].keys():
+        for synonym_dict in entity_dict['aliases']['en']:
+            data['synonym'].append(synonym_dict['value'])
+    return data
 
 
 def main():
-    # Obtain a csv file with Wikidata entities
-    if len(sys.argv) < 2:
-        raise ValueError("Please specify the compressed Wikidata file."
-                         "Example: ``python3 src/wikiall.py latest-all.json.bz2``")
-    elif len(sys.argv) > 2:
-        raise ValueError('Too many arguments are given. Please specify the Wikidata file only.')
-    wiki_compressed = sys.argv[1]
-
-    # Create files for multiprocessing
-    if not os.path.exists('temp/'):
-        os.mkdir('temp/')
+    # Obtain Parquet files with Wikidata entities
+    parser = argparse.ArgumentParser(description='Extract the Wikidata entities that are subclasses of another entity.')
+    parser.add_argument('wiki_compressed', help='compressed Wikidata dump, e.g., latest-all.json.bz2')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='processes extracting byte ranges of the dump at once (default 0: all cores)')
+    parser.add_argument('--range-mb', type=int, default=RANGE_BYTES >> 20,
+                        help='megabytes of the compressed dump per range (default %(default)s)')
+    args = parser.parse_args()
+    if args.range_mb < 1:
+        parser.error(f"--range-mb must be at least 1, not {args.range_mb}")
+    wiki_compressed = args.wiki_compressed
+
     if not os.path.exists(SAVEDIR):
         os.makedirs(SAVEDIR)
-    with open(os.path.join('temp', 'lock'), 'w') as fp: pass
 
     # Run
-    wjd = WikidataJsonDump(wiki_compressed)
-
-    proc_num = get_proc_num()
-    df = pd.DataFrame(columns=['id', 'label', 'parent', 'wikipedia', 'wordnet', 'synonym'])
-    df.to_csv(os.path.join(SAVEDIR, "data-" + str(proc_num) + ".csv"), index=False)
-
     print(f'Extracting data into the ``{SAVEDIR}`` folder...')
-    for ii, entity_dict in enumerate(wjd):
-        if ii < proc_num:
-            continue
-
-        data = dict()
-        data['id'] = entity_dict['id']
-        if 'en' in entity_dict['labels'] and 'P279' in entity_dict['claims'].keys():
-            # label
-            data['label'] = entity_dict['labels']['en']['value']
-
-            # subclass of
-            data['parent'] = list()
-            for subclass in entity_dict['claims']['P279']:
-                if 'datavalue' in subclass['mainsnak'].keys():
-                    data['parent'].append(subclass['mainsnak']['datavalue']['value']['id'])
-
-            # Wikipedia
-            data['wikipedia'] = ''
-            if 'sitelinks' in entity_dict.keys() and 'enwiki' in entity_dict['sitelinks'].keys():
-                data['wikipedia'] = entity_dict['sitelinks']['enwiki']['title']
-
-            # WordNet 3.1
-            data['wordnet'] = list()
-            if 'P8814' in entity_dict['claims'].keys():
-                for mainsnak_dict in entity_dict['claims']['P8814']:
-                    if 'datavalue' in mainsnak_dict['mainsnak'].keys():
-                        data['wordnet'].append(mainsnak_dict['mainsnak']['datavalue']['value'])
-
-            # Exact match (WordNet 3.0 and wordNet 3.1)
-            if 'P2888' in entity_dict['claims'].keys():
-                for mainsnak_dict in entity_dict['claims']['P2888']:
-                    if 'datavalue' in mainsnak_dict['mainsnak'].keys():
-                        if 'http://wordnet-rdf.princeton.edu/' in mainsnak_dict['mainsnak']['datavalue']['value']:
-                            data['wordnet'].append(mainsnak_dict['mainsnak']['datavalue']['value'].split("http://wordnet-rdf.princeton.edu/")[-1])
-
-            # synonyms
-            data['synonym'] = list()
-            if 'en' in entity_dict['aliases'].keys():
-                for synonym_dict in entity_dict['aliases']['en']:
-                    data['synonym'].append(synonym_dict['value'])
-
-            df = pd.DataFrame([data], columns=data.keys())
-            df.to_csv(os.path.join(SAVEDIR, "data-" + str(proc_num) + ".csv"), mode='a', header=False, index=False)
-
-        if ii == proc_num + CAP - 1:
-            proc_num = get_proc_num()
-            df = pd.DataFrame(columns=['id', 'label', 'parent', 'wikipedia', 'wordnet', 'synonym'])
-            df.to_csv(os.path.join(SAVEDIR, "data-" + str(proc_num) + ".csv"), index=False)
-
-    shutil.rmtree('temp/')
+    progress = run_ranges(wiki_compressed, extract_range, PROGRESS_FILE, workers=args.workers or None,
+                          range_bytes=args.range_mb << 20)
+    done = progress.state['done'].values()
+    print(f"{sum(range_done['result']['entities'] for range_done in done):,} entities read, "
+          f"{sum(range_done['result']['rows'] for range_done in done):,} kept.")
+    if progress.state['failed']:
+        sys.exit(f"{len(progress.state['failed'])} ranges failed (see {PROGRESS_FILE}); "
+                 f"run the same command again to extract them.")
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,271 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import bz2
+import gzip
+import json
+import os
+import time
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Reads the entities of a Wikidata JSON dump (one entity per line between "[" and "]") with several processes.
+# A bz2 file is a series of independently compressed blocks, each starting with a 48-bit magic number
+# at any bit offset. The blocks are found by scanning for the magic number, and every worker decompresses
+# whole blocks on its own by wrapping a block in a stream header and trailer of its own.
+# ``run_ranges`` splits the dump into byte ranges processed independently by a pool of workers:
+# a range owns the lines after the newlines of the blocks starting within it, so no range needs another one.
+# Lines without all of the ``required`` byte strings (e.g., b'"P279"') are rejected without decoding them,
+# which skips most of the dump; the others are decoded with orjson when it is installed.
+
+BLOCK_MAGIC = 0x314159265359  # start of a compressed block (pi)
+STREAM_END_MAGIC = 0x177245385090  # end of a stream (sqrt(pi)), followed by the CRC of the stream
+# Next boundaries a block may end at: the magic number can also appear by chance inside a block,
+# in which case the block doesn't decompress up to that boundary, and the one after is tried
+LOOKAHEAD = 4
+RANGE_BYTES = 1 << 28  # bytes of the compressed file per range of ``run_ranges``
+TAIL_BYTES = 1 << 21  # bytes scanned at a time past the end of a range, for the end of its last block and line
+RANGE_RETRIES = 2  # times a failed range is run again within ``run_ranges``
+loads = orjson.loads if orjson else json.loads
+
+
+def _magic_patterns(magic):
+    # (bit offset within the first byte, the bytes that are fully covered by the magic number at that offset)
+    patterns = list()
+    for shift in range(8):
+        size = (shift + 48 + 7) // 8
+        value = (magic << (size * 8 - shift - 48)).to_bytes(size, 'big')
+        trailing = size * 8 - shift - 48
+        patterns.append((shift, value[1 if shift else 0:size - 1 if trailing else size]))
+    return patterns
+
+
+_PATTERNS = [(kind, shift, pattern) for kind, magic in [('block', BLOCK_MAGIC), ('end', STREAM_END_MAGIC)]
+             for shift, pattern in _magic_patterns(magic)]
+
+
+def read_bits(data, bit_offset, bits):
+    # The ``bits`` bits of ``data`` starting at ``bit_offset``, as an integer
+    first, last = bit_offset // 8, (bit_offset + bits + 7) // 8
+    value = int.from_bytes(data[first:last], 'big')
+    return (value >> (last * 8 - bit_offset - bits)) & ((1 << bits) - 1)
+
+
+def scan_markers(path, start, end):
+    # [(bit offset, 'block' or 'end')] of the magic numbers starting within bytes [start, end) of the file
+    with open(path, 'rb') as f:
+        f.seek(max(0, start - 1))
+        data = f.read(end - max(0, start - 1) + 7)
+    base = max(0, start - 1)
+    markers = set()
+    for kind, shift, pattern in _PATTERNS:
+        magic = BLOCK_MAGIC if kind == 'block' else STREAM_END_MAGIC
+        position = data.find(pattern)
+        while position >= 0:
+            bit_offset = (position - (1 if shift else 0)) * 8 + shift
+            if bit_offset >= 0 and start * 8 <= base * 8 + bit_offset < end * 8 and \
+                    bit_offset + 48 <= len(data) * 8 and read_bits(data, bit_offset, 48) == magic:
+                markers.add((base * 8 + bit_offset, kind))
+            position = data.find(pattern, position + 1)
+    return sorted(markers)
+
+
+def decompress_block(path, start, ends):
+    # Decompress the block starting at bit ``start`` and ending at the first of ``ends`` it decompresses up to;
+    # None if it doesn't (i.e., ``start`` is a magic number by chance inside another block)
+    shift = start % 8
+    with open(path, 'rb') as f:
+        f.seek(start // 8)
+        data = b''
+        for end in ends:
+            # read up to the next candidate end only when the block didn't decompress up to the one before
+            data += f.read((end + 7) // 8 - start // 8 - len(data))
+            result = _decompress_to(data, shift, end - start)
+            if result is not None:
+                return result
+    return None
+
+
+def _decompress_to(data, shift, bits):
+    # The block of ``bits`` bits starting at bit ``shift`` of ``data`` decompressed, or None if it isn't a block
+    if len(data) * 8 < shift + bits:
+        return None
+    crc = read_bits(data, shift + 48, 32)
+    block = read_bits(data, shift, bits)
+    # a stream with this block only; the CRC of a one-block stream is the CRC of its block
+    trailer_bits = bits + 48 + 32
+    padding = -trailer_bits % 8
+    stream = ((block << 80 | STREAM_END_MAGIC << 32 | crc) << padding).to_bytes((trailer_bits + padding) // 8, 'big')
+    try:
+        return bz2.decompress(b'BZh9' + stream)
+    except (OSError, ValueError, EOFError):
+        return None
+
+
+def read_line(line, transform=None, required=()):
+    # [transform(entity)] (or [entity]) for a line of the dump, [None] for an entity rejected by ``required``
+    # and [] for the brackets around the entities
+    if len(line) < 4 and line.strip() in (b'', b'[', b']'):
+        return list()
+    for substring in required:
+        if substring not in line:
+            return [None]
+    entity = loads(line.rstrip().rstrip(b','))
+    return [transform(entity) if transform else entity]
+
+
+def read_lines(path):
+    # The lines of a dump read in this process: ".bz2", ".gz" or uncompressed
+    opener = bz2.open if path.endswith('.bz2') else gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        yield from f
+
+
+def iter_range_blocks(path, start, end):
+    # (whether the block starts within bytes [start, end), decompressed block) for the blocks of a bz2 file
+    # from the first one starting within the range on; the caller stops when it doesn't need more
+    size = os.path.getsize(path)
+    markers = scan_markers(path, start, end)
+    scanned = end
+    i = 0
+    while True:
+        while len(markers) - i <= LOOKAHEAD and scanned < size:
+            markers += scan_markers(path, scanned, min(scanned + TAIL_BYTES, size))
+            scanned = min(scanned + TAIL_BYTES, size)
+        if i >= len(markers):
+            return
+        bit, kind = markers[i]
+        ends = [offset for offset, _ in markers[i + 1:i + 1 + LOOKAHEAD]]
+        i += 1
+        if kind == 'block' and ends:
+            data = decompress_block(path, bit, ends)
+            if data is not None:
+                yield bit < end * 8, data
+
+
+def iter_range_lines(path, start, end):
+    # The lines of a dump owned by bytes [start, end): the lines after the newlines of the bz2 blocks starting
+    # within the range, plus the first line of the dump for the range starting at 0.
+    # A dump that isn't bz2 compressed can only be read as one range.
+    if not path.endswith('.bz2'):
+        if start != 0 or end < os.path.getsize(path):
+            raise ValueError(f"Only bz2 compressed dumps can be split into ranges: {path}")
+        for line in read_lines(path):
+            yield line.rstrip(b'\n')
+        return
+    pending = b'' if start == 0 else None  # None until the first newline of the range
+    for owned, data in iter_range_blocks(path, start, end):
+        if not owned:
+            # a block of the next range, read for the end of the last line
+            if pending is None:
+                return
+            newline = data.find(b'\n')
+            if newline < 0:
+                pending += data
+                continue
+            yield pending + data[:newline]
+            return
+        parts = data.split(b'\n')
+        if pending is None:
+            if len(parts) == 1:
+                continue
+            # the end of a line owned by the range before
+            del parts[0]
+            pending = b''
+        parts[0] = pending + parts[0]
+        pending = parts.pop()
+        yield from parts
+    if pending:
+        yield pending
+
+
+class RangeProgress:
+    # The ranges of a dump done so far, kept in a JSON file so that a run can be stopped and started again:
+    # {"dump": ..., "size": ..., "range_bytes": ..., "done": {start: {...}}, "failed": {start: error}}
+    def __init__(self, progress_file, path, range_bytes):
+        self.progress_file = progress_file
+        self.state = {'dump': os.path.basename(path), 'size': os.path.getsize(path), 'range_bytes': range_bytes,
+                      'done': dict(), 'failed': dict()}
+        if os.path.exists(progress_file):
+            with open(progress_file, encoding='utf-8') as f:
+                state = json.load(f)
+            if [state[key] for key in ['dump', 'size', 'range_bytes']] != \
+                    [self.state[key] for key in ['dump', 'size', 'range_bytes']]:
+                raise ValueError(f"{progress_file} belongs to another dump or range size; "
+                                 f"remove it (and the files written for it) to start over.")
+            self.state = state
+
+    def ranges(self):
+        # [(start, end)] of all ranges of the dump
+        size, range_bytes = self.state['size'], self.state['range_bytes']
+        if not self.state['dump'].endswith('.bz2'):
+            return [(0, size)]
+        return [(start, min(start + range_bytes, size)) for start in range(0, size, range_bytes)]
+
+    def pending(self):
+        return [(start, end) for start, end in self.ranges() if str(start) not in self.state['done']]
+
+    def done(self, start, result):
+        self.state['done'][str(start)] = result
+        self.state['failed'].pop(str(start), None)
+        self.save()
+
+    def failed(self, start, error):
+        self.state['failed'][str(start)] = f"{type(error).__name__}: {error}"
+        self.save()
+
+    def save(self):
+        if os.path.dirname(self.progress_file) and not os.path.exists(os.path.dirname(self.progress_file)):
+            os.makedirs(os.path.dirname(self.progress_file))
+        with open(self.progress_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.state, f, indent=1)
+        os.replace(self.progress_file + '.tmp', self.progress_file)
+
+
+def run_ranges(path, task, progress_file, workers=None, range_bytes=RANGE_BYTES, retries=RANGE_RETRIES):
+    # Run ``task(path, start, end)`` for every byte range of the dump not done yet according to ``progress_file``,
+    # in ``workers`` processes (default: all cores). ``task`` must be a module-level function writing its own
+    # output, so that a range done is never run again, and return a JSON-serializable summary of the range.
+    # A range raising an exception is run again up to ``retries`` times; if it still fails, it is recorded as
+    # failed and run again by the next run. A worker dying (e.g., killed for lack of memory) breaks the whole pool:
+    # all the ranges not finished then count as failed, and the ones left to retry are run in a new pool.
+    # Returns the ``RangeProgress``.
+    progress = RangeProgress(progress_file, path, range_bytes)
+    pending = progress.pending()
+    total = len(progress.ranges())
+    print(f"{total - len(pending)}/{total} ranges of {path} done before, {len(pending)} to go")
+    workers = workers or os.cpu_count()
+    attempts = dict()
+
+    def retry(start, end, error):
+        # Record a failed attempt of a range; True if the range is to be run again in this run
+        attempts[start] = attempts.get(start, 0) + 1
+        progress.failed(start, error)
+        if attempts[start] <= retries:
+            print(f"Range {start}-{end} failed ({error}), running it again")
+            return True
+        print(f"Range {start}-{end} failed ({error}); it is run again by the next run")
+        return False
+
+    while pending:
+        with ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            started = {executor.submit(task, path, start, end): (start, end, time.time()) for start, end in pending}
+            pending = list()
+            while started:
+                for future in as_completed(list(started)):
+                    start, end, began = started.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool as error:
+                        unfinished = [(start, end)] + [(start, end) for start, end, _ in started.values()]
+                        pending = [(start, end) for start, end in unfinished if retry(start, end, error)]
+                        started = dict()
+                        break
+                    except Exception as error:
+                        if retry(start, end, error):
+                            started[executor.submit(task, path, start, end)] = (start, end, time.time())
+                        continue
+                    progress.done(start, {'end': end, 'seconds': round(time.time() - began, 1), 'result': result})
+                    print(f"{len(progress.state['done'])}/{total} ranges done")
+    return progress
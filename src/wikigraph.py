@@ -0,0 +1,161 @@
+from os import listdir
+from os.path import isfile, join
+import json
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# The "subclass of" (P279) graph of the entities extracted by wikiall.py, with integer nodes in CSR form:
+# the parents of node i are ``targets[offsets[i]:offsets[i + 1]]``. Node i is the entity ``keys[i]``,
+# an entity ID such as "Q42" stored as an integer (see ``entity_key``); the keys are sorted, so the node
+# of an entity is found by binary search. The arrays are saved as .npy files and memory-mapped when loaded,
+# so loading the graph again takes no time; it is built again when the Parquet shards change.
+# ``descendant_flags`` marks the nodes under given roots with a breadth-first search down from the roots,
+# one pass over the graph per group of roots instead of a search up from every entity.
+
+GRAPH_FILES = ['keys', 'offsets', 'targets']
+PREFIXES = 'QPL'  # items, properties and lexemes; the key of "Q42" is 42 * len(PREFIXES) + 0
+
+
+def entity_key(entity_id):
+    if not entity_id or entity_id[0] not in PREFIXES or not entity_id[1:].isdigit():
+        raise ValueError(f"Not a Wikidata entity ID: {entity_id!r}")
+    return int(entity_id[1:]) * len(PREFIXES) + PREFIXES.index(entity_id[0])
+
+
+def entity_id(key):
+    return PREFIXES[key % len(PREFIXES)] + str(key // len(PREFIXES))
+
+
+def entity_keys(ids):
+    # ``entity_key`` of every string of an Arrow array, without converting them to Python strings
+    if len(ids) == 0:
+        return np.zeros(0, dtype=np.int64)
+    prefixes = pc.utf8_slice_codeunits(ids, 0, 1)
+    numbers = pc.utf8_slice_codeunits(ids, 1)
+    valid = pc.and_(pc.is_in(prefixes, value_set=pa.array(list(PREFIXES))),
+                    pc.match_substring_regex(numbers, r'^\d+$'))
+    if not pc.all(valid).as_py():
+        raise ValueError(f"Not a Wikidata entity ID: {ids.filter(pc.invert(valid))[0]!r}")
+    prefix_index = np.zeros(len(ids), dtype=np.int64)
+    for index, prefix in enumerate(PREFIXES):
+        prefix_index[pc.equal(prefixes, prefix).to_numpy(zero_copy_only=False)] = index
+    return pc.cast(numbers, pa.int64()).to_numpy() * len(PREFIXES) + prefix_index
+
+
+class SubclassGraph:
+    def __init__(self, keys, offsets, targets):
+        self.keys = keys
+        self.offsets = offsets
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.keys)
+
+    def node(self, wiki_id):
+        # The node of an entity, or -1 if it is neither extracted nor the parent of an extracted entity
+        try:
+            key = entity_key(wiki_id)
+        except ValueError:
+            return -1
+        index = int(np.searchsorted(self.keys, key))
+        return index if index < len(self.keys) and self.keys[index] == key else -1
+
+    def parent_nodes(self, node):
+        return self.targets[self.offsets[node]:self.offsets[node + 1]]
+
+    def parents(self, wiki_id):
+        # The parents of an entity, in the order of its P279 claims; [] for an unknown entity
+        node = self.node(wiki_id)
+        if node < 0:
+            return list()
+        return [entity_id(int(key)) for key in self.keys[self.parent_nodes(node)]]
+
+    def children(self):
+        # The reversed graph: (offsets, targets) of the children of every node, in CSR form as well
+        order = np.argsort(self.targets, kind='stable')
+        edge_children = np.repeat(np.arange(len(self.keys), dtype=np.int32), np.diff(self.offsets))
+        offsets = np.zeros(len(self.keys) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.targets, minlength=len(self.keys)), out=offsets[1:])
+        return offsets, edge_children[order]
+
+    def descendant_flags(self, root_groups):
+        # Bit i of the flags of a node is set if the node is under (a subclass of, at any depth) one of the
+        # entities of ``root_groups[i]``; a root itself only if it is under another root of its group or in a cycle
+        if len(root_groups) > 64:
+            raise ValueError(f"At most 64 groups of roots fit into the flags, not {len(root_groups)}.")
+        offsets, targets = self.children()
+        flags = np.zeros(len(self.keys), dtype=np.uint64)
+        for bit, roots in enumerate(root_groups):
+            under = np.zeros(len(self.keys), dtype=bool)
+            frontier = np.array([node for node in map(self.node, roots) if node >= 0], dtype=np.int64)
+            while len(frontier):
+                frontier = np.unique(gather(offsets, targets, frontier))
+                frontier = frontier[~under[frontier]]
+                under[frontier] = True
+            flags[under] |= np.uint64(1 << bit)
+        return flags
+
+    def save(self, graph_dir, fingerprint):
+        if not os.path.exists(graph_dir):
+            os.makedirs(graph_dir)
+        for name in GRAPH_FILES:
+            np.save(join(graph_dir, name + '.npy'), getattr(self, name))
+        # written last, so a graph interrupted while being saved is built again
+        with open(join(graph_dir, 'source.json'), 'w', encoding='utf-8') as f:
+            json.dump(fingerprint, f)
+
+    @classmethod
+    def load(cls, graph_dir):
+        return cls(*[np.load(join(graph_dir, name + '.npy'), mmap_mode='r') for name in GRAPH_FILES])
+
+
+def gather(offsets, targets, nodes):
+    # The targets of all ``nodes`` of a CSR graph, i.e., targets[offsets[node]:offsets[node + 1]] concatenated
+    starts = offsets[nodes]
+    lengths = offsets[nodes + 1] - starts
+    ends = np.cumsum(lengths)
+    return targets[np.arange(ends[-1] if len(ends) else 0) + np.repeat(starts - ends + lengths, lengths)]
+
+
+def shard_fingerprint(shard_dir):
+    # (name, size, modification time) of the Parquet shards the graph is built from
+    return [[f, os.path.getsize(join(shard_dir, f)), os.path.getmtime(join(shard_dir, f))]
+            for f in sorted(listdir(shard_dir)) if isfile(join(shard_dir, f)) and f.endswith('.parquet')]
+
+
+def build_graph(shard_dir):
+    # The graph of the ``id`` and ``parent`` columns of the shards
+    tables = [pq.read_table(join(shard_dir, f), columns=['id', 'parent']) for f, _, _ in shard_fingerprint(shard_dir)]
+    if not tables or not sum(table.num_rows for table in tables):
+        return SubclassGraph(np.zeros(0, np.int64), np.zeros(1, np.int64), np.zeros(0, np.int32))
+    table = pa.concat_tables(tables).combine_chunks()
+    child_keys = entity_keys(table.column('id').chunk(0))
+    parents = table.column('parent').chunk(0)
+    # the parents of all rows as one array, and the number of parents of each row
+    parent_keys = entity_keys(parents.flatten())
+    counts = pc.fill_null(pc.list_value_length(parents), 0).to_numpy()
+
+    keys = np.unique(np.concatenate([child_keys, parent_keys]))
+    children = np.repeat(np.searchsorted(keys, child_keys), counts)
+    targets = np.searchsorted(keys, parent_keys).astype(np.int32)
+    order = np.argsort(children, kind='stable')
+    offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(children, minlength=len(keys)), out=offsets[1:])
+    return SubclassGraph(keys, offsets, targets[order])
+
+
+def load_graph(shard_dir, graph_dir):
+    # The graph saved in ``graph_dir``, built again (and saved) if the shards in ``shard_dir`` changed since
+    fingerprint = shard_fingerprint(shard_dir)
+    source_file = join(graph_dir, 'source.json')
+    if os.path.exists(source_file):
+        with open(source_file, encoding='utf-8') as f:
+            if json.load(f) == fingerprint:
+                return SubclassGraph.load(graph_dir)
+        os.remove(source_file)
+    graph = build_graph(shard_dir)
+    graph.save(graph_dir, fingerprint)
+    return SubclassGraph.load(graph_dir)
@@ -1,13 +1,21 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 import copy
 import inflect
 import io
 import os
 from openai import OpenAI
-import pandas as pd
 from pathlib import Path
 import re
 from nltk.stem import WordNetLemmatizer
+from batch import ingest_results, plan_summary
+from budget import BUDGET_LOG, BudgetExhausted, loop_budget, noun_budget
+from cache import PendingRequest, cache_scope
+from clean import clean_in_chunks
 from prompt import *
+from results import ResultWriter
+from taskgraph import TaskGraph
+from telemetry import call_site
 
 INFLECT_ENGINE = inflect.engine()
 WNL = WordNetLemmatizer()
@@ -25,10 +33,23 @@ if not Path(RESULT_FOLDER).exists():
 LOG_FILE = RESULT_FOLDER+'log/zero_log.txt'
 RESULT_FILE = RESULT_FOLDER+'csv/zero_interm_result.csv'
 CLEAN_RESULT_FILE = RESULT_FOLDER+'csv/zero_result.csv'
+CACHE_FILE = RESULT_FOLDER+'cache/zero_cache.sqlite'
+VERDICT_FILE = RESULT_FOLDER+'cache/zero_verdicts.json'  # subtype confirmations; None for one run only
+METRICS_FILE = RESULT_FOLDER+'log/zero_metrics.jsonl'  # one line per request; ".csv" for CSV
+BUDGET_FILE = RESULT_FOLDER+'log/zero_budget.jsonl'  # nouns skipped and retry loops stopped by their limits
+# caps of max_tokens per call site, written by ``python3 src/telemetry.py METRICS_FILE --suggest-max-tokens``
+MAX_TOKENS_FILE = RESULT_FOLDER+'log/zero_max_tokens.json'
+CACHE_MODE = 'read-through'  # 'read-through', 'replay' or 'bypass'
 MAX_TOKENS = 1024
+HAS_TYPES_VOTES = 3  # samples in the majority vote of Questions 1 and 3
+# Ask for a majority of the votes first and for the rest only if they disagree;
+# saves completion tokens on agreement at the cost of a second round trip on disagreement
+HAS_TYPES_EARLY_EXIT = False
 MODEL = "gpt-4-1106-preview"
 OPENAI_API_KEY = '[API_KEY]'
-CLIENT = OpenAI(api_key=OPENAI_API_KEY)
+# e.g., "http://127.0.0.1:8000/v1" for the mock server in src/mockserver.py; None for the OpenAI API
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL')
+CLIENT = OpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL)
 
 def find_plural(word):
     # check whether the word is plural or singular
@@ -93,24 +114,32 @@ def prompt_response(message, max_tokens, model, client=CLIENT):
     return receive_response(message, max_tokens, model, client)
 
 
-def q_has_types(item, max_tokens=MAX_TOKENS, model=MODEL):
+@call_site('q_has_types')
+def q_has_types(item, max_tokens=MAX_TOKENS, model=MODEL, votes=None, early_exit=None, client=CLIENT):
     question = f'Are there any essential, non-optional parts\n1) that are present in one type of {item} but absent in another and\n2) that would be recognized by most people?\nSimply say "yes" or "no".'
+    votes = votes or HAS_TYPES_VOTES
+    early_exit = HAS_TYPES_EARLY_EXIT if early_exit is None else early_exit
 
-    # ask for three times and return the most frequent answer
+    # sample the answer several times in one request and return the most frequent answer
     res = {'yes': 0, 'no': 0}
-    for i in range(3):
-        response = prompt_response(question, max_tokens, model)
-        if 'yes' not in response.lower():
-            res['no'] += 1
-        else:
-            res['yes'] += 1
-        # same answers in the first two times
-        if i == 1 and min(res.values()) == 0:
-            return max(res, key=res.get)
+    majority = votes // 2 + 1
+    rounds = [majority, votes - majority] if early_exit else [votes]
+    for samples in rounds:
+        if samples == 0:
+            break
+        for response in sample_responses(question, max_tokens, model, client, samples):
+            if 'yes' not in response.lower():
+                res['no'] += 1
+            else:
+                res['yes'] += 1
+        # the first answers already agree
+        if max(res.values()) >= majority:
+            break
 
     return max(res, key=res.get)
 
 
+@call_site('q_list_types')
 def q_list_types(quoted_item, max_tokens=MAX_TOKENS, model=MODEL):
     question = f"In numbered points, please simply list physically distinct types of {quoted_item}, where each type is distinguished by unique, externally visible, essential parts.\n\nExclude any categories that share the same essential external components and functions. The listed categories should reflect differences in their primary operation rather than just external design variations or connections.\n\nAlso, avoid from your list any categories that merely represent design variations, subtypes, or alternate names for the same tool. Format each entry as a complete noun without using 'traditional', 'and', 'or', nouns indicating materials, or any prepositional phrases such as 'with' in the names."
     response = prompt_response(question, max_tokens, model)
@@ -119,33 +148,39 @@ def q_list_types(quoted_item, max_tokens=MAX_TOKENS, model=MODEL):
     return response
 
 
+@call_site('q_likely_types')
 def q_likely_types(item, type_list, max_tokens=MAX_TOKENS, model=MODEL):
     question = f'How likely would the following types of {item} be recognized by most people? Add " - [likely / probably likely / probably unlikely / unlikely] recognized by most people" after the nouns in the list. Please do not alter the names within parentheses.\n\n{type_list}'
     return prompt_response(question, max_tokens, model)
 
 
+@call_site('Q4 q_distinct_parts')
 def q_distinct_parts(item, max_tokens=MAX_TOKENS, model=MODEL):
     question = f'How many parts does {item} have? Specifically, how many clearly distinct parts that are attached to it or inseparable from it? Please simply say the number of parts.'
     return prompt_response(question, max_tokens, model)
 
 
+@call_site('Q5 q_item_materials')
 def q_item_materials(item, max_tokens=MAX_TOKENS, model=MODEL):
     question = f'In one line, please list solely the types of materials that {item} are typically made of. Avoid using "sometimes", and connect the materials with a conjunction, e.g., \'glass, plastic, and/or metal\'. Exclude any materials used for joining, stitching or dying.\n\nHere are the conjunctions you can use:\n- "and": all listed materials are typically used together\n- "or": each of the materials from the list is used exclusively\n- "and/or": some of the listed materials are typically used in combination.'
     response = prompt_response(question, max_tokens, model)
     return response
 
 
+@call_site('Q6 q_same_materials')
 def q_same_materials(item, max_tokens=MAX_TOKENS, model=MODEL):
     question = f'Are distinct parts of {item} made of the same materials? Say "yes" or "no".'
     return prompt_response(question, max_tokens, model)
 
 
+@call_site('Q7 q_parts_materials')
 def q_parts_materials(article_item, max_tokens=MAX_TOKENS, model=MODEL):
     article, item = article_item
     question = f'1) Starting your paragraph with "<Parts>\\n", in numbered points, please list clearly distinct, essential parts of {article}{item} with succinct descriptions followed by ":". For each part, insert a new line that starts with "- Optional:". Answer with "yes" or "no".\n\n2) Starting your paragraph with "<Materials>: ", in new bullet points, please list solely the materials that {article}typical {item} is entirely made of. Avoid using "sometimes", and connect the materials with a conjunction, e.g., \'<Materials>: glass, plastic, and/or metal\'. Exclude any materials used for joining, stitching or dying. Here are the conjunctions you can use.\n- "and": all listed materials are typically used together\n- "or": each of the materials from the list is used exclusively\n- "and/or": some of the listed materials are typically used in combination.\n\nKeep your answers very simple, in terms a second-grader would understand.'
     return ask_multiple_times(question, max_tokens, model)
 
 
+@call_site('Q8 q_different_parts_materials')
 def q_different_parts_materials(item, max_tokens=MAX_TOKENS, model=MODEL):
     question = f'In numbered points, please list the clearly distinct, essential parts of {item} that are attached to it or inseparable from it, with succinct descriptions following ":". Things that have multiple independent uses, such as \'battery\', don\'t count as a part. You may use "internal mechanism" as a part for anything that is not visible from the outside.\n\nFor each part, insert a new line that starts with "- Optional:". Answer with "yes" or "no".\n\nThen again, for each part, insert a new line that starts with "- Materials:" and mention the materials the part is typically made of. List the materials, avoiding using "sometimes", and connect the materials with a conjunction, e.g., \'- Materials: glass, plastic, and/or metal\'. Here are the conjunctions you can use.\n- "and": all listed materials are typically used together\n- "or": each of the materials from the list is used exclusively\n- "and/or": some of the listed materials are typically used in combination.\n\nKeep your answers very simple, in terms a second-grader would understand.'
     return ask_multiple_times(question, max_tokens, model)
@@ -170,92 +205,119 @@ def ask_multiple_times(question, max_tokens, model):
 
     # to avoid 'additional', 'various', 'mechanism', 'system' in parts' names
     problem_prompt = get_problem_prompt(response)
-    while problem_prompt:
-        message_list = [{"role": "user", "content": question},
-                        {"role": "assistant", "content": response},
-                        {"role": "user", "content":
-                            problem_prompt + "\n\n" + question.split("materials with a conjunction", 1)[0]
-                            + "materials with a conjunction."}]
-        response = prompt_response(message_list, max_tokens, model)
-        problem_prompt = get_problem_prompt(response)
+    # out of budget, the last response is kept as it is
+    with loop_budget('problem_parts') as budget:
+        while problem_prompt and budget.next_round():
+            message_list = [{"role": "user", "content": question},
+                            {"role": "assistant", "content": response},
+                            {"role": "user", "content":
+                                problem_prompt + "\n\n" + question.split("materials with a conjunction", 1)[0]
+                                + "materials with a conjunction."}]
+            response = prompt_response(message_list, max_tokens, model)
+            problem_prompt = get_problem_prompt(response)
 
     return response
 
 
-def extract_subtypes(supertype, max_tokens=MAX_TOKENS, model=MODEL, client=CLIENT):
+def find_subtypes(supertype, model=MODEL, client=CLIENT):
+    # Question 2 -- Find subtypes
     noun_dict = dict()
-    while len(noun_dict.keys()) == 0:
-        # find subtypes
-        a_list_types = q_list_types(f'"{supertype}"')
-        a_likely_types = q_likely_types(supertype.lower(), a_list_types)
-        subtype_list = extract_likely_items("\n" + a_likely_types)
-        a_likely_types += "\n"
-        renamed_trace = ""
-        excluded_trace = ""
-
-        for subitem in subtype_list:
-            # rename subtypes
-            new_subtype = confirm_subtype(subitem, supertype, 512, 128, model, client)
-            if not new_subtype:
-                excluded_trace += f"{subitem} is removed from the subtypes of {supertype}.\n"
-                continue
-            if new_subtype.lower() in [lower_type.lower() for lower_type in noun_dict.keys()]:
-                # If the new name for the subtype already exists as another subtype, find subtypes again.
-                noun_dict = dict()
-                break
-            if new_subtype.lower() == re.sub(r' \([^)]*\)$', '', supertype.lower()):
-                # If the original subtype name is the same as the supertype name, remove it.
-                excluded_trace += f"{subitem} is removed from the subtypes of {supertype}.\n"
-                continue
-            if new_subtype.lower() != subitem.lower():
-                renamed_trace += f"{subitem} is renamed as {new_subtype}.\n"
-            noun_dict[new_subtype] = list()
+    with loop_budget('find_subtypes') as budget:
+        while len(noun_dict.keys()) == 0 and budget.next_round():
+            # find subtypes
+            a_list_types = q_list_types(f'"{supertype}"')
+            a_likely_types = q_likely_types(supertype.lower(), a_list_types)
+            subtype_list = extract_likely_items("\n" + a_likely_types)
+            a_likely_types += "\n"
+            renamed_trace = ""
+            excluded_trace = ""
+
+            # rename subtypes, all of them with one question
+            subtype_names = confirm_subtypes(subtype_list, supertype, 512, 128, model, client)
+            for subitem in subtype_list:
+                new_subtype = subtype_names[subitem]
+                if not new_subtype:
+                    excluded_trace += f"{subitem} is removed from the subtypes of {supertype}.\n"
+                    continue
+                if new_subtype.lower() in [lower_type.lower() for lower_type in noun_dict.keys()]:
+                    # If the new name for the subtype already exists as another subtype, find subtypes again.
+                    forget_verdict(subitem, supertype)
+                    noun_dict = dict()
+                    break
+                if new_subtype.lower() == re.sub(r' \([^)]*\)$', '', supertype.lower()):
+                    # If the original subtype name is the same as the supertype name, remove it.
+                    excluded_trace += f"{subitem} is removed from the subtypes of {supertype}.\n"
+                    continue
+                if new_subtype.lower() != subitem.lower():
+                    renamed_trace += f"{subitem} is renamed as {new_subtype}.\n"
+                noun_dict[new_subtype] = list()
+    if len(noun_dict.keys()) == 0:
+        raise BudgetExhausted("no subtypes found within the find_subtypes loop's budget")
+
+    return noun_dict, a_likely_types, renamed_trace, excluded_trace
+
 
+def find_subsubtypes(supertype, new_subtype, subtype_names, model=MODEL, client=CLIENT):
+    # Question 3 -- Find subsubtypes of one subtype; the subtypes don't depend on each other
+    subsubtypes = list()
+    a_has_types = q_has_types(new_subtype, 10, model, client=client)
+    if a_has_types == 'no':
+        return subsubtypes, "", "", ""
+
+    if supertype.endswith(')'):
+        category = " (" + supertype.rsplit("(", 1)[1].lower()
+    elif supertype.lower() not in new_subtype.lower():
+        category = f" (a type of {supertype.lower()})"
+    else:
+        category = ""
+    with loop_budget('find_subsubtypes') as budget:
+        while len(subsubtypes) == 0 and budget.next_round():
+            a_list_types = q_list_types(f'"{new_subtype}{category}"')
+            a_likely_subsubtypes = q_likely_types(new_subtype.lower(), a_list_types)
+            subsubtype_list = extract_likely_items("\n" + a_likely_subsubtypes)
+            a_likely_types_temp = "Subtype: " + new_subtype + "\n" + a_likely_subsubtypes + "\n"
+            renamed_trace_temp = ""
+            excluded_trace_temp = ""
+
+            # rename subsubtypes, all of them with one question
+            subsubtype_names = confirm_subtypes(subsubtype_list, new_subtype, 512, 128, model, client)
+            for subsubtype in subsubtype_list:
+                new_subsubtype = subsubtype_names[subsubtype]
+                if not new_subsubtype:
+                    excluded_trace_temp += f"{subsubtype} is removed from the subtypes of {new_subtype}.\n"
+                    continue
+                if new_subsubtype.lower() in [lower_type.lower() for lower_type in subsubtypes]:
+                    # If the new name for the subsubtype already exists as another subsubtype, find subsubtypes again.
+                    forget_verdict(subsubtype, new_subtype)
+                    subsubtypes = list()
+                    break
+                if new_subsubtype.lower() == re.sub(r' \([^)]*\)$', '', supertype.lower()) or\
+                        new_subsubtype.lower() == new_subtype.lower() or\
+                        new_subsubtype.lower() in [sub_name.lower() for sub_name in subtype_names]:
+                    # If the subsubtype is the same as the supertype or subtype name, remove it.
+                    # If the subsubtype exists as another subtype, remove it.
+                    excluded_trace_temp += f"{subsubtype} is removed from the subtypes of {new_subtype}.\n"
+                    continue
+                if new_subsubtype.lower() != subsubtype.lower():
+                    renamed_trace_temp += f"{subsubtype} is renamed as {new_subsubtype}.\n"
+
+                subsubtypes.append(new_subsubtype)
+    if len(subsubtypes) == 0:
+        # out of budget, as if the subtype had no subtypes
+        return subsubtypes, "", "", ""
+
+    return subsubtypes, a_likely_types_temp, renamed_trace_temp, excluded_trace_temp
+
+
+def extract_subtypes(supertype, max_tokens=MAX_TOKENS, model=MODEL, client=CLIENT):
+    # Question 2 & 3 asked one after another; ``process_noun`` asks Q3 for all subtypes at once instead
+    noun_dict, a_likely_types, renamed_trace, excluded_trace = find_subtypes(supertype, model, client)
     for new_subtype in noun_dict.keys():
-        # find subsubtypes
-        a_has_types = q_has_types(new_subtype, 10, model)
-        if a_has_types == 'no':
-            noun_dict[new_subtype] = list()
-        else:
-            if supertype.endswith(')'):
-                category = " (" + supertype.rsplit("(", 1)[1].lower()
-            elif supertype.lower() not in new_subtype.lower():
-                category = f" (a type of {supertype.lower()})"
-            else:
-                category = ""
-            while len(noun_dict[new_subtype]) == 0:
-                a_list_types = q_list_types(f'"{new_subtype}{category}"')
-                a_likely_subsubtypes = q_likely_types(new_subtype.lower(), a_list_types)
-                subsubtype_list = extract_likely_items("\n" + a_likely_subsubtypes)
-                a_likely_types_temp = "Subtype: " + new_subtype + "\n" + a_likely_subsubtypes + "\n"
-                renamed_trace_temp = ""
-                excluded_trace_temp = ""
-
-                # rename subsubtypes
-                for subsubtype in subsubtype_list:
-                    new_subsubtype = confirm_subtype(subsubtype, new_subtype, 512, 128, model, client)
-                    if not new_subsubtype:
-                        excluded_trace_temp += f"{subsubtype} is removed from the subtypes of {new_subtype}.\n"
-                        continue
-                    if new_subsubtype.lower() in [lower_type.lower() for lower_type in noun_dict[new_subtype]]:
-                        # If the new name for the subsubtype already exists as another subsubtype, find subsubtypes again.
-                        noun_dict[new_subtype] = list()
-                        break
-                    if new_subsubtype.lower() == re.sub(r' \([^)]*\)$', '', supertype.lower()) or\
-                            new_subsubtype.lower() == new_subtype.lower() or\
-                            new_subsubtype.lower() in [sub_name.lower() for sub_name in noun_dict.keys()]:
-                        # If the subsubtype is the same as the supertype or subtype name, remove it.
-                        # If the subsubtype exists as another subtype, remove it.
-                        excluded_trace_temp += f"{subsubtype} is removed from the subtypes of {new_subtype}.\n"
-                        continue
-                    if new_subsubtype.lower() != subsubtype.lower():
-                        renamed_trace_temp += f"{subsubtype} is renamed as {new_subsubtype}.\n"
-
-                    noun_dict[new_subtype].append(new_subsubtype)
-
-            a_likely_types += a_likely_types_temp
-            renamed_trace += renamed_trace_temp
-            excluded_trace += excluded_trace_temp
+        noun_dict[new_subtype], a_likely_types_temp, renamed_trace_temp, excluded_trace_temp = \
+            find_subsubtypes(supertype, new_subtype, list(noun_dict.keys()), model, client)
+        a_likely_types += a_likely_types_temp
+        renamed_trace += renamed_trace_temp
+        excluded_trace += excluded_trace_temp
 
     return noun_dict, a_likely_types, renamed_trace, excluded_trace
 
@@ -298,18 +360,22 @@ def ensure_material_semantics(question_type, response, question_func, question_p
     if materials_too_long(material_response) or parts_too_long(material_response) or\
             ('unknown' in material_response.lower()) or\
             verbose_materials(material_response.lower()) or dependent_material:
-        # Prompt the model for the composition materials again
-        response = question_func(question_params)
-        _, _, material_response, dependent_material = extract_parts_materials(question_type, response)
-        while verbose_materials(material_response.lower()) or dependent_material:
+        # Prompt the model for the composition materials again;
+        # out of budget, the last response is kept and simplified when cleaning
+        with loop_budget('verbose_materials') as budget:
             response = question_func(question_params)
             _, _, material_response, dependent_material = extract_parts_materials(question_type, response)
+            while (verbose_materials(material_response.lower()) or dependent_material) and budget.next_round():
+                response = question_func(question_params)
+                _, _, material_response, dependent_material = extract_parts_materials(question_type, response)
         if materials_too_long(material_response) or parts_too_long(material_response) or\
                 'unknown' in material_response.lower():
-            response = question_func(question_params)
-            _, _, material_response, dependent_material = extract_parts_materials(question_type, response)
-            while verbose_materials(material_response.lower()) or dependent_material:
+            with loop_budget('verbose_materials') as budget:
                 response = question_func(question_params)
+                _, _, material_response, dependent_material = extract_parts_materials(question_type, response)
+                while (verbose_materials(material_response.lower()) or dependent_material) and budget.next_round():
+                    response = question_func(question_params)
+                    _, _, material_response, dependent_material = extract_parts_materials(question_type, response)
     return response
 
 
@@ -591,22 +657,9 @@ def extract_parts_materials(question_type, response):
     return new_parts_optionality, new_materials, material_response.strip(), dependent_material
 
 
-def append_rows(df, col_names, col_values):
-    if len(col_names) != len(col_names):
-        raise ValueError("The two lists `col_names` and `col_values` must have the same length.")
-
-    row_dict = dict()
-    for i in range(len(col_names)):
-        row_dict[col_names[i]] = col_values[i]
-
-    new_df = pd.DataFrame([row_dict])
-    df = pd.concat([df, new_df], axis=0, ignore_index=True)
-    return df
-
-
 def clean_response_format(raw_df):
     col_names = ['item', 'subtype', 'subsubtype', 'optionality', 'response']
-    clean_df = pd.DataFrame(columns=col_names)
+    clean_rows = RowBuffer(col_names)
 
     for ind, row in raw_df.iterrows():
         question_type = row['question']
@@ -614,122 +667,219 @@ def clean_response_format(raw_df):
         parts_optionality, materials, _, _ = extract_parts_materials(question_type, response)
         # change 'electronics' material to 'electronic materials'
         new_materials = re.sub(r':([^\n]+)electronics', ':\\1electronic materials', materials)
-        clean_df = append_rows(clean_df, col_names,
-                               [row['item'], row['subtype'], row['subsubtype'], parts_optionality, new_materials])
-    return clean_df
+        clean_rows.append([row['item'], row['subtype'], row['subsubtype'], parts_optionality, new_materials])
+    return clean_rows.to_frame()
 
 
-def main():
-    with open(NOUN_FILE, 'r') as f_read:
-        col_names = ['item', 'subtype', 'subsubtype', 'question', 'response']
-        result_df = pd.DataFrame(columns=col_names)
-        supertype = f_read.readline().strip()
-        while supertype:
-            # Question 1 -- Has subtypes
-            a_has_types = q_has_types(supertype, 10)
-
-            # leave a quick progress log
-            f_write = open(LOG_FILE, 'a')
-            f_write.write('Noun: ' + supertype + "\n")
-
-            if a_has_types == 'no':
-                noun_dict = dict()
-                noun_dict[supertype] = list()
+def leaf_items(supertype, noun_dict):
+    # Yield the items whose materials are asked, in the order of ``noun_dict``;
+    # these are either only the supertype, or only subitem(s), or only subsubitem(s).
+    for noun, subsub_list in noun_dict.items():
+        if subsub_list:
+            item_list = subsub_list
+        else:
+            item_list = [noun]
+
+        for cur_item in item_list:
+            subsubitem = ''
+            category = ''
+            supertype_tokens = supertype.lower().split()
+            if cur_item == supertype:
+                # Target: item
+                subitem = '-'
+                subsubitem = '-'
             else:
-                # Question 2 & 3 -- Find subtypes & subsubtypes
-                noun_dict, a_likely_types, renamed_type_trace, excluded_type_trace = extract_subtypes(supertype)
-                f_write.write(a_likely_types)
-                if renamed_type_trace:
-                    f_write.write("Renamed:\n" + renamed_type_trace)
-                if excluded_type_trace:
-                    f_write.write("Deleted:\n" + excluded_type_trace)
-
-            f_write.write("\n")
-            f_write.close()
-
-            if supertype not in noun_dict.keys():
-                noun_dict = organize_subtypes(supertype, noun_dict)
-
-            for noun, subsub_list in noun_dict.items():
-                # item_list becomes either only supertype, or only subitem(s), or only subsubitem(s).
-                if subsub_list:
-                    item_list = subsub_list
-                else:
-                    item_list = [noun]
-
-                for cur_item in item_list:
-                    subsubitem = ''
-                    category = ''
-                    supertype_tokens = supertype.lower().split()
-                    if cur_item == supertype:
-                        # Target: item
-                        subitem = '-'
-                        subsubitem = '-'
-                    else:
-                        subitem = noun
-
-                    if not subsubitem:
-                        if cur_item == noun:
-                            # Target: subtype
-                            subsubitem = '-'
-                            if all(token not in noun.lower() for token in supertype_tokens) and\
-                                    all(token.lower() not in supertype.lower() for token in noun.split()):
-                                if " (" in supertype:
-                                    category = f" ({supertype.rsplit(' (', 1)[1].lower()}"
-                                else:
-                                    category = f" (a type of {supertype.lower()})"
+                subitem = noun
+
+            if not subsubitem:
+                if cur_item == noun:
+                    # Target: subtype
+                    subsubitem = '-'
+                    if all(token not in noun.lower() for token in supertype_tokens) and\
+                            all(token.lower() not in supertype.lower() for token in noun.split()):
+                        if " (" in supertype:
+                            category = f" ({supertype.rsplit(' (', 1)[1].lower()}"
                         else:
-                            # Target: subsubtype
-                            subsubitem = cur_item
-                            if all(token not in subsubitem.lower() for token in supertype_tokens) and\
-                                    all(token.lower() not in subsubitem.lower() for token in noun.split()) and\
-                                    all(token.lower() not in supertype.lower() for token in subsubitem.split()) and\
-                                    all(token.lower() not in noun.lower() for token in subsubitem.split()):
-                                if " (" in supertype:
-                                    category = f" ({supertype.rsplit(' (', 1)[1].lower()}"
-                                else:
-                                    category = f" (a type of {re.sub(r' \([^)]*\)', '', noun.lower())})"
-
-
-                    item_plural = find_plural(cur_item.lower())
-                    article = find_article(cur_item.lower(), item_plural)
-
-                    # Question 4 -- Has distinct parts
-                    a_distinct_parts = q_distinct_parts(article + cur_item.lower() + category, 10)
-                    if a_distinct_parts in {'0', '1'}:
-                        # Question 5 -- Find materials for the type
-                        a_item_materials = q_item_materials(item_plural + category, 256)
-                        a_item_materials = ensure_material_semantics('A', a_item_materials, q_item_materials,
-                                                                     item_plural + category)
-                        result_df = append_rows(result_df, col_names,
-                                                [supertype, subitem, subsubitem, 'A', a_item_materials])
-                    else:
-                        # Question 6 -- Different parts have uniform materials
-                        a_same_materials = q_same_materials(article + cur_item.lower() + category, 10)
-                        if "yes" in a_same_materials.lower():
-                            # Question 7 -- Find parts and materials for the type
-                            a_parts_materials = q_parts_materials((article, cur_item.lower() + category))
-                            a_parts_materials = ensure_material_semantics('B', a_parts_materials, q_parts_materials, (article, cur_item.lower() + category))
-                            if wrong_parts_materials_format(a_parts_materials):
-                                a_parts_materials = q_parts_materials((article, cur_item.lower() + category))
-                            result_df = append_rows(result_df, col_names,
-                                                    [supertype, subitem, subsubitem, 'B', a_parts_materials])
+                            category = f" (a type of {supertype.lower()})"
+                else:
+                    # Target: subsubtype
+                    subsubitem = cur_item
+                    if all(token not in subsubitem.lower() for token in supertype_tokens) and\
+                            all(token.lower() not in subsubitem.lower() for token in noun.split()) and\
+                            all(token.lower() not in supertype.lower() for token in subsubitem.split()) and\
+                            all(token.lower() not in noun.lower() for token in subsubitem.split()):
+                        if " (" in supertype:
+                            category = f" ({supertype.rsplit(' (', 1)[1].lower()}"
                         else:
-                            # Question 8 -- Find parts and materials for each part
-                            a_diff_parts_materials = q_different_parts_materials(article + cur_item.lower() + category)
-                            a_diff_parts_materials = ensure_material_semantics('C', a_diff_parts_materials, q_different_parts_materials, article + cur_item.lower() + category)
-                            if not re.search(r'-[\s]+material[s]*:', a_diff_parts_materials, re.IGNORECASE) or\
-                                    wrong_parts_materials_format(a_diff_parts_materials):
-                                a_diff_parts_materials = q_different_parts_materials(article + cur_item.lower() + category)
-                            result_df = append_rows(result_df, col_names,
-                                                    [supertype, subitem, subsubitem, 'C', a_diff_parts_materials])
-
+                            category = f" (a type of {re.sub(r' \([^)]*\)', '', noun.lower())})"
+
+            yield subitem, subsubitem, cur_item, category
+
+
+def ask_item_materials(graph, q4_task, q6_task, supertype, subitem, subsubitem, cur_item, category):
+    item_plural = find_plural(cur_item.lower())
+    article = find_article(cur_item.lower(), item_plural)
+
+    a_distinct_parts = graph.result(q4_task)
+    if a_distinct_parts in {'0', '1'}:
+        # Question 5 -- Find materials for the type
+        a_item_materials = q_item_materials(item_plural + category, 256)
+        a_item_materials = ensure_material_semantics('A', a_item_materials, q_item_materials,
+                                                     item_plural + category)
+        return [supertype, subitem, subsubitem, 'A', a_item_materials]
+
+    # Question 6 was asked at the same time as Question 4
+    a_same_materials = graph.result(q6_task)
+    if "yes" in a_same_materials.lower():
+        # Question 7 -- Find parts and materials for the type
+        a_parts_materials = q_parts_materials((article, cur_item.lower() + category))
+        a_parts_materials = ensure_material_semantics('B', a_parts_materials, q_parts_materials, (article, cur_item.lower() + category))
+        if wrong_parts_materials_format(a_parts_materials):
+            a_parts_materials = q_parts_materials((article, cur_item.lower() + category))
+        return [supertype, subitem, subsubitem, 'B', a_parts_materials]
+    else:
+        # Question 8 -- Find parts and materials for each part
+        a_diff_parts_materials = q_different_parts_materials(article + cur_item.lower() + category)
+        a_diff_parts_materials = ensure_material_semantics('C', a_diff_parts_materials, q_different_parts_materials, article + cur_item.lower() + category)
+        if not re.search(r'-[\s]+material[s]*:', a_diff_parts_materials, re.IGNORECASE) or\
+                wrong_parts_materials_format(a_diff_parts_materials):
+            a_diff_parts_materials = q_different_parts_materials(article + cur_item.lower() + category)
+        return [supertype, subitem, subsubitem, 'C', a_diff_parts_materials]
+
+
+def schedule_subtypes(graph, supertype, state):
+    if graph.result('Q1') == 'no':
+        state['noun_dict'] = {supertype: list()}
+        schedule_items(graph, supertype, state)
+        return
+
+    # Question 2 -- Find subtypes
+    noun_dict, state['likely_types'], state['renamed'], state['excluded'] = find_subtypes(supertype)
+    state['noun_dict'] = noun_dict
+    # Question 3 -- Find subsubtypes of all subtypes at once
+    subtype_tasks = [graph.add(f'Q3 [{new_subtype}]', find_subsubtypes, supertype, new_subtype, list(noun_dict.keys()))
+                     for new_subtype in noun_dict.keys()]
+    graph.add('Q3', collect_subsubtypes, graph, supertype, state, subtype_tasks, deps=subtype_tasks)
+
+
+def collect_subsubtypes(graph, supertype, state, subtype_tasks):
+    for new_subtype, subtype_task in zip(state['noun_dict'].keys(), subtype_tasks):
+        state['noun_dict'][new_subtype], a_likely_types_temp, renamed_trace_temp, excluded_trace_temp = \
+            graph.result(subtype_task)
+        state['likely_types'] += a_likely_types_temp
+        state['renamed'] += renamed_trace_temp
+        state['excluded'] += excluded_trace_temp
+    schedule_items(graph, supertype, state)
+
+
+def schedule_items(graph, supertype, state):
+    noun_dict = state['noun_dict']
+    if supertype not in noun_dict.keys():
+        noun_dict = organize_subtypes(supertype, noun_dict)
+
+    # Questions 4 to 8 for every item at once
+    for i, (subitem, subsubitem, cur_item, category) in enumerate(leaf_items(supertype, noun_dict)):
+        item_plural = find_plural(cur_item.lower())
+        article = find_article(cur_item.lower(), item_plural)
+        # Question 4 -- Has distinct parts
+        q4_task = graph.add(f'Q4 [{i}: {cur_item}]', q_distinct_parts, article + cur_item.lower() + category, 10)
+        # Question 6 -- Different parts have uniform materials;
+        # this short question is asked together with Question 4 and ignored if the item has no distinct parts
+        q6_task = graph.add(f'Q6 [{i}: {cur_item}]', q_same_materials, article + cur_item.lower() + category, 10)
+        state['item_tasks'].append(graph.add(f'Q5-Q8 [{i}: {cur_item}]', ask_item_materials, graph, q4_task, q6_task,
+                                             supertype, subitem, subsubitem, cur_item, category,
+                                             deps=[q4_task, q6_task]))
+
+
+def process_noun(supertype, executor):
+    # The questions about one noun form a dependency graph; every question whose answers it needs
+    # are known is asked right away, e.g., Question 3 for all subtypes, or Questions 4 to 8 for all items.
+    state = {'noun_dict': dict(), 'likely_types': '', 'renamed': '', 'excluded': '', 'item_tasks': list()}
+    graph = TaskGraph(executor)
+    with cache_scope(supertype), noun_budget(supertype):
+        # Question 1 -- Has subtypes
+        graph.add('Q1', q_has_types, supertype, 10)
+        graph.add('Q2', schedule_subtypes, graph, supertype, state, deps=['Q1'])
+        graph.run()
+
+    # a quick progress log
+    log = 'Noun: ' + supertype + "\n"
+    if graph.result('Q1') != 'no':
+        log += state['likely_types']
+        if state['renamed']:
+            log += "Renamed:\n" + state['renamed']
+        if state['excluded']:
+            log += "Deleted:\n" + state['excluded']
+    log += "\n"
+
+    rows = [graph.result(item_task) for item_task in state['item_tasks']]
+    return rows, log, graph.report()
 
-            result_df.to_csv(RESULT_FILE, sep='\t', index=False, encoding='utf-8')
-            supertype = f_read.readline().strip()
 
-        clean_df = clean_response_format(result_df)
-        clean_df.to_csv(CLEAN_RESULT_FILE, sep='\t', index=False, encoding='utf-8')
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true',
+                        help=f'skip the nouns already completed in {RESULT_FILE}')
+    parser.add_argument('--plan', metavar='BATCH_FILE', default=None,
+                        help='write the requests without cached responses to a Batch API file instead of sending them')
+    parser.add_argument('--ingest', metavar='RESULTS_FILE', default=None,
+                        help='store the responses of a Batch API results file before planning the next requests')
+    parser.add_argument('--clean-workers', type=int, default=1,
+                        help='number of processes cleaning the intermediate file (0: all cores)')
+    args = parser.parse_args()
+    if args.ingest and not args.plan:
+        raise ValueError("Please specify the next batch file with ``--plan`` when ingesting results.")
+
+    cache = set_response_cache(CACHE_FILE, CACHE_MODE)
+    verdict_memo = set_verdict_memo(VERDICT_FILE)
+    set_max_tokens(MAX_TOKENS_FILE)
+    if args.ingest:
+        ingest_results(args.ingest, cache)
+    if args.plan:
+        cache.plan(args.plan)
+    col_names = ['item', 'subtype', 'subsubtype', 'question', 'response']
+    # in plan mode, the nouns completed by earlier waves are kept
+    writer = ResultWriter(RESULT_FILE, col_names, resume=args.resume or bool(args.plan))
+    unfinished = 0
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+        for supertype in read_nouns(NOUN_FILE):
+            if supertype in writer.completed:
+                continue
+            try:
+                rows, log, report = process_noun(supertype, executor)
+            except PendingRequest:
+                # every question that could be asked with the cached responses is in the batch file
+                unfinished += 1
+                continue
+            except BudgetExhausted as error:
+                # the noun is written without rows, so that the run goes on; see BUDGET_FILE
+                BUDGET_LOG.skip(supertype, error)
+                rows, log, report = list(), f"Noun: {supertype}\nSkipped, out of budget: {error}\n\n", \
+                    f"skipped, out of budget: {error}"
+            if unfinished:
+                # written in a later wave to keep the noun order; the responses are cached by then
+                unfinished += 1
+                continue
+            print(f"{supertype}: {report}")
+            with open(LOG_FILE, 'a') as f_write:
+                f_write.write(log)
+            writer.write(supertype, rows)
+
+    verdict_memo.save()
+    TELEMETRY.export(METRICS_FILE)
+    BUDGET_LOG.export(BUDGET_FILE)
+    print(TELEMETRY.summary())
+    print(verdict_memo.summary())
+    print(BUDGET_LOG.summary())
+    if args.plan:
+        print(plan_summary(cache, unfinished))
+        if unfinished:
+            return
+
+    # clean the whole intermediate file in one pass, split over ``--clean-workers`` processes
+    clean_df = clean_in_chunks(writer.read(), clean_response_format, args.clean_workers or None)
+    clean_df.to_csv(CLEAN_RESULT_FILE, sep='\t', index=False, encoding='utf-8')
+    print(cache.summary())
 
 
 if __name__ == "__main__":